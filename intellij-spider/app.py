@@ -1,5 +1,8 @@
 from network.urlloader import Url
+from network.dnscache import DnsCache
 from config import get_app_config
+from rule.stats import RegexStats
+from rule.budget import require_regex
 
 
 class BaseApp(object):
@@ -25,3 +28,10 @@ class BaseApp(object):
         self.normal_thread_count = 1
         self.proxy_thread_count = 1
         self.config = get_app_config()
+        # 开启正则时间预算时在启动时检查regex模块，避免工作线程解析时才失败
+        if self.config.regex_timeout:
+            require_regex()
+        if self.config.adaptive_regex_order and self.config.regex_stats_file:
+            RegexStats.setup(self.config.regex_stats_file)
+        if self.config.dns_cache_ttl and self.config.dns_prefetch:
+            DnsCache.prefetch([url.value for url in self.urls])
@@ -0,0 +1,385 @@
+import time
+import pathlib
+import asyncio
+import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from app import BaseApp
+from rule.registry import RuleRegistry
+from task import Task
+from scheduler import Scheduler
+from config import *
+from config import get_app_config
+from common.cache import read_cache, write_cache
+from common.content import RawContent
+from common.log import logger
+from common.util import writelines
+from network.hoststats import HostConcurrency, HostTimeout
+from network.transport import Transport
+from network.dnscache import DnsCache
+from network.urlloader import UrlLoader, Url, BufferedResponse, BodyRejected, BLOCK_STATUS_CODES, CHUNK_SIZE
+from network.retry import CircuitBreaker, CircuitOpenError, DeadlineExceeded, RetryBudget, RetryLater, \
+    get_retry_delay, FAILURE_STATUS_CODES
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+'''
+主应用：使用asyncio异步下载，一个事件循环同时处理大量请求，解析在线程池中执行（需要安装aiohttp）
+'''
+
+
+class AsyncUrlLoader(object):
+    """
+    异步URL下载器，缓存、代理、失败重试（RetryPolicy、熔断）、下载内容检查（FailureCondition）与UrlLoader一致，
+    域名的并发名额和请求频率由Scheduler在调度任务时控制
+    """
+
+    def __init__(self, session, executor: ThreadPoolExecutor):
+        self._session = session
+        self._executor = executor
+
+    async def load(self, url: Url, raw=False, retry=None, attempt=0, deadline=None):
+        """
+        下载URL链接，先查询缓存，下载成功后保存到缓存
+        :param url:
+        :param raw: 是否返回未解码的原始内容RawContent
+        :param retry: 最大请求次数，为空时使用RetryPolicy.max_retries
+        :param attempt: 已经请求的次数
+        :param deadline: 截止时间（time.time()），包括所有重试和跳转
+        :return:
+        :raise CircuitOpenError: 域名熔断中
+        :raise RetryLater: 请求失败，延后重试
+        """
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self._executor, read_cache, url.value, raw)
+        if result is not None:
+            return result
+        ok, result = await self.fetch(url, retry, raw, attempt, deadline)
+        if ok:
+            await loop.run_in_executor(self._executor, write_cache, url.value, result, raw)
+        return result
+
+    async def fetch(self, url: Url, retry=None, raw=False, attempt=0, deadline=None):
+        ok, result = False, None
+        referer = url.referer
+        url = url.value
+
+        app_config = get_app_config()
+        policy = app_config.get_url_policy(url)
+        pool = policy.proxy_pool
+        scheme = url.split(':')[0]
+        logger.info('Start request url: {}, proxy: {}'.format(url, pool))
+
+        loop = asyncio.get_running_loop()
+        retry = retry or app_config.retry_policy.max_retries
+        if not attempt:
+            RetryBudget.deposit(url)
+        for i in range(attempt, retry):
+            probe = CircuitBreaker.allow(url)
+            try:
+                # 每次请求从代理池按健康分数选择代理
+                proxies = pool.choose() if pool else None
+                proxy = proxies.get(scheme) if proxies else None
+                from_t = time.perf_counter()
+                blocked, status_code = False, None
+                try:
+                    async with self._session.get(url, headers=Transport.get_headers(referer), proxy=proxy,
+                                                 timeout=self.get_timeout(url, deadline)) as res:
+                        response = await self.read_response(url, res)
+                    seconds = time.perf_counter() - from_t
+                    dt = int(seconds * 1000)
+                    if response.ok:
+                        logger.info('[{}] request url success, takes: {} ms, size:{}, {}'.format(
+                            i, dt, len(response.content), url))
+                        CircuitBreaker.record(url, True)
+                        # 解码和内容检查在线程池中执行，不阻塞事件循环
+                        ok, result = await loop.run_in_executor(self._executor, self.check, url, response, raw,
+                                                                   policy.failures)
+                        HostConcurrency.record(url, seconds, blocked=not ok)
+                        if pool:
+                            pool.record(proxies, seconds, blocked=not ok)
+                        if ok:
+                            break
+                        # 被反扒，等待代理地址切换
+                        blocked = True
+                    else:
+                        logger.info('[{}] request url failed, takes {}ms, code:{}-{}'.format(
+                            i, dt, response.status_code, response.reason))
+                        status_code = response.status_code
+                        blocked = status_code in BLOCK_STATUS_CODES
+                        # 只有服务端错误计入并发调整和熔断，404等链接错误不表示域名不可用
+                        healthy = status_code not in FAILURE_STATUS_CODES
+                        HostConcurrency.record(url, seconds, ok=healthy, blocked=blocked)
+                        CircuitBreaker.record(url, healthy)
+                        if pool:
+                            pool.record(proxies, seconds, ok=False, blocked=blocked)
+                except asyncio.CancelledError:
+                    raise
+                except BodyRejected as e:
+                    logger.warn('[{}] {}, {}'.format(i, e, url))
+                    break
+                except DeadlineExceeded as e:
+                    # 任务延后重新执行，使用新的截止时间
+                    logger.warn('[{}] {}, {}'.format(i, e, url))
+                except Exception as e:
+                    logger.error('[{}] request url failed, error: {}'.format(i, e))
+                    seconds = time.perf_counter() - from_t
+                    HostConcurrency.record(url, seconds, ok=False)
+                    CircuitBreaker.record(url, False)
+                    if pool:
+                        pool.record(proxies, seconds, ok=False)
+            finally:
+                # 试探请求没有调用record（例如超过截止时间）时释放试探，否则域名一直处于熔断状态
+                if probe:
+                    CircuitBreaker.release(url)
+            delay = get_retry_delay(url, i, retry, blocked, status_code)
+            if delay is None:
+                break
+            raise RetryLater(url, delay, i + 1)
+        return ok, result
+
+    @classmethod
+    async def read_response(cls, url: str, res) -> BufferedResponse:
+        """
+        分块读取响应内容，内容类型不是网页或者大小超过上限时中止下载，错误响应不读取内容
+        :param url:
+        :param res:
+        :return:
+        :raise BodyRejected:
+        """
+        if res.status >= 400:
+            return BufferedResponse(res.status, res.reason, res.headers, b'')
+        max_size = UrlLoader.check_headers(url, res.headers)
+        size, buffer = 0, bytearray()
+        async for chunk in res.content.iter_chunked(CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_size:
+                raise BodyRejected('Content size exceeds {}'.format(max_size))
+            buffer.extend(chunk)
+        return BufferedResponse(res.status, res.reason, res.headers, bytes(buffer))
+
+    @classmethod
+    def get_timeout(cls, url: str, deadline=None):
+        """
+        按域名延迟计算请求超时（HostTimeout），包括跳转的总时间不超过截止时间
+        :param url:
+        :param deadline:
+        :return:
+        """
+        connect, read = HostTimeout.get_timeout(url)
+        total = None
+        if deadline is not None:
+            total = deadline - time.time()
+            if total <= 0:
+                raise DeadlineExceeded(total)
+        return aiohttp.ClientTimeout(total=total, sock_connect=connect, sock_read=read)
+
+    @classmethod
+    def check(cls, url, response: BufferedResponse, raw=False, failures=None):
+        encoding = UrlLoader.get_encoding(url, response)
+        result = RawContent(response.content, encoding) if raw else UrlLoader.decode(response, encoding)
+        # 根据配置检查是否是正常的返回内容
+        return get_app_config().fail_conditions.test(url, result, failures), result
+
+
+class Job(object):
+    """
+    (异步)爬虫应用框架，所有下载在一个事件循环中并发执行，解析在线程池中执行，
+    任务按域名调度（Scheduler）：某个域名达到并发上限或者请求频率限制时，其他域名的任务继续执行；
+    解析过程中提取的子任务立即加入调度队列，所有任务完成后结束
+    """
+
+    def __init__(self, name: str, urls: list, rule_name: str, concurrency=1000, parse_thread_count=4):
+        """
+        初始化一个抓取应用
+        :param name: 应用名
+        :param urls: 入口链接列表
+        :param rule_name: 入口链接内容对应的解析规则
+        :param concurrency: 同时下载的任务数
+        :param parse_thread_count: 解析线程数
+        """
+        self.name = name
+        self.urls = urls
+        self.rule_name = rule_name
+        self.concurrency = concurrency
+        self.parse_thread_count = parse_thread_count
+
+        self.scheduler = None
+        self.executor = None
+        # 有新任务、任务完成时唤醒调度协程
+        self.wakeup = None
+        # 正在执行的任务数
+        self.running = 0
+        # 解析结果，定时存储 [(task, data)]
+        self.data_list = []
+        self.is_running = False
+
+    def add_task(self, task: Task, delay=0):
+        """
+        在事件循环中加入任务
+        :param task:
+        :param delay: 延后执行的时间（秒），用于失败重试
+        :return:
+        """
+        self.scheduler.put(task, delay=delay)
+        self.wakeup.set()
+        logger.info('Add to task queue(async):{}, {}'.format(task.url, self.scheduler.qsize()))
+
+    async def dispatch(self, loader: AsyncUrlLoader):
+        """
+        调度协程：有空闲的并发名额时取出任意一个可以执行的域名的任务执行，没有可以执行的任务时等待，
+        所有任务完成后返回
+        :param loader:
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            await semaphore.acquire()
+            while True:
+                self.wakeup.clear()
+                task, wait = self.scheduler.poll()
+                if task is not None:
+                    break
+                if self.scheduler.empty() and not self.running:
+                    return
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            self.running += 1
+            loop.create_task(self.run_task(loader, task, semaphore))
+
+    async def run_task(self, loader: AsyncUrlLoader, task: Task, semaphore: asyncio.Semaphore):
+        loop = asyncio.get_running_loop()
+
+        def on_sub_task(t):
+            # 解析线程中提取的子任务，在事件循环中加入调度队列
+            loop.call_soon_threadsafe(self.add_task, t)
+
+        try:
+            url_content = await loader.load(task.url, get_app_config().raw_content, attempt=task.attempt,
+                                            deadline=task.get_deadline())
+            tr = await loop.run_in_executor(self.executor, task.parse, url_content, on_sub_task)
+            if tr.data and not get_app_config().no_save:
+                self.data_list.append((task, tr.data))
+        except CircuitOpenError as e:
+            # 域名熔断，熔断结束后重新调度
+            logger.info('Task deferred, {}, {}'.format(e, task.url))
+            self.add_task(task, delay=e.retry_after)
+        except RetryLater as e:
+            # 下载失败，按重试间隔重新调度
+            self.add_task(task, delay=task.defer(e).retry_after)
+        except Exception as e:
+            logger.error('Execute task failed, {} {}'.format(task.url, e))
+        finally:
+            # 释放域名的并发名额
+            self.scheduler.done(task)
+            self.running -= 1
+            semaphore.release()
+            self.wakeup.set()
+
+    def store(self, data_list):
+        if not data_list:
+            return 0
+        grouped_data = defaultdict(lambda: [])
+        for task, data in data_list:
+            grouped_data[task.rule.name].append(data)
+        base_path = pathlib.Path(OUTPUT_DIR) / self.name / self.now()
+        for rule_name, data_list in grouped_data.items():
+            path = base_path / '{}.txt'.format(rule_name)
+            writelines(data_list, path)
+        return len(grouped_data)
+
+    async def run_store(self):
+        index, count = 0, 0
+        loop = asyncio.get_running_loop()
+        while self.is_running:
+            # 每10s存储一次数据
+            await asyncio.sleep(10)
+            # 在事件循环中取出解析结果，避免与工作协程并发修改
+            data_list, self.data_list = self.data_list, []
+            n = await loop.run_in_executor(self.executor, self.store, data_list)
+            if n:
+                index, count = index + 1, count + n
+                logger.info('Store index: {}, count:{}'.format(index, count))
+
+    @classmethod
+    def now(cls):
+        return datetime.datetime.now().date().isoformat()
+
+    async def run(self):
+        self.is_running = True
+        self.scheduler = Scheduler()
+        self.wakeup = asyncio.Event()
+        for url in self.urls:
+            self.add_task(Task(url=url, rule=RuleRegistry.get(self.rule_name)))
+        self.executor = ThreadPoolExecutor(max_workers=self.parse_thread_count, thread_name_prefix='parse_task')
+
+        app_config = get_app_config()
+        # aiohttp按dns_cache_ttl缓存解析结果，缓存过期后的解析（线程池中的getaddrinfo）使用DnsCache
+        if app_config.dns_cache_ttl:
+            DnsCache.install()
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=app_config.max_connections_per_host,
+                                         use_dns_cache=bool(app_config.dns_cache_ttl),
+                                         ttl_dns_cache=app_config.dns_cache_ttl or None)
+        # 不使用会话时不保留cookie，与同步下载一致
+        cookie_jar = None if app_config.use_session else aiohttp.DummyCookieJar()
+        # 每个请求按域名延迟设置超时（AsyncUrlLoader.get_timeout）
+        timeout = aiohttp.ClientTimeout(sock_connect=app_config.connect_timeout, sock_read=app_config.read_timeout)
+        loop = asyncio.get_running_loop()
+        async with aiohttp.ClientSession(connector=connector, cookie_jar=cookie_jar, timeout=timeout) as session:
+            loader = AsyncUrlLoader(session, self.executor)
+            store_task = loop.create_task(self.run_store())
+            await self.dispatch(loader)
+
+            self.is_running = False
+            store_task.cancel()
+            await asyncio.gather(store_task, return_exceptions=True)
+        await loop.run_in_executor(self.executor, self.store, self.data_list)
+        self.executor.shutdown()
+        logger.info('All tasks done !')
+
+    def start(self):
+        if aiohttp is None:
+            logger.error('Async mode requires aiohttp, please install it first')
+            return
+        asyncio.run(self.run())
+
+
+class App(BaseApp):
+    """
+    (异步)爬虫应用框架，用于创建一个定时抓取任务，只需要指定抓取入口链接和对应的解析规则即可，
+    后续提取和链接会自动添加到抓取队列，例如：
+    my_app = App('myApp', url='http://www.sina.com', rule_name='sina')
+    my_app.schedule()
+    """
+
+    def __init__(self, name: str, url: (str, list), rule_name: str):
+        """
+        初始化一个抓取应用
+        :param name: 应用名
+        :param url: 入口链接
+        :param rule_name: 入口链接内容对应的解析规则
+        """
+        super(App, self).__init__(name, url, rule_name)
+        self.concurrency = self.config.async_concurrency
+
+    def start_job(self):
+        job = Job(self.name, self.urls, self.rule_name, self.concurrency, self.config.parse_thread_count)
+        job.start()
+
+    def schedule(self, concurrency=None):
+        if concurrency:
+            self.concurrency = concurrency
+        self.start_job()
+
+
+if __name__ == '__main__':
+    get_app_config().proxy_mapping = ProxyMapping.of_asdl_high()
+    app = App('async_app', rule_name='jd_page', url='https://list.jd.hk/list.html?cat=1316,1381,1389&page=1')
+    app.schedule()
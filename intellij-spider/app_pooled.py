@@ -3,8 +3,9 @@ from collections import defaultdict
 
 import time
 import datetime
-from rule.rule import Rule
+from rule.registry import RuleRegistry
 from task import Task
+from scheduler import Scheduler
 from threading import Thread
 import queue
 from config import *
@@ -78,10 +79,14 @@ class Job(object):
 
     @classmethod
     def run_worker(cls, task, app):
-        tr = task.execute()
-        if tr.sub_tasks:
-            for t in tr.sub_tasks:
-                app.normal_task_queue.put(t)
+        # 解析过程中提取的子任务立即加入任务队列
+        try:
+            tr = task.execute(on_sub_task=app.normal_task_queue.put, defer_retry=True)
+        finally:
+            app.normal_task_queue.done(task)
+        if tr.retry_after:
+            # 下载失败或者域名熔断，任务延后重新调度，当前线程继续执行其他任务
+            app.normal_task_queue.put(task, delay=tr.retry_after)
         if tr.data:
             app.data_queue.put((task, tr.data))
 
@@ -123,9 +128,9 @@ class Job(object):
         self.is_running = True
 
         # Task queue for url without proxy downloading
-        self.normal_task_queue = Queue()
+        self.normal_task_queue = Scheduler()
         for url in self.urls:
-            self.normal_task_queue.put(Task(url=url, rule=Rule.find_by_name(self.rule_name)))
+            self.normal_task_queue.put(Task(url=url, rule=RuleRegistry.get(self.rule_name)))
         # Task queue for url with proxy downloading
         self.proxy_task_queue = Queue()
         # Data queue for result storage
@@ -136,7 +141,8 @@ class Job(object):
 
         while 1:
             try:
-                task: Task = self.normal_task_queue.get(block=False)
+                # 按域名请求频率调度，所有域名都没有令牌时等待
+                task: Task = self.normal_task_queue.get(timeout=1)
                 task_pool = self.normal_task_pool
 
                 task_pool.submit(self.run_worker, task, self)
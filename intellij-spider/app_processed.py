@@ -1,12 +1,13 @@
 import pathlib
 from collections import defaultdict
 import datetime
-from rule.rule import Rule
+from rule.registry import RuleRegistry
 from task import Task
+from scheduler import Scheduler, HostRateLimiter
 from config import *
 from network.urlloader import Url
 from config import set_app_config, get_app_config
-from multiprocessing import Process, Queue, Lock
+from multiprocessing import Process, Queue, Lock, Manager
 import time
 from queue import Empty
 from app import BaseApp
@@ -89,13 +90,18 @@ class Job(object):
     my_app.schedule()
     """
 
+    # 每个进程从任务队列预取的任务数
+    PREFETCH_COUNT = 16
+
     def __init__(self, name: str, urls: list, rule_name: str, task_queue: QueueWithLock, data_queue: QueueWithLock,
-                 process_count=2):
+                 process_count=2, rate_states=None, rate_lock=None):
         """
         初始化一个抓取应用
         :param name: 应用名
         :param url: 入口链接
         :param rule_name: 入口链接内容对应的解析规则
+        :param rate_states: 多进程共享的域名请求频率状态
+        :param rate_lock: 多进程共享的请求频率锁
         """
         self.name = name
         self.urls = urls
@@ -115,36 +121,50 @@ class Job(object):
         self.id = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
         self.app_config = app_config
 
+        # 所有进程共享域名请求频率，每个进程的任务按域名调度
+        self.rate_states = rate_states
+        self.rate_lock = rate_lock
+        self.scheduler = None
+
     @classmethod
     def is_proxy_url(cls, url):
         pm = app_config.proxy_mapping
-        return pm.get_url_proxy(url) is not None
+        return pm.get_url_pool(url) is not None
 
     @classmethod
     def run_worker_thread(cls, job):
         while job.is_running:
-            tasks = job.task_queue.get_many()
-            if not tasks:
-                time.sleep(5)
+            # 从共享的任务队列预取任务，按域名请求频率调度
+            if job.scheduler.ready_qsize() < cls.PREFETCH_COUNT:
+                job.scheduler.put_many(job.task_queue.get_many(cls.PREFETCH_COUNT))
+            try:
+                task = job.scheduler.get(timeout=1)
+            except Empty:
+                if job.task_queue.qsize() == 0:
+                    time.sleep(1)
                 continue
 
-            task_results = []
-            for task in tasks:
-                tr = task.execute()
-                if tr.sub_tasks:
-                    job.task_queue.put_many(tr.sub_tasks)
-                    logger.info('Add {} new tasks, total task count:{}'.format(len(tr.sub_tasks), job.task_queue.qsize()))
+            # 解析过程中提取的子任务立即加入任务队列
+            try:
+                tr = task.execute(on_sub_task=job.task_queue.put, defer_retry=True)
+            finally:
+                job.scheduler.done(task)
+            if tr.retry_after:
+                # 下载失败或者域名熔断，任务延后重新调度，当前线程继续执行其他任务
+                job.scheduler.put(task, delay=tr.retry_after)
+            if tr.sub_tasks:
+                logger.info('Add {} new tasks, total task count:{}'.format(len(tr.sub_tasks), job.task_queue.qsize()))
 
-                if tr.data:
-                    # job.data_queue.put((task, tr.data))
-                    task_results.append((task, tr.data))
-            job.data_queue.put_many(task_results)
+            if tr.data:
+                job.data_queue.put((task, tr.data))
 
     @classmethod
     def run_worker(cls, job):
         logger.info("Start process")
         set_app_config(job.app_config)
         logger.info('app config:%s', get_app_config)
+        limiter = HostRateLimiter(job.app_config.rate_limit_mapping, job.rate_states, job.rate_lock)
+        job.scheduler = Scheduler(limiter)
         for i in range(3):
             sub_thread = Thread(target=cls.run_worker_thread, args=(job,))
             sub_thread.start()
@@ -184,7 +204,7 @@ class Job(object):
         self.is_running = True
 
         for url in self.urls:
-            self.task_queue.put(Task(url=url, rule=Rule.find_by_name(self.rule_name)))
+            self.task_queue.put(Task(url=url, rule=RuleRegistry.get(self.rule_name)))
         self.worker_processes = [Process(target=self.run_worker, args=(self,)) for i in
                                  range(self.process_count)]
 
@@ -240,12 +260,16 @@ class App(BaseApp):
         self._process_count = 1
         self._task_queue = QueueWithLock('TaskQueue')
         self._data_queue = QueueWithLock('DataQueue')
+        # 多进程共享的域名请求频率状态
+        self._manager = Manager()
+        self._rate_states = self._manager.dict()
+        self._rate_lock = self._manager.Lock()
         super(App, self).__init__(name, urls, rule_name)
 
     def start_job(self):
         self._current_job = Job(self._name, self._urls, self._rule_name,
                                 self._task_queue, self._data_queue,
-                                self._process_count)
+                                self._process_count, self._rate_states, self._rate_lock)
         self._current_job.start()
 
     def schedule(self, process_count=2):
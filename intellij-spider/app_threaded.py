@@ -6,8 +6,9 @@ import time
 import datetime
 
 from app import BaseApp
-from rule.rule import Rule
+from rule.registry import RuleRegistry
 from task import Task
+from scheduler import Scheduler
 from threading import Thread
 import queue
 from config import *
@@ -88,27 +89,34 @@ class Job(object):
     @classmethod
     def is_proxy_url(cls, url):
         pm = get_app_config().proxy_mapping
-        return pm.get_url_proxy(url) is not None
+        return pm.get_url_pool(url) is not None
 
     @classmethod
     def run_worker(cls, app):
         task_queue = app.task_normal_queue
         while app.is_running:
             try:
-                task = task_queue.get(block=False)
+                # 按域名请求频率调度，所有域名都没有令牌时等待
+                task = task_queue.get(timeout=1)
             except queue.Empty as e:
-                time.sleep(0.1)
                 continue
-            tr = task.execute()
-            if tr.sub_tasks:
-                for t in tr.sub_tasks:
-                    app.task_normal_queue.put(t)
-                    logger.info('Add to task queue(normal):{}, {}'.format(t.url, app.task_normal_queue.qsize()))
-
+            # 解析过程中提取的子任务立即加入任务队列
+            try:
+                tr = task.execute(on_sub_task=lambda t: cls.add_task(app, t), defer_retry=True)
+            finally:
+                task_queue.done(task)
+            if tr.retry_after:
+                # 下载失败或者域名熔断，任务延后重新调度，当前线程继续执行其他任务
+                task_queue.put(task, delay=tr.retry_after)
             if tr.data:
                 app.data_queue.put((task, tr.data))
         logger.info('Task 1 thread done !')
 
+    @classmethod
+    def add_task(cls, app, task):
+        app.task_normal_queue.put(task)
+        logger.info('Add to task queue(normal):{}, {}'.format(task.url, app.task_normal_queue.qsize()))
+
     @classmethod
     def run_store(cls, job):
         index, count = 0, 0
@@ -142,9 +150,9 @@ class Job(object):
     def start_all_threads(self):
         self.is_running = True
 
-        self.task_normal_queue = Queue()
+        self.task_normal_queue = Scheduler()
         for url in self._urls:
-            self.task_normal_queue.put(Task(url=url, rule=Rule.find_by_name(self._rule_name)))
+            self.task_normal_queue.put(Task(url=url, rule=RuleRegistry.get(self._rule_name)))
         self.worker_normal_threads = [Thread(target=self.run_worker, args=(self,)) for i in
                                       range(self.normal_thread_count)]
 
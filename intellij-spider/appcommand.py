@@ -17,5 +17,9 @@ def start_app(app_name: str, urls: list, rule_name: str, process_count=3):
         from app_processed import App
         app = App(app_name, urls, rule_name)
         app.schedule(process_count)
+    elif mode == AppMode.ASYNC:
+        from app_async import App
+        app = App(app_name, urls, rule_name)
+        app.schedule()
     else:
         logger.error('Not support mode: %s', mode)
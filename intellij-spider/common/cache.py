@@ -1,5 +1,8 @@
+import os
+import mmap
 import hashlib
 import pathlib
+import tempfile
 import functools
 import datetime
 
@@ -8,6 +11,7 @@ from config import *
 from config import get_app_config
 from common.log import logger
 from common.util import now, take_ms
+from common.content import RawContent
 
 if get_app_config().cache_mode == CacheMode.ELASTICSEARCH:
     from elasticsearch import Elasticsearch
@@ -80,6 +84,62 @@ class EsClient(object):
         return res
 
 
+def get_cache_file(url: str, suffix='') -> pathlib.Path:
+    """
+    获取URL对应的本地缓存文件，缓存目录按日期、域名划分，文件名为URL的MD5值
+    :param url:
+    :param suffix: 缓存文件后缀
+    :return:
+    """
+    cache_dir = pathlib.Path(CACHE_DIR)
+    date = datetime.datetime.now().date().isoformat()
+    if url:
+        items = url.split('/')
+        domain = items[2]
+        cache_dir = cache_dir / date / domain
+
+    if not cache_dir.exists():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+    h = hashlib.md5()
+    h.update(url.encode())
+    return cache_dir / (h.hexdigest() + suffix)
+
+
+# 缓存目录下的URL索引文件，每行为：缓存文件名\tURL，用于离线重放缓存的网页
+CACHE_INDEX_FILE = 'urls.txt'
+
+
+def index_cache_file(cache_file: pathlib.Path, url: str):
+    try:
+        with open(cache_file.parent / CACHE_INDEX_FILE, 'a', encoding='utf8') as fp:
+            fp.write('{}\t{}\n'.format(cache_file.name, url))
+    except OSError as e:
+        logger.error('Write cache index failed, {} {}'.format(cache_file, e))
+
+
+def read_cache_index(cache_dir: pathlib.Path) -> dict:
+    """
+    读取缓存目录的URL索引
+    :param cache_dir:
+    :return: k：缓存文件名，v：URL
+    """
+    index = {}
+    index_file = cache_dir / CACHE_INDEX_FILE
+    if index_file.exists():
+        with open(index_file, encoding='utf8') as fp:
+            for line in fp:
+                name, _, url = line.rstrip('\n').partition('\t')
+                if url:
+                    index[name] = url
+    return index
+
+
+def read_str_cache(cache_file: pathlib.Path) -> str:
+    with open(cache_file, encoding='utf8') as fp:
+        return '\n'.join(fp.readlines())
+
+
 def daily_file_cache_for_str(func):
     """
     装饰器，用于本地文件缓存数据，缓存的key为被装饰函数第一个参数的MD5值。
@@ -90,33 +150,167 @@ def daily_file_cache_for_str(func):
 
     @functools.wraps(func)
     def wrapper(*args, **kwarg):
-        cache_dir = pathlib.Path(CACHE_DIR)
         url = kwarg.get('url').value
-        date = datetime.datetime.now().date().isoformat()
-        if url:
-            items = url.split('/')
-            domain = items[2]
-            cache_dir = cache_dir / date / domain
+        result = read_file_cache(url)
+        if result is None:
+            ok, result = func(*args, **kwarg)
+            if ok:
+                write_file_cache(url, result)
+        return result
+
+    return wrapper
+
+
+def read_file_cache(url: str, raw=False):
+    """
+    读取URL的本地文件缓存
+    :param url:
+    :param raw: 是否读取原始内容缓存RawContent
+    :return: 缓存不存在时返回None
+    """
+    t = now()
+    cache_file = get_cache_file(url, '.raw' if raw else '')
+    if not cache_file.exists():
+        return None
+    if raw:
+        logger.info('Read from raw cache: {}ms, {},{}'.format(take_ms(t), str(cache_file), url))
+        return read_raw_cache(cache_file)
+    logger.info('Read from cache: {}ms, {},{}'.format(take_ms(t), str(cache_file), url))
+    return read_str_cache(cache_file)
+
+
+def write_file_cache(url: str, result, raw=False):
+    """
+    保存URL的本地文件缓存
+    :param url:
+    :param result: 网页内容，字符串或者原始内容RawContent
+    :param raw: 是否保存为原始内容缓存
+    :return:
+    """
+    t = now()
+    cache_file = get_cache_file(url, '.raw' if raw else '')
+    if raw:
+        with open(cache_file, 'wb') as fp:
+            fp.write(result.encoding.encode('ascii') + b'\n')
+            fp.write(result.body)
+            logger.info(
+                'Save to raw cache, takes {}ms, url: {}, file: {}, size: {}'.format(take_ms(t), url, cache_file,
+                                                                                    len(result)))
+    else:
+        with open(cache_file, 'w', encoding='utf8') as fp:
+            fp.write(result)
+            logger.info(
+                'Save to cache, takes {}ms, url: {}, file: {}, size: {}'.format(take_ms(t), url, cache_file,
+                                                                                len(result)))
+    index_cache_file(cache_file, url)
+
+
+# 边下载边写入的原始内容缓存，第一行（网页编码）按固定长度占位，下载完成确定编码后写入
+RAW_HEADER_SIZE = 32
+# 写入中的缓存临时文件后缀，读取缓存目录时跳过
+TMP_SUFFIX = '.tmp'
+
+
+class RawCacheWriter(object):
+    """
+    边下载边写入原始内容缓存：内容先写入临时文件（.tmp），下载完成、确定网页编码并检查内容后替换为缓存文件，
+    下载失败时删除临时文件。每次下载使用唯一的临时文件，同一链接并发下载时互不影响，最后完成的替换缓存文件
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.cache_file = get_cache_file(url, '.raw')
+        self._fp = tempfile.NamedTemporaryFile(mode='w+b', dir=str(self.cache_file.parent),
+                                               prefix=self.cache_file.name + '.', suffix=TMP_SUFFIX, delete=False)
+        self.tmp_file = pathlib.Path(self._fp.name)
+        self.size = 0
+        self._fp.write(b' ' * (RAW_HEADER_SIZE - 1) + b'\n')
+        self._mm = None
 
-        if not cache_dir.exists():
-            cache_dir.mkdir(parents=True, exist_ok=True)
+    def write(self, chunk: bytes):
+        self._fp.write(chunk)
+        self.size += len(chunk)
 
+    def body(self) -> memoryview:
+        """
+        已经写入的内容（内存映射，不复制）
+        :return:
+        """
+        self._fp.flush()
+        if not self.size:
+            return memoryview(b'')
+        if self._mm is None:
+            self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mm)[RAW_HEADER_SIZE:]
+
+    def close(self):
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except BufferError:
+                # 内容仍在使用，由垃圾回收释放
+                pass
+            self._mm = None
+        self._fp.close()
+
+    def commit(self, encoding: str) -> RawContent:
+        """
+        写入网页编码，替换为缓存文件
+        :param encoding:
+        :return: 缓存内容
+        """
         t = now()
-        h = hashlib.md5()
-        h.update(url.encode())
-        cache_file = cache_dir / h.hexdigest()
-        if not cache_file.exists():
+        header = encoding.encode('ascii')
+        self._fp.seek(0)
+        self._fp.write(header + b' ' * (RAW_HEADER_SIZE - 1 - len(header)))
+        self.close()
+        os.replace(str(self.tmp_file), str(self.cache_file))
+        index_cache_file(self.cache_file, self.url)
+        logger.info('Save to raw cache (streamed), takes {}ms, url: {}, file: {}, size: {}'.format(
+            take_ms(t), self.url, self.cache_file, self.size))
+        return read_raw_cache(self.cache_file)
+
+    def abort(self):
+        self.close()
+        try:
+            os.remove(str(self.tmp_file))
+        except OSError as e:
+            logger.error('Remove cache file failed, {} {}'.format(self.tmp_file, e))
+
+
+def read_raw_cache(cache_file: pathlib.Path) -> RawContent:
+    """
+    读取原始内容缓存文件，第一行为网页编码，之后为网页内容，
+    网页内容使用内存映射，不解码也不复制
+    :param cache_file:
+    :return:
+    """
+    with open(cache_file, 'rb') as fp:
+        encoding = fp.readline().strip().decode('ascii')
+        offset = fp.tell()
+        if os.fstat(fp.fileno()).st_size <= offset:
+            return RawContent(b'', encoding)
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    return RawContent(memoryview(mm)[offset:], encoding)
+
+
+def daily_file_cache_for_bytes(func):
+    """
+    装饰器，用于本地文件缓存原始网页内容RawContent（未解码），缓存文件第一行为网页编码。
+    暂不支持缓存失效，可以手动删除使缓存失效
+    :param func:
+    :return:
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwarg):
+        url = kwarg.get('url').value
+        result = read_file_cache(url, raw=True)
+        if result is None:
             ok, result = func(*args, **kwarg)
-            if ok:
-                with open(cache_file, 'w', encoding='utf8') as fp:
-                    fp.write(result)
-                    logger.info(
-                        'Save to cache, takes {}ms, url: {}, file: {}, size: {}'.format(take_ms(t), url, cache_file,
-                                                                                        len(result)))
-        else:
-            logger.info('Read from cache: {}ms, {},{}'.format(take_ms(t), str(cache_file), url))
-            with open(cache_file, encoding='utf8') as fp:
-                result = '\n'.join(fp.readlines())
+            # 下载时已经直接写入缓存（RawCacheWriter）的内容不再保存
+            if ok and not is_cached(url, raw=True):
+                write_file_cache(url, result, raw=True)
         return result
 
     return wrapper
@@ -153,7 +347,41 @@ def daily_es_cache_for_str(func):
     return wrapper
 
 
+def read_cache(url: str, raw=False):
+    """
+    按缓存配置读取URL的缓存（不使用装饰器的下载方式，例如异步下载），原始内容只支持本地文件缓存
+    :param url:
+    :param raw: 是否读取原始内容缓存RawContent
+    :return: 缓存不存在时返回None
+    """
+    if raw or get_app_config().cache_mode == CacheMode.LOCAL_FILE:
+        return read_file_cache(url, raw)
+    es = EsClient.instance()
+    return es.get(url) if es.exists(url) else None
+
+
+def is_cached(url: str, raw=False) -> bool:
+    """
+    URL是否已经有本地文件缓存（ES缓存不检查）
+    :param url:
+    :param raw:
+    :return:
+    """
+    if not raw and get_app_config().cache_mode != CacheMode.LOCAL_FILE:
+        return False
+    return get_cache_file(url, '.raw' if raw else '').exists()
+
+
+def write_cache(url: str, result, raw=False):
+    if raw or get_app_config().cache_mode == CacheMode.LOCAL_FILE:
+        write_file_cache(url, result, raw)
+    else:
+        EsClient.instance().save(url, result)
+
+
 daily_cache = daily_file_cache_for_str if get_app_config().cache_mode == CacheMode.LOCAL_FILE else daily_es_cache_for_str
+# 原始内容（按字节解析）只支持本地文件缓存
+daily_raw_cache = daily_file_cache_for_bytes
 
 if __name__ == '__main__':
     es = EsClient()
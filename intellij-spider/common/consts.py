@@ -14,6 +14,14 @@ class Keys(Enum):
     # 正则表达式
     REGEX = 'regex'
 
+    # 选择器，与正则表达式二选一，支持CSS和XPath常用子集，例如：'div.title::text', '//a[@class="next"]/@href'
+    # 同一个网页只解析为HTML树一次，所有选择器节点共享，子节点在匹配元素的子树上继续选择
+    SELECTOR = 'selector'
+
+    # JSON路径，用于解析接口返回的JSON，例如：'$.data.items[*].title'
+    # 同一个接口响应只解析JSON一次，所有JSON路径节点共享，子节点在匹配的值上继续查找
+    JSON_PATH = 'json_path'
+
     # 匹配模式，'0'：第一个匹配（缺省） '1':所有匹配
     SEARCH_MODE = 'search_mode'
 
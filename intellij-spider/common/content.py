@@ -0,0 +1,46 @@
+class RawContent(object):
+    """
+    原始网页内容（未解码的bytes或者内存映射的缓存文件），和网页编码一起传递，
+    解析时按字节匹配，只对匹配到的内容解码
+    """
+
+    def __init__(self, body, encoding: str):
+        """
+        :param body: 网页内容，bytes/bytearray/memoryview/mmap
+        :param encoding: 网页编码
+        """
+        self._body = body
+        self._encoding = encoding or 'utf8'
+        self._text = None
+
+    @property
+    def body(self):
+        return self._body
+
+    @property
+    def encoding(self):
+        return self._encoding
+
+    def decode(self, data) -> str:
+        """
+        按网页编码解码部分内容
+        :param data:
+        :return:
+        """
+        return data.decode(self._encoding, errors='replace') if data is not None else None
+
+    @property
+    def text(self) -> str:
+        """
+        解码整个网页，只在无法按字节匹配时使用，解码结果会被缓存
+        :return:
+        """
+        if self._text is None:
+            self._text = str(self._body, self._encoding, errors='replace')
+        return self._text
+
+    def __len__(self):
+        return len(self._body)
+
+    def __str__(self) -> str:
+        return self.text
@@ -0,0 +1,155 @@
+import re
+
+# 域名规则：由'.'分隔的多段字母、数字、'-'组成（正则中的'.'可以转义），例如jd.com、sg\.vegnet\.com\.cn，
+# 只匹配URL的origin（scheme://host:port）；带有锚点、路径、参数或者只有一段的规则匹配完整URL
+HOST_PATTERN = re.compile(r'[A-Za-z0-9-]+(?:\\?\.[A-Za-z0-9-]+)+')
+# 最后一段是这些后缀时更可能是文件名（例如list\.html），不作为域名规则
+FILE_SUFFIXES = {'htm', 'html', 'shtml', 'xhtml', 'php', 'asp', 'aspx', 'jsp', 'do', 'action', 'cgi',
+                 'json', 'xml', 'txt', 'js', 'css', 'jpg', 'jpeg', 'png', 'gif', 'pdf'}
+# 缓存的origin个数上限，超过后清空
+MAX_CACHED_ORIGINS = 10000
+
+
+def get_origin(url: str) -> str:
+    """
+    URL的origin部分，例如：https://www.jd.com/item/1.html -> https://www.jd.com
+    :param url:
+    :return:
+    """
+    return '/'.join(url.split('/', 3)[:3])
+
+
+def is_host_pattern(pattern: str) -> bool:
+    """
+    规则是否是域名规则（只匹配origin）
+    :param pattern: 正则表达式或子字符串
+    :return:
+    """
+    if not HOST_PATTERN.fullmatch(pattern):
+        return False
+    return pattern.rsplit('.', 1)[-1].lower() not in FILE_SUFFIXES
+
+
+class UrlRule(object):
+    def __init__(self, pattern: str, value, literal=False):
+        """
+        :param pattern: 正则表达式，literal为True时为子字符串
+        :param value: 规则对应的配置
+        :param literal: 是否按子字符串匹配
+        """
+        self.pattern = pattern
+        self.value = value
+        self.regex = re.compile(re.escape(pattern) if literal else pattern)
+        # 域名规则只匹配origin，匹配结果按origin缓存
+        self.origin_only = is_host_pattern(pattern)
+
+    def match(self, s: str) -> bool:
+        return self.regex.search(s) is not None
+
+
+class UrlRules(object):
+    """
+    按URL匹配的规则列表（正则预先编译），按添加顺序匹配：
+    域名规则（例如jd.com，见is_host_pattern）只匹配URL的origin，每个origin的匹配结果只计算一次；
+    其他规则匹配完整URL，每次查询时匹配
+    """
+
+    def __init__(self, literal=False):
+        """
+        :param literal: 规则是否按子字符串匹配（不是正则表达式）
+        """
+        self._literal = literal
+        self._rules = []
+        # k：origin，v：(候选规则列表, 是否以匹配的域名规则结束)
+        self._origins = {}
+
+    def add(self, pattern: str, value, replace=False):
+        """
+        添加规则
+        :param pattern:
+        :param value:
+        :param replace: 相同的规则已经存在时替换配置（保持原来的顺序），否则追加
+        :return:
+        """
+        rule = UrlRule(pattern, value, self._literal)
+        index = next((i for i, r in enumerate(self._rules) if r.pattern == pattern), None) if replace else None
+        if index is None:
+            self._rules.append(rule)
+        else:
+            self._rules[index] = rule
+        self._origins = {}
+        return self
+
+    def get_candidates(self, url: str) -> list:
+        """
+        可能匹配URL的规则：匹配origin的域名规则，以及所有匹配完整URL的规则（保持添加顺序）
+        :param url:
+        :return:
+        """
+        origin = get_origin(url)
+        candidates = self._origins.get(origin)
+        if candidates is None:
+            candidates = [r for r in self._rules if not r.origin_only or r.match(origin)]
+            if len(self._origins) >= MAX_CACHED_ORIGINS:
+                self._origins = {}
+            self._origins[origin] = candidates
+        return candidates
+
+    def first(self, url: str, default=None):
+        """
+        :param url:
+        :param default:
+        :return: 第一个匹配的规则对应的配置，没有匹配的规则时返回default
+        """
+        for rule in self.get_candidates(url):
+            if rule.origin_only or rule.match(url):
+                return rule.value
+        return default
+
+    def all(self, url: str) -> list:
+        """
+        :param url:
+        :return: 所有匹配的规则对应的配置
+        """
+        return [rule.value for rule in self.get_candidates(url) if rule.origin_only or rule.match(url)]
+
+    def clear(self):
+        self._rules = []
+        self._origins = {}
+
+    def __iter__(self):
+        return iter((rule.pattern, rule.value) for rule in self._rules)
+
+    def __len__(self):
+        return len(self._rules)
+
+    def __str__(self) -> str:
+        return str([(rule.pattern, str(rule.value)) for rule in self._rules])
+
+
+def test_url_rules():
+    assert is_host_pattern('jd.com') and is_host_pattern(r'sg\.vegnet\.com\.cn') and is_host_pattern('127.0.0.1')
+    for pattern in [r'\.html$', 'page=', r'list\.html', 'list.html', 'item', 'jd.com/item', r'^https://jd\.com', '.*']:
+        assert not is_host_pattern(pattern), pattern
+
+    rules = UrlRules()
+    rules.add(r'\.html$', 'html').add('page=', 'page').add(r'list\.html', 'list').add('item', 'item')
+    rules.add(r'jd\.com', 'jd').add('jd.com/list', 'jd-list')
+    assert rules.first('https://www.tmall.com/a/1.html') == 'html'
+    assert rules.first('https://www.tmall.com/a?page=2') == 'page'
+    assert rules.all('https://www.tmall.com/list.html?page=2') == ['page', 'list']
+    assert rules.all('https://www.jd.com/item/1') == ['item', 'jd']
+    # 同一origin的不同链接，域名规则使用缓存的匹配结果，其他规则每次匹配
+    assert rules.all('https://www.jd.com/list/1.html') == ['html', 'jd', 'jd-list']
+    assert rules.all('https://www.jd.com/') == ['jd']
+    # 域名规则只匹配origin
+    assert rules.first('https://www.tmall.com/?from=jd.com', 'none') == 'none'
+
+    literal_rules = UrlRules(literal=True)
+    literal_rules.add('vegnet.com.cn', 1).add('list.html', 2).add('a.b', 3)
+    assert literal_rules.all('http://sg.vegnet.com.cn/list.html') == [1, 2]
+    assert literal_rules.first('http://aXb.com/') is None
+
+
+if __name__ == '__main__':
+    test_url_rules()
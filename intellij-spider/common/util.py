@@ -4,6 +4,7 @@ import json
 from common.log import logger
 import sys
 import pathlib
+import pkgutil
 
 entry_path = pathlib.Path(sys.argv[0])
 if entry_path.parent.parent.name != 'apps':
@@ -22,16 +23,32 @@ def get_rule(name):
     return rule_data
 
 
+def get_rule_names():
+    """
+    列出当前应用模板目录（apps/<app>/templates/）下的所有模板名称
+    :return:
+    """
+    names = []
+    if template_path == '.':
+        return names
+    try:
+        package = __import__(template_path.rstrip('.'), fromlist=[''])
+        names = [name for _, name, is_pkg in pkgutil.iter_modules(package.__path__) if not is_pkg]
+    except ImportError as e:
+        logger.error('Cannot list rules in {}, {}'.format(template_path, e))
+    return names
+
+
 def test(url, rule_name):
     from task import Task
-    from rule.rule import Rule
+    from rule.registry import RuleRegistry
     import pprint
 
     from config import app_config, CacheMode
     app_config.cache_mode = CacheMode.LOCAL_FILE
 
     printer = pprint.PrettyPrinter(indent=2)
-    task = Task(url=url, rule=Rule.find_by_name(rule_name))
+    task = Task(url=url, rule=RuleRegistry.get(rule_name))
     tr = task.execute()
     print('-------------------- 测试结果 --------------------')
     print(tr.data)
@@ -1,13 +1,20 @@
 import os
 import re
+import random
 from common.util import today_str
 from common.log import logger
+from common.content import RawContent
+from common.urlrules import UrlRules
+from network.proxypool import ProxyPool
 
 IS_WINDOWS = (os.name == 'nt')
 
 # request interval (unit/seconds)
 REQUEST_INTERVAL = 0
 
+# max response body size (unit/bytes)
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
 # Cache
 CACHE_DIR = 'c:/cache/' if IS_WINDOWS else '/home/wxc/cache/'
 
@@ -35,20 +42,31 @@ class Proxies(object):
 
 
 class ProxyMapping(object):
+    """
+    按URL（正则匹配）配置的代理，每个URL规则对应一个代理池（ProxyPool），每个请求从代理池按健康分数选择代理
+    """
+
     def __init__(self):
-        self._url_proxies = []
+        self._url_proxies = UrlRules()
+
+    def get_url_pool(self, url: str) -> ProxyPool:
+        return self._url_proxies.first(url)
 
     def get_url_proxy(self, url: str) -> dict:
-        proxy = None
-        for item in self._url_proxies:
-            result = re.search(item[0], url)
-            if result:
-                proxy = item[1]
-                break
-        return proxy
-
-    def add_url_proxy(self, url_pattern: str, proxy: dict):
-        self._url_proxies.append((url_pattern, proxy))
+        pool = self.get_url_pool(url)
+        return pool.choose() if pool else None
+
+    def add_url_proxy(self, url_pattern: str, proxy: (dict, list, ProxyPool)):
+        """
+        :param url_pattern:
+        :param proxy: 单个代理、代理列表或者代理池
+        :return:
+        """
+        if isinstance(proxy, dict):
+            proxy = ProxyPool([proxy])
+        elif isinstance(proxy, list):
+            proxy = ProxyPool(proxy)
+        self._url_proxies.add(url_pattern, proxy)
         return self
 
     @classmethod
@@ -60,32 +78,123 @@ class ProxyMapping(object):
         return ProxyMapping().add_url_proxy('.*', Proxies.ADSL_LOW)
 
     def clear(self):
-        self._url_proxies = []
+        self._url_proxies.clear()
+
+    def __str__(self) -> str:
+        return str(self._url_proxies)
+
+
+class RateLimitMapping(object):
+    """
+    按URL（正则匹配）配置的请求频率：同一个域名两次请求的最小间隔（秒）和允许的突发请求数，
+    没有匹配的URL使用REQUEST_INTERVAL
+    """
+
+    def __init__(self):
+        self._url_rates = UrlRules()
+
+    def get_url_rate(self, url: str) -> tuple:
+        """
+        :param url:
+        :return: (请求间隔, 突发请求数)
+        """
+        return self._url_rates.first(url, (REQUEST_INTERVAL, 1))
+
+    def add_url_rate(self, url_pattern: str, interval: float, burst=1):
+        self._url_rates.add(url_pattern, (interval, max(burst, 1)))
+        return self
+
+    def clear(self):
+        self._url_rates.clear()
+
+    def __str__(self) -> str:
+        return str(self._url_rates)
+
+
+class BodySizeMapping(object):
+    """
+    按URL（正则匹配）配置的响应内容大小上限（字节），超过上限时中止下载，没有匹配的URL使用MAX_BODY_SIZE
+    """
+
+    def __init__(self):
+        self._url_sizes = UrlRules()
+
+    def get_url_size(self, url: str) -> int:
+        return self._url_sizes.first(url, MAX_BODY_SIZE)
+
+    def add_url_size(self, url_pattern: str, size: int):
+        self._url_sizes.add(url_pattern, size)
+        return self
+
+    def clear(self):
+        self._url_sizes.clear()
+
+    def __str__(self) -> str:
+        return str(self._url_sizes)
+
+
+class RetryPolicy(object):
+    """
+    下载失败重试策略：重试间隔按指数增长（加随机抖动，避免大量任务同时重试），
+    每个域名的重试次数不超过正常请求数的一定比例（重试预算），域名不可用时不会产生大量重试请求
+    """
+
+    def __init__(self, max_retries=10, base_delay=0.5, block_delay=4, max_delay=60, multiplier=2, jitter=0.5,
+                 budget_ratio=0.2, min_budget=10):
+        """
+        :param max_retries: 每个任务的最大请求次数
+        :param base_delay: 请求失败（异常、错误状态码）后的初始重试间隔（秒）
+        :param block_delay: 被反扒（FailureCondition）后的初始重试间隔（秒），等待代理地址切换
+        :param max_delay: 最大重试间隔（秒）
+        :param multiplier: 重试间隔的增长倍数
+        :param jitter: 随机抖动比例，重试间隔在[(1 - jitter) * 间隔, 间隔]之间
+        :param budget_ratio: 每个请求为所在域名增加的重试预算，即重试请求数与正常请求数的最大比例
+        :param min_budget: 每个域名的初始重试预算（请求数较少时也可以重试）
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.block_delay = block_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.budget_ratio = budget_ratio
+        self.min_budget = min_budget
+
+    def get_delay(self, attempt: int, blocked=False) -> float:
+        """
+        第attempt次请求失败后的重试间隔
+        :param attempt: 从0开始
+        :param blocked: 是否被反扒
+        :return:
+        """
+        base = self.block_delay if blocked else self.base_delay
+        delay = min(base * self.multiplier ** attempt, self.max_delay)
+        return delay * (1 - self.jitter * random.random())
+
+    def __str__(self) -> str:
+        return str(self.__dict__)
 
 
 class RefererConfig(object):
     def __init__(self):
-        self._url_referer = {}
+        self._url_referer = UrlRules()
 
-    def get_url_referer(self, url: str) -> str:
-        referer_rule = None
-        for url_pattern, value in self._url_referer.items():
-            result = re.search(url_pattern, url)
-            if result:
-                referer_rule = value
-                break
-        return referer_rule
+    def get_url_referer(self, url: str) -> dict:
+        return self._url_referer.first(url)
 
     def add_url_referer(self, url_pattern: str, host=None, use_parent_link=False):
-        self._url_referer[url_pattern] = {'host': host, 'use_parent_link': use_parent_link}
+        self._url_referer.add(url_pattern, {'host': host, 'use_parent_link': use_parent_link}, replace=True)
         return self
 
     def clear(self):
-        self._url_referer = {}
+        self._url_referer.clear()
+
+    def __str__(self) -> str:
+        return str(self._url_referer)
 
 
 class FailureCondition(object):
-    def __init__(self, failure_map: dict = None):
+    def __init__(self, failure_map: dict = None, head_size=0, tail_size=0):
         """
         初始化下载失败场景
         :param failure_map: 失败场景映射表，
@@ -93,38 +202,103 @@ class FailureCondition(object):
             'tamall.com': ['下载失败', '请求过于频繁'],
             'www.jd.com': '"error_code":-1'
         }
+        :param head_size: 只检查网页开头的字符数（原始内容为字节数），反扒页面的特征一般在开头或者结尾
+        :param tail_size: 只检查网页结尾的字符数，head_size和tail_size都为0时检查整个网页
         """
         self._failure_map = failure_map if failure_map is not None else {}
+        self._head_size = head_size
+        self._tail_size = tail_size
+        # 失败场景按子字符串匹配URL
+        self._url_failures = UrlRules(literal=True)
+        for k, v in self._failure_map.items():
+            self._url_failures.add(k, [v] if isinstance(v, str) else list(v))
+        # k：(失败特征, 编码)，v：(编译后的正则, 匹配内容 -> 失败特征)
+        self._matchers = {}
 
     def get_failure_str_list(self, url):
-        ret = []
-        for k, v in self._failure_map.items():
-            if k in url:
-                ret.append(v) if isinstance(v, str) else ret.extend(v)
-        return ret
+        return [item for items in self._url_failures.all(url) for item in items]
+
+    def get_matcher(self, failure_list: list, encoding=None) -> tuple:
+        """
+        同一URL的所有失败特征编译为一个正则（子字符串的选择），一次扫描匹配所有特征，
+        空特征和网页编码无法表示的特征跳过（否则匹配所有网页）
+        :param failure_list:
+        :param encoding: 原始内容的网页编码，为空时按字符串匹配
+        :return: (编译后的正则, 匹配内容 -> 失败特征)，没有可以匹配的特征时返回None
+        """
+        key = (tuple(failure_list), encoding)
+        if key in self._matchers:
+            return self._matchers[key]
+        items = {}
+        for failure_item in failure_list:
+            try:
+                pattern = failure_item.encode(encoding) if encoding else failure_item
+            except UnicodeEncodeError:
+                logger.warn('Fail condition can not be encoded with {}, skip: {}'.format(encoding, failure_item))
+                continue
+            if pattern:
+                items.setdefault(pattern, failure_item)
+        matcher = None
+        if items:
+            # 较长的特征在前，同一位置优先匹配较长的特征
+            patterns = sorted(items, key=len, reverse=True)
+            matcher = (re.compile((b'|' if encoding else '|').join(map(re.escape, patterns))), items)
+        self._matchers[key] = matcher
+        return matcher
+
+    def get_ranges(self, size: int) -> list:
+        """
+        需要检查的内容范围
+        :param size: 网页长度
+        :return: [(开始位置, 结束位置)]
+        """
+        head, tail = self._head_size, self._tail_size
+        if not (head or tail) or size <= head + tail:
+            return [(0, size)]
+        return [r for r in ((0, head), (size - tail, size)) if r[0] < r[1]]
 
-    def test(self, url, content):
+    def test(self, url, content, failure_list=None):
         """
         根据配置（反扒响应条件）检查是否是期望的内容（如果URL被反扒，响应内容返回错误的信息）
         检查通过，则URL内容正确；检查失败，说明该请求被反扒.
         :param url:
-        :param content:
+        :param content: 网页内容，字符串或者原始内容RawContent
+        :param failure_list: URL的失败特征（UrlPolicy.failures），为空时按URL查询
         :return:
         """
-        ret = True
-        failure_list = self.get_failure_str_list(url)
-        if failure_list:
-            for failure_item in failure_list:
-                if failure_item in content:
-                    logger.warn('Wrong response content, fail condition: %s', failure_item)
-                    ret = False
-                    break
-        return ret
+        if failure_list is None:
+            failure_list = self.get_failure_str_list(url)
+        if not failure_list:
+            return True
+        is_raw = isinstance(content, RawContent)
+        # 原始内容按网页编码匹配失败特征，直接扫描内存映射的缓存内容，不复制
+        data = content.body if is_raw else content
+        matcher = self.get_matcher(failure_list, content.encoding if is_raw else None)
+        if matcher is None:
+            return True
+        regex, items = matcher
+        for pos, endpos in self.get_ranges(len(data)):
+            m = regex.search(data, pos, endpos)
+            if m:
+                logger.warn('Wrong response content, fail condition: %s', items[m.group(0)])
+                return False
+        return True
 
     def __str__(self) -> str:
         return str(self._failure_map)
 
 
+class UrlPolicy(object):
+    """
+    URL的抓取策略：代理池、Referer规则和失败特征，由Configuration.get_url_policy查询
+    """
+
+    def __init__(self, proxy_pool: ProxyPool, referer: dict, failures: list):
+        self.proxy_pool = proxy_pool
+        self.referer = referer
+        self.failures = failures
+
+
 class AppMode(object):
     MULTI_THREAD = 'multi-thread'
     THREAD_POOL = 'thread-pool'
@@ -144,21 +318,92 @@ class Configuration(object):
         self.use_session = use_session
         self.fail_conditions = FailureCondition()
         self.referer_config = RefererConfig()
+        self.rate_limit_mapping = RateLimitMapping()
+        self.retry_policy = RetryPolicy()
+        self.body_size_mapping = BodySizeMapping()
 
         self.no_save = False
         self.app_name = 'default'
         self.app_start_date = today_str()
         self.cache_mode = CacheMode.LOCAL_FILE
         self.app_mode = AppMode.MULTI_THREAD
+        # 同级解析节点合并为一次正则扫描
+        self.combined_scan = False
+        # 下载原始内容（不解码），按字节解析，只解码匹配到的内容
+        self.raw_content = False
+        # 每个顶层解析节点（包括子节点）正则匹配的时间预算（秒），超时后该节点按解析失败处理，0表示不限制；
+        # 开启时需要安装regex模块（中断单次匹配的回溯）
+        self.regex_timeout = 0
+        # "匹配第一个"节点的备选正则项按历史命中率排序后尝试
+        self.adaptive_regex_order = False
+        # 正则项命中统计文件（adaptive_regex_order开启时统计），为空时不保存
+        self.regex_stats_file = os.path.join(CACHE_DIR, 'regex_stats.json')
+        # 每个域名（代理）保持的最大连接数，所有工作线程共享
+        self.max_connections_per_host = 10
+        # 连接池保留的域名（代理）个数
+        self.max_pooled_hosts = 100
+        # 按域名的延迟和反扒信号自适应调整并发请求数（不超过max_connections_per_host）
+        self.adaptive_concurrency = True
+        # 每个域名的初始并发请求数
+        self.initial_host_concurrency = 2
+        # 请求的连接超时和读取超时（秒），按域名的延迟自动缩短（HostTimeout），不超过该值
+        self.connect_timeout = 10
+        self.read_timeout = 60
+        # 每个任务下载的总时间（秒，包括所有重试和跳转），超时后任务延后重新执行，0表示不限制
+        self.task_deadline = 300
+        # 域名连续请求失败达到该次数后熔断（不再请求，任务延后执行），0表示不熔断
+        self.circuit_failure_threshold = 10
+        # 熔断时间（秒），熔断后的试探请求失败时加倍，不超过circuit_max_open_seconds
+        self.circuit_open_seconds = 30
+        self.circuit_max_open_seconds = 600
+        # 域名解析结果的缓存时间（秒），所有工作线程共享（DnsCache），0表示不缓存
+        self.dns_cache_ttl = 300
+        # 域名解析失败的缓存时间（秒）
+        self.dns_negative_ttl = 30
+        # 应用启动时预解析入口链接的域名
+        self.dns_prefetch = True
+        # 异步模式（AppMode.ASYNC）同时下载的任务数
+        self.async_concurrency = 1000
+        # 异步模式的解析线程数
+        self.parse_thread_count = 4
+
+    def get_url_policy(self, url: str) -> UrlPolicy:
+        """
+        查询URL的代理池、Referer规则和失败特征，域名规则的匹配结果按origin缓存（UrlRules）
+        :param url:
+        :return:
+        """
+        return UrlPolicy(self.proxy_mapping.get_url_pool(url), self.referer_config.get_url_referer(url),
+                         self.fail_conditions.get_failure_str_list(url))
 
     def __str__(self) -> str:
         return {
             'proxy_mapping': str(self.proxy_mapping),
             'use_session': self.use_session,
             'fail_conditions': str(self.fail_conditions),
-            'referer_config': self.referer_config,
+            'referer_config': str(self.referer_config),
+            'rate_limit_mapping': str(self.rate_limit_mapping),
+            'retry_policy': str(self.retry_policy),
+            'body_size_mapping': str(self.body_size_mapping),
             'cache_mode': self.cache_mode,
-            'app_mode': self.app_mode
+            'app_mode': self.app_mode,
+            'combined_scan': self.combined_scan,
+            'raw_content': self.raw_content,
+            'regex_timeout': self.regex_timeout,
+            'adaptive_regex_order': self.adaptive_regex_order,
+            'regex_stats_file': self.regex_stats_file,
+            'max_connections_per_host': self.max_connections_per_host,
+            'adaptive_concurrency': self.adaptive_concurrency,
+            'initial_host_concurrency': self.initial_host_concurrency,
+            'connect_timeout': self.connect_timeout,
+            'read_timeout': self.read_timeout,
+            'task_deadline': self.task_deadline,
+            'circuit_failure_threshold': self.circuit_failure_threshold,
+            'circuit_open_seconds': self.circuit_open_seconds,
+            'dns_cache_ttl': self.dns_cache_ttl,
+            'dns_negative_ttl': self.dns_negative_ttl,
+            'dns_prefetch': self.dns_prefetch,
+            'async_concurrency': self.async_concurrency
         }.__str__()
 
 
@@ -172,3 +417,33 @@ def get_app_config():
 def set_app_config(config):
     global app_config
     app_config = config
+
+
+def test_failure_condition():
+    url = 'http://www.test.com/item/1.html'
+    condition = FailureCondition({'test.com': ['下载失败', '', 'error_code'], 'item': 'error_code:-1'})
+    assert condition.test(url, 'ok')
+    assert not condition.test(url, 'abc 下载失败 abc')
+    assert not condition.test(url, '{"error_code":-1}')
+    assert condition.test('http://www.other.com/', 'error_code')
+
+    # 网页编码无法表示的特征跳过，空特征不能匹配所有网页
+    page = 'normal page éàü'
+    assert condition.test(url, RawContent(page.encode('latin-1'), 'latin-1'))
+    assert not condition.test(url, RawContent((page + ' error_code').encode('latin-1'), 'latin-1'))
+    assert not condition.test(url, RawContent((page + ' 下载失败').encode('gbk'), 'gbk'))
+    only_chinese = FailureCondition({'test.com': ['下载失败', '']})
+    assert only_chinese.get_matcher(['下载失败', ''], 'latin-1') is None
+    assert only_chinese.test(url, RawContent(page.encode('latin-1'), 'latin-1'))
+    assert only_chinese.test(url, '')
+
+    # 只检查开头和结尾
+    ranged = FailureCondition({'test.com': '下载失败'}, head_size=10, tail_size=10)
+    assert not ranged.test(url, '下载失败' + 'x' * 100)
+    assert not ranged.test(url, 'x' * 100 + '下载失败')
+    assert ranged.test(url, 'x' * 50 + '下载失败' + 'x' * 50)
+    assert not ranged.test(url, RawContent(('x' * 100 + '下载失败').encode('gbk'), 'gbk'))
+
+
+if __name__ == '__main__':
+    test_failure_condition()
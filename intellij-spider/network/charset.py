@@ -0,0 +1,126 @@
+import re
+import codecs
+import threading
+
+from requests.compat import chardet
+
+from common.log import logger
+from network.hoststats import get_host
+
+# 查找<meta charset>的网页头部长度
+META_SCAN_SIZE = 4096
+# 统计检测（chardet）使用的网页头部长度
+DETECT_SIZE = 64 * 1024
+
+# BOM -> 编码，UTF-32的BOM以UTF-16的BOM开头，先检查
+BOMS = (
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF32_LE, 'utf-32-le'),
+    (codecs.BOM_UTF32_BE, 'utf-32-be'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+)
+
+CHARSET_PATTERN = re.compile(r'charset\s*=\s*["\']?\s*([\w.:-]+)', re.I)
+META_PATTERN = re.compile(rb'<meta[^>]+?charset\s*=\s*["\']?\s*([\w.:-]+)', re.I)
+NON_ASCII_PATTERN = re.compile(rb'[\x80-\xff]')
+
+# 服务端经常错误声明（或者默认）的编码，不作为最终结果，继续检查网页内容
+WEAK_CHARSETS = ('iso8859-1', 'ascii')
+# 编码的超集，GB2312网页经常包含GBK字符
+SUPERSETS = {'gb2312': 'gbk'}
+
+
+def normalize(name):
+    """
+    统一编码名称
+    :param name:
+    :return: 不支持的编码返回None
+    """
+    if not name:
+        return None
+    try:
+        name = codecs.lookup(name.strip()).name
+    except LookupError:
+        return None
+    return SUPERSETS.get(name, name)
+
+
+class Charset(object):
+    """
+    网页编码检测，按以下顺序，找到即返回：
+    1. 响应头Content-Type声明的编码（ISO-8859-1等经常错误声明的编码除外）
+    2. BOM
+    3. 网页头部的<meta charset>或者<meta http-equiv="Content-Type">
+    4. 同一域名之前检测的编码
+    5. 网页头部能否按UTF-8解码，最后使用统计检测（chardet），只检测网页头部
+    第5步的检测结果按域名缓存，同一域名后续没有声明编码的网页不再检测
+    """
+    _lock = threading.Lock()
+    # k：域名，v：编码
+    _hosts = {}
+
+    @classmethod
+    def from_header(cls, content_type: str):
+        m = CHARSET_PATTERN.search(content_type) if content_type else None
+        return normalize(m.group(1)) if m else None
+
+    @classmethod
+    def from_bom(cls, head: bytes):
+        for bom, name in BOMS:
+            if head.startswith(bom):
+                return name
+        return None
+
+    @classmethod
+    def from_meta(cls, head: bytes):
+        m = META_PATTERN.search(head[:META_SCAN_SIZE])
+        return normalize(m.group(1).decode('ascii', errors='ignore')) if m else None
+
+    @classmethod
+    def from_content(cls, head: bytes):
+        try:
+            head.decode('utf-8')
+            return 'utf-8'
+        except UnicodeDecodeError as e:
+            # 截断位置在多字节字符中间
+            if e.start >= len(head) - 3 and e.reason == 'unexpected end of data':
+                return 'utf-8'
+        return normalize(chardet.detect(head)['encoding']) or 'utf-8'
+
+    @classmethod
+    def detect(cls, url: str, headers, content) -> str:
+        """
+        检测网页编码
+        :param url:
+        :param headers: 响应头
+        :param content: 网页内容，bytes或者memoryview
+        :return: 编码名称（Python codec名称）
+        """
+        declared = cls.from_header(headers.get('content-type', ''))
+        if declared and declared not in WEAK_CHARSETS:
+            return declared
+
+        head = bytes(content[:DETECT_SIZE])
+        encoding = cls.from_bom(head) or cls.from_meta(head)
+        if encoding:
+            return encoding
+
+        host = get_host(url)
+        encoding = cls._hosts.get(host)
+        if encoding:
+            return encoding
+        # 只有ASCII字符时无法判断，不缓存
+        if not NON_ASCII_PATTERN.search(head):
+            return 'utf-8'
+
+        encoding = cls.from_content(head)
+        with cls._lock:
+            cls._hosts[host] = encoding
+        logger.info('Detect charset of {}: {}, declared: {}'.format(host, encoding, declared))
+        return encoding
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._hosts = {}
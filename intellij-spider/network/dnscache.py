@@ -0,0 +1,167 @@
+import time
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from config import get_app_config
+from common.log import logger
+
+try:
+    # 与urllib3建立连接时的地址族一致，预解析的结果才能被使用
+    from urllib3.util.connection import allowed_gai_family
+except ImportError:
+    def allowed_gai_family():
+        return socket.AF_UNSPEC
+
+# 缓存的解析结果个数上限，超过后清空
+MAX_ENTRIES = 10000
+# 预解析的最大线程数
+PREFETCH_THREADS = 16
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class DnsEntry(object):
+    def __init__(self, result, error, expires: float):
+        """
+        :param result: getaddrinfo的结果
+        :param error: 解析失败的异常（负缓存），为空表示解析成功
+        :param expires: 过期时间（time.time()）
+        """
+        self.result = result
+        self.error = error
+        self.expires = expires
+
+
+class DnsCache(object):
+    """
+    进程内的域名解析缓存，所有工作线程共享。替换socket.getaddrinfo，requests（urllib3）和aiohttp建立连接时都使用该缓存：
+    解析结果缓存dns_cache_ttl秒，解析失败缓存dns_negative_ttl秒（期间直接抛出异常，不再请求DNS）；
+    解析失败时如果有过期的结果，继续使用过期的结果；同一域名同时只有一个线程解析，其他线程等待解析结果。
+    系统解析接口不返回记录的TTL，缓存时间使用配置值
+    """
+    _lock = threading.Lock()
+    # k：getaddrinfo参数，v：DnsEntry
+    _entries = {}
+    # k：getaddrinfo参数，v：threading.Event，正在解析的域名
+    _pending = {}
+    # 原始的socket.getaddrinfo，为空表示没有安装
+    _getaddrinfo = None
+
+    @classmethod
+    def install(cls):
+        """
+        替换socket.getaddrinfo，多次调用只安装一次
+        :return:
+        """
+        with cls._lock:
+            if cls._getaddrinfo is None:
+                cls._getaddrinfo = socket.getaddrinfo
+                socket.getaddrinfo = cls.getaddrinfo
+                app_config = get_app_config()
+                logger.info('Install dns cache, ttl: {}s, negative ttl: {}s'.format(
+                    app_config.dns_cache_ttl, app_config.dns_negative_ttl))
+
+    @classmethod
+    def uninstall(cls):
+        with cls._lock:
+            if cls._getaddrinfo is not None:
+                socket.getaddrinfo = cls._getaddrinfo
+                cls._getaddrinfo = None
+            cls._entries = {}
+
+    @classmethod
+    def getaddrinfo(cls, host, port, family=0, type=0, proto=0, flags=0):
+        """
+        与socket.getaddrinfo一致，优先返回缓存的结果
+        :raise socket.gaierror: 解析失败（包括负缓存）
+        """
+        resolve = cls._getaddrinfo or socket.getaddrinfo
+        app_config = get_app_config()
+        if not host or not app_config.dns_cache_ttl:
+            return resolve(host, port, family, type, proto, flags)
+
+        key = (host, port, family, type, proto, flags)
+        while True:
+            with cls._lock:
+                entry = cls._entries.get(key)
+                if entry and time.time() < entry.expires:
+                    if entry.error:
+                        raise socket.gaierror(*entry.error.args)
+                    return entry.result
+                event = cls._pending.get(key)
+                if event is None:
+                    event = cls._pending[key] = threading.Event()
+                    break
+            # 其他线程正在解析，等待解析结果
+            event.wait()
+
+        try:
+            try:
+                result = resolve(host, port, family, type, proto, flags)
+                entry = DnsEntry(result, None, time.time() + app_config.dns_cache_ttl)
+            except socket.gaierror as e:
+                if entry and not entry.error:
+                    logger.warn('Resolve {} failed, use expired result, error: {}'.format(host, e))
+                    entry = DnsEntry(entry.result, None, time.time() + app_config.dns_negative_ttl)
+                else:
+                    logger.warn('Resolve {} failed, error: {}'.format(host, e))
+                    entry = DnsEntry(None, e, time.time() + app_config.dns_negative_ttl)
+            with cls._lock:
+                if len(cls._entries) >= MAX_ENTRIES:
+                    cls._entries = {}
+                cls._entries[key] = entry
+        finally:
+            with cls._lock:
+                del cls._pending[key]
+            event.set()
+        if entry.error:
+            raise entry.error
+        return entry.result
+
+    @classmethod
+    def get_address(cls, url: str):
+        """
+        :param url:
+        :return: (域名, 端口)，无效的URL返回None
+        """
+        try:
+            parts = urlsplit(url)
+            return (parts.hostname, parts.port or DEFAULT_PORTS.get(parts.scheme, 80)) if parts.hostname else None
+        except ValueError:
+            return None
+
+    @classmethod
+    def prefetch(cls, urls: list):
+        """
+        预解析链接（以及链接使用的代理）的域名，用于应用启动时解析入口链接
+        :param urls:
+        :return:
+        """
+        cls.install()
+        proxy_mapping = get_app_config().proxy_mapping
+        targets = list(urls)
+        for url in urls:
+            pool = proxy_mapping.get_url_pool(url)
+            if pool:
+                targets.extend(v for proxy in pool.proxies for v in proxy.values())
+        addresses = {cls.get_address(url) for url in targets} - {None}
+        if not addresses:
+            return
+        family = allowed_gai_family()
+
+        def resolve(address):
+            try:
+                cls.getaddrinfo(address[0], address[1], family, socket.SOCK_STREAM)
+            except (socket.gaierror, UnicodeError) as e:
+                logger.warn('Prefetch dns failed: {}, error: {}'.format(address[0], e))
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=min(len(addresses), PREFETCH_THREADS)) as executor:
+            list(executor.map(resolve, addresses))
+        logger.info('Prefetch dns of {} hosts, takes {:.0f}ms'.format(len(addresses), (time.time() - start) * 1000))
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._entries = {}
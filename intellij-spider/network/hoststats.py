@@ -0,0 +1,193 @@
+import threading
+from collections import deque
+
+from config import get_app_config
+from common.log import logger
+
+
+def get_host(url: str) -> str:
+    items = url.split('/')
+    return items[2] if len(items) > 2 else url
+
+
+class HostStats(object):
+    """
+    单个域名的并发上限和请求信号统计（延迟、被反扒、请求失败），每个统计窗口结束时调整一次并发上限
+    """
+    # 统计窗口的最小请求数
+    MIN_WINDOW = 5
+    # 用于计算延迟百分位的最近成功请求数
+    LATENCY_SAMPLES = 200
+
+    def __init__(self, host: str, limit: float):
+        self.host = host
+        self.limit = limit
+        self.in_flight = 0
+        # 窗口内是否有请求因为达到并发上限而等待，没有等待说明并发上限不是瓶颈，不增加上限
+        self.saturated = False
+        self.samples = 0
+        self.blocked = 0
+        self.errors = 0
+        self.seconds = 0
+        # 基准延迟：历史窗口的最小平均延迟
+        self.baseline = None
+        # 最近成功请求的延迟
+        self.latencies = deque(maxlen=self.LATENCY_SAMPLES)
+
+    @property
+    def window(self):
+        return max(int(self.limit), self.MIN_WINDOW)
+
+    def reset_window(self):
+        self.saturated = self.in_flight >= self.limit
+        self.samples = self.blocked = self.errors = 0
+        self.seconds = 0
+
+
+class HostConcurrency(object):
+    """
+    按域名自适应调整同时进行的请求数（AIMD）：
+    每个统计窗口内延迟、被反扒（FailureCondition）比例和失败比例正常时，并发上限加1；
+    任意一项恶化时，并发上限减半。响应快的网站逐步达到最大并发，容易反扒的网站保持低并发
+    """
+    _lock = threading.Lock()
+    # k：域名，v：HostStats
+    _hosts = {}
+
+    # 被反扒比例超过该值时减少并发
+    MAX_BLOCK_RATE = 0.05
+    # 失败（异常、错误状态码）比例超过该值时减少并发
+    MAX_ERROR_RATE = 0.2
+    # 平均延迟超过基准延迟的倍数时减少并发
+    LATENCY_TOLERANCE = 2.0
+    # 基准延迟每个窗口上浮的比例，使基准延迟跟随网站长期的延迟变化
+    BASELINE_DRIFT = 1.05
+
+    @classmethod
+    def get_stats(cls, host: str) -> HostStats:
+        stats = cls._hosts.get(host)
+        if stats is None:
+            stats = cls._hosts[host] = HostStats(host, get_app_config().initial_host_concurrency)
+        return stats
+
+    @classmethod
+    def try_acquire(cls, url: str) -> bool:
+        """
+        占用URL所在域名的一个并发名额
+        :param url:
+        :return: 是否占用成功，达到并发上限时返回False
+        """
+        if not get_app_config().adaptive_concurrency:
+            return True
+        with cls._lock:
+            stats = cls.get_stats(get_host(url))
+            if stats.in_flight >= int(stats.limit):
+                stats.saturated = True
+                return False
+            stats.in_flight += 1
+            return True
+
+    @classmethod
+    def release(cls, url: str):
+        if not get_app_config().adaptive_concurrency:
+            return
+        with cls._lock:
+            stats = cls.get_stats(get_host(url))
+            stats.in_flight = max(stats.in_flight - 1, 0)
+
+    @classmethod
+    def record(cls, url: str, seconds: float, ok=True, blocked=False):
+        """
+        记录一次请求的结果
+        :param url:
+        :param seconds: 请求耗时
+        :param ok: 请求是否成功（没有异常，状态码不是服务端错误FAILURE_STATUS_CODES，404等链接错误不影响并发）
+        :param blocked: 是否被反扒（响应内容满足FailureCondition，或者状态码为429/503）
+        :return:
+        """
+        adaptive = get_app_config().adaptive_concurrency
+        with cls._lock:
+            stats = cls.get_stats(get_host(url))
+            if ok:
+                stats.latencies.append(seconds)
+            if not adaptive:
+                return
+            stats.samples += 1
+            stats.seconds += seconds
+            stats.blocked += 1 if blocked else 0
+            stats.errors += 0 if ok else 1
+            if stats.samples >= stats.window:
+                cls.adjust(stats)
+
+    @classmethod
+    def adjust(cls, stats: HostStats):
+        app_config = get_app_config()
+        latency = stats.seconds / stats.samples
+        block_rate = stats.blocked / stats.samples
+        error_rate = stats.errors / stats.samples
+        baseline = latency if stats.baseline is None else min(stats.baseline * cls.BASELINE_DRIFT, latency)
+
+        old = stats.limit
+        if block_rate > cls.MAX_BLOCK_RATE or error_rate > cls.MAX_ERROR_RATE or \
+                (stats.baseline is not None and latency > stats.baseline * cls.LATENCY_TOLERANCE):
+            stats.limit = max(stats.limit / 2, 1)
+        elif stats.saturated:
+            stats.limit = min(stats.limit + 1, app_config.max_connections_per_host)
+        stats.baseline = baseline
+
+        if int(old) != int(stats.limit):
+            logger.info('Host concurrency {}: {} -> {}, in flight: {}, latency: {:.0f}ms (baseline {:.0f}ms), '
+                        'block rate: {:.1%}, error rate: {:.1%}, samples: {}'.format(
+                            stats.host, int(old), int(stats.limit), stats.in_flight, latency * 1000,
+                            baseline * 1000, block_rate, error_rate, stats.samples))
+        stats.reset_window()
+
+    @classmethod
+    def get_latency(cls, url: str, percentile: float):
+        """
+        URL所在域名最近成功请求的延迟百分位（秒）
+        :param url:
+        :param percentile: 0 ~ 1
+        :return: 样本数不足HostTimeout.MIN_SAMPLES时返回None
+        """
+        with cls._lock:
+            stats = cls._hosts.get(get_host(url))
+            if stats is None or len(stats.latencies) < HostTimeout.MIN_SAMPLES:
+                return None
+            latencies = sorted(stats.latencies)
+        return latencies[min(int(len(latencies) * percentile), len(latencies) - 1)]
+
+    @classmethod
+    def items(cls):
+        with cls._lock:
+            return [(host, int(stats.limit), stats.in_flight) for host, stats in cls._hosts.items()]
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._hosts = {}
+
+
+class HostTimeout(object):
+    """
+    按域名延迟计算请求超时：连接超时为P90延迟的2倍，读取超时为P99延迟的4倍，
+    不超过配置的connect_timeout/read_timeout，样本不足时使用配置值
+    """
+    # 计算超时需要的最少样本数
+    MIN_SAMPLES = 10
+    MIN_CONNECT_TIMEOUT = 2
+    MIN_READ_TIMEOUT = 5
+
+    @classmethod
+    def get_timeout(cls, url: str) -> tuple:
+        """
+        :param url:
+        :return: (连接超时, 读取超时)，单位秒
+        """
+        app_config = get_app_config()
+        connect, read = app_config.connect_timeout, app_config.read_timeout
+        p90 = HostConcurrency.get_latency(url, 0.9)
+        if p90 is not None:
+            connect = min(max(p90 * 2, cls.MIN_CONNECT_TIMEOUT), connect)
+            read = min(max(HostConcurrency.get_latency(url, 0.99) * 4, cls.MIN_READ_TIMEOUT), read)
+        return connect, read
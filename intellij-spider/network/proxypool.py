@@ -0,0 +1,124 @@
+import time
+import random
+import threading
+
+from common.log import logger
+
+
+class ProxyStats(object):
+    """
+    单个代理的健康统计（指数加权移动平均）
+    """
+
+    def __init__(self, proxy: dict):
+        self.proxy = proxy
+        self.success = 1.0
+        self.blocked = 0.0
+        # 平均延迟（秒），没有请求时为空
+        self.latency = None
+        self.requests = 0
+        # 隔离结束时间，隔离期间不使用该代理
+        self.quarantine_until = 0
+        self.quarantine_seconds = 0
+
+
+class ProxyPool(object):
+    """
+    代理池：按成功率、延迟、被反扒比例为每个代理打分，每个请求按分数随机选择代理（分数低的代理也有少量请求，用于恢复），
+    被反扒的代理自动隔离一段时间，连续被反扒时隔离时间加倍。
+    每个代理使用独立的连接池（共享的HTTPAdapter按代理地址分别建立连接池）
+    """
+    # 指数加权移动平均的权重
+    ALPHA = 0.2
+    # 最低分数，避免代理永远不被选中
+    MIN_SCORE = 0.05
+    QUARANTINE_SECONDS = 60
+    MAX_QUARANTINE_SECONDS = 1800
+
+    def __init__(self, proxies: list):
+        """
+        :param proxies: 代理列表，每个代理的格式与requests一致，例如：{'http': 'http://1.2.3.4:8080', 'https': ...}
+        """
+        self._stats = [ProxyStats(proxy) for proxy in proxies]
+        self._index = {id(s.proxy): s for s in self._stats}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # 锁不能序列化（多进程应用）
+        state = self.__dict__.copy()
+        del state['_lock']
+        del state['_index']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._index = {id(s.proxy): s for s in self._stats}
+        self._lock = threading.Lock()
+
+    @property
+    def proxies(self):
+        return [s.proxy for s in self._stats]
+
+    @classmethod
+    def score(cls, stats: ProxyStats) -> float:
+        latency = stats.latency if stats.latency is not None else 1
+        return max(stats.success * (1 - stats.blocked) / (latency + 0.5), cls.MIN_SCORE)
+
+    def choose(self) -> dict:
+        """
+        按分数随机选择一个没有隔离的代理，所有代理都被隔离时选择最早结束隔离的代理
+        :return:
+        """
+        now = time.time()
+        with self._lock:
+            healthy = [s for s in self._stats if s.quarantine_until <= now]
+            if not healthy:
+                return min(self._stats, key=lambda s: s.quarantine_until).proxy
+            if len(healthy) == 1:
+                return healthy[0].proxy
+            weights = [self.score(s) for s in healthy]
+            r = random.random() * sum(weights)
+            for stats, weight in zip(healthy, weights):
+                r -= weight
+                if r <= 0:
+                    return stats.proxy
+            return healthy[-1].proxy
+
+    def record(self, proxy: dict, seconds: float, ok=True, blocked=False):
+        """
+        记录使用代理的请求结果
+        :param proxy: choose返回的代理
+        :param seconds: 请求耗时
+        :param ok: 请求是否成功
+        :param blocked: 是否被反扒
+        :return:
+        """
+        with self._lock:
+            stats = self._index.get(id(proxy))
+            if stats is None:
+                return
+            a = self.ALPHA
+            stats.requests += 1
+            stats.success = stats.success * (1 - a) + (a if ok and not blocked else 0)
+            stats.blocked = stats.blocked * (1 - a) + (a if blocked else 0)
+            if ok:
+                stats.latency = seconds if stats.latency is None else stats.latency * (1 - a) + seconds * a
+            if blocked:
+                stats.quarantine_seconds = min(stats.quarantine_seconds * 2, self.MAX_QUARANTINE_SECONDS) \
+                    if stats.quarantine_seconds else self.QUARANTINE_SECONDS
+                stats.quarantine_until = time.time() + stats.quarantine_seconds
+                logger.warn('Quarantine proxy {} for {}s, success: {:.2f}, blocked: {:.2f}'.format(
+                    proxy, stats.quarantine_seconds, stats.success, stats.blocked))
+            elif ok:
+                stats.quarantine_seconds = 0
+
+    def items(self):
+        """
+        :return: [(代理, 分数, 请求数, 是否隔离)]
+        """
+        now = time.time()
+        with self._lock:
+            return [(s.proxy, self.score(s), s.requests, s.quarantine_until > now) for s in self._stats]
+
+    def __str__(self) -> str:
+        return str(self.proxies)
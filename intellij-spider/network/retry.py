@@ -0,0 +1,282 @@
+import time
+import threading
+
+from config import get_app_config
+from common.log import logger
+from network.hoststats import get_host
+
+# 表示服务端错误（域名不可用）的状态码，计入熔断
+FAILURE_STATUS_CODES = (429, 500, 502, 503, 504)
+# 重试也不会成功的状态码，不重试
+NO_RETRY_STATUS_CODES = (404, 410)
+
+
+def get_retry_delay(url: str, attempt: int, max_retries: int, blocked=False, status_code=None):
+    """
+    第attempt次请求失败后是否重试，以及重试间隔
+    :param url:
+    :param attempt: 从0开始
+    :param max_retries: 最大请求次数
+    :param blocked: 是否被反扒
+    :param status_code: 响应状态码，请求异常时为空
+    :return: 重试间隔（秒），不重试时返回None
+    """
+    if attempt + 1 >= max_retries or status_code in NO_RETRY_STATUS_CODES:
+        return None
+    if not RetryBudget.withdraw(url):
+        logger.warn('Retry budget exhausted, give up: {}'.format(url))
+        return None
+    return get_app_config().retry_policy.get_delay(attempt, blocked)
+
+
+class RetryLater(Exception):
+    """
+    请求失败，任务需要在retry_after秒后重新执行，不在工作线程中等待
+    """
+
+    def __init__(self, url: str, retry_after: float, attempt: int):
+        """
+        :param url:
+        :param retry_after: 重试间隔（秒）
+        :param attempt: 已经请求的次数，重新执行时从该次数继续
+        """
+        super(RetryLater, self).__init__('Retry after {:.1f}s, attempt: {}'.format(retry_after, attempt))
+        self.url = url
+        self.retry_after = retry_after
+        self.attempt = attempt
+
+
+class DeadlineExceeded(Exception):
+    """
+    任务下载超过截止时间（Configuration.task_deadline）
+    """
+
+    def __init__(self, remaining: float):
+        super(DeadlineExceeded, self).__init__('Task deadline exceeded by {:.1f}s'.format(-remaining))
+
+
+class CircuitOpenError(Exception):
+    """
+    域名已经熔断，请求不发送，任务需要在retry_after秒后重新执行
+    """
+
+    def __init__(self, host: str, retry_after: float):
+        super(CircuitOpenError, self).__init__('Circuit open: {}, retry after {:.1f}s'.format(host, retry_after))
+        self.host = host
+        self.retry_after = retry_after
+
+
+class RetryBudget(object):
+    """
+    按域名的重试预算（令牌桶）：每个正常请求增加RetryPolicy.budget_ratio个令牌，每次重试消耗1个令牌，
+    令牌不足时不再重试，域名不可用时重试请求数不超过正常请求数的一定比例
+    """
+    _lock = threading.Lock()
+    # k：域名，v：剩余令牌
+    _tokens = {}
+
+    @classmethod
+    def deposit(cls, url: str):
+        policy = get_app_config().retry_policy
+        host = get_host(url)
+        with cls._lock:
+            tokens = cls._tokens.get(host, policy.min_budget)
+            # 最多累积min_budget的10倍，避免长时间正常后突然失败时大量重试
+            cls._tokens[host] = min(tokens + policy.budget_ratio, policy.min_budget * 10)
+
+    @classmethod
+    def withdraw(cls, url: str) -> bool:
+        """
+        消耗一次重试
+        :param url:
+        :return: 预算不足时返回False
+        """
+        policy = get_app_config().retry_policy
+        host = get_host(url)
+        with cls._lock:
+            tokens = cls._tokens.get(host, policy.min_budget)
+            if tokens < 1:
+                return False
+            cls._tokens[host] = tokens - 1
+            return True
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._tokens = {}
+
+
+class CircuitState(object):
+    def __init__(self):
+        self.failures = 0
+        # 熔断结束时间，0表示未熔断
+        self.open_until = 0
+        self.open_seconds = 0
+        # 熔断结束后是否有试探请求正在进行（半开状态只允许一个试探请求）
+        self.probing = False
+
+
+class CircuitBreaker(object):
+    """
+    按域名熔断：连续请求失败达到阈值后，在熔断时间内不发送请求（快速失败，任务延后执行），
+    熔断结束后只允许一个试探请求，成功后恢复，失败后熔断时间加倍
+    """
+    _lock = threading.Lock()
+    # k：域名，v：CircuitState
+    _states = {}
+
+    @classmethod
+    def get_wait(cls, url: str) -> float:
+        """
+        距离域名可以请求的时间（秒），不占用试探请求
+        :param url:
+        :return: 0表示可以请求
+        """
+        with cls._lock:
+            state = cls._states.get(get_host(url))
+            if state is None or not state.open_until:
+                return 0
+            now = time.time()
+            if now < state.open_until:
+                return state.open_until - now
+            # 试探请求正在进行，等待试探结果
+            return 1 if state.probing else 0
+
+    @classmethod
+    def allow(cls, url: str):
+        """
+        检查URL所在域名是否可以请求，熔断结束后的第一个请求作为试探请求
+        :param url:
+        :return: 是否是试探请求，试探请求结束时必须调用record或release
+        :raise CircuitOpenError: 域名熔断中
+        """
+        host = get_host(url)
+        with cls._lock:
+            state = cls._states.get(host)
+            if state is None or not state.open_until:
+                return False
+            now = time.time()
+            if now < state.open_until:
+                raise CircuitOpenError(host, state.open_until - now)
+            if state.probing:
+                raise CircuitOpenError(host, 1)
+            state.probing = True
+            logger.info('Circuit half open, probe request: {}'.format(url))
+            return True
+
+    @classmethod
+    def release(cls, url: str):
+        """
+        试探请求没有得到结果（超过截止时间、任务中断等）时释放试探，熔断状态不变，下一个请求重新试探；
+        已经调用record时不做处理
+        :param url:
+        :return:
+        """
+        with cls._lock:
+            state = cls._states.get(get_host(url))
+            if state is not None and state.probing:
+                state.probing = False
+                logger.info('Circuit probe released without result: {}'.format(url))
+
+    @classmethod
+    def record(cls, url: str, ok: bool):
+        """
+        记录一次请求的结果
+        :param url:
+        :param ok: 域名是否可用（错误状态码、请求异常为不可用）
+        :return:
+        """
+        app_config = get_app_config()
+        if not app_config.circuit_failure_threshold:
+            return
+        host = get_host(url)
+        with cls._lock:
+            state = cls._states.get(host)
+            if state is None:
+                if ok:
+                    return
+                state = cls._states[host] = CircuitState()
+            if ok:
+                if state.open_until:
+                    logger.info('Circuit closed: {}'.format(host))
+                state.failures, state.open_until, state.open_seconds, state.probing = 0, 0, 0, False
+                return
+
+            state.failures += 1
+            if state.probing or (not state.open_until and state.failures >= app_config.circuit_failure_threshold):
+                state.open_seconds = min(state.open_seconds * 2, app_config.circuit_max_open_seconds) \
+                    if state.open_seconds else app_config.circuit_open_seconds
+                state.open_until = time.time() + state.open_seconds
+                state.probing = False
+                logger.warn('Circuit open: {}, failures: {}, open for {}s'.format(
+                    host, state.failures, state.open_seconds))
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._states = {}
+
+
+def test_circuit_breaker():
+    app_config = get_app_config()
+    app_config.circuit_failure_threshold = 2
+    app_config.circuit_open_seconds = 30
+    url = 'http://circuit.test/a'
+    CircuitBreaker.clear()
+    CircuitBreaker.record(url, False)
+    assert not CircuitBreaker.allow(url)
+    CircuitBreaker.record(url, False)
+    try:
+        CircuitBreaker.allow(url)
+        assert False
+    except CircuitOpenError:
+        pass
+
+    # 熔断结束，只允许一个试探请求
+    state = CircuitBreaker._states[get_host(url)]
+    state.open_until = time.time() - 1
+    assert CircuitBreaker.allow(url)
+    try:
+        CircuitBreaker.allow(url)
+        assert False
+    except CircuitOpenError:
+        pass
+
+    # 试探失败，熔断时间加倍
+    CircuitBreaker.record(url, False)
+    assert not state.probing and state.open_seconds == 60 and state.open_until > time.time()
+
+    # 试探没有结果时释放，下一个请求重新试探
+    state.open_until = time.time() - 1
+    assert CircuitBreaker.allow(url)
+    CircuitBreaker.release(url)
+    assert CircuitBreaker.allow(url)
+
+    # 试探成功，恢复
+    CircuitBreaker.record(url, True)
+    assert not state.open_until and not state.probing and not state.failures
+    assert not CircuitBreaker.allow(url)
+    CircuitBreaker.clear()
+
+
+def test_circuit_probe_deadline():
+    from network.urlloader import Url, UrlLoader
+    app_config = get_app_config()
+    app_config.circuit_failure_threshold = 1
+    url = 'http://circuit.test/deadline'
+    CircuitBreaker.clear()
+    CircuitBreaker.record(url, False)
+    state = CircuitBreaker._states[get_host(url)]
+    state.open_until = time.time() - 1
+
+    # 试探请求超过截止时间，没有调用record，试探需要释放
+    ok, _ = UrlLoader.fetch(Url(url), retry=1, deadline=time.time() - 1)
+    assert not ok
+    assert not state.probing
+    assert CircuitBreaker.allow(url)
+    CircuitBreaker.clear()
+
+
+if __name__ == '__main__':
+    test_circuit_breaker()
+    test_circuit_probe_deadline()
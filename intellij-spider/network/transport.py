@@ -0,0 +1,125 @@
+import time
+import threading
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import get_app_config
+from common.log import logger
+from network.retry import DeadlineExceeded
+from network.dnscache import DnsCache
+
+# 最大跳转次数，与requests一致
+MAX_REDIRECTS = 30
+
+UA = 'Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/66.0.3359.181 Safari/537.36'
+# UA = 'Mozilla/5.0 (compatible; Baiduspider-render/2.0; +http://www.baidu.com/search/spider.html)'
+
+
+class Transport(object):
+    """
+    HTTP传输层，所有工作线程共享同一组连接池（长连接），每个域名（代理）的连接数不超过配置的上限，
+    连接数达到上限时等待其他线程释放连接。
+    http session不能多线程并发使用，每个线程使用自己的session（线程结束后自动释放），所有session挂载共享的连接池；
+    请求头按请求生成，不修改共享的请求头；
+    新建连接时的域名解析使用进程内缓存（DnsCache）
+    """
+    _lock = threading.Lock()
+    _adapter = None
+    _local = threading.local()
+
+    @classmethod
+    def get_adapter(cls) -> HTTPAdapter:
+        if cls._adapter is None:
+            with cls._lock:
+                if cls._adapter is None:
+                    app_config = get_app_config()
+                    if app_config.dns_cache_ttl:
+                        DnsCache.install()
+                    cls._adapter = HTTPAdapter(pool_connections=app_config.max_pooled_hosts,
+                                               pool_maxsize=app_config.max_connections_per_host,
+                                               pool_block=True)
+                    logger.info('Create http connection pool, hosts: {}, connections per host: {}'.format(
+                        app_config.max_pooled_hosts, app_config.max_connections_per_host))
+        return cls._adapter
+
+    @classmethod
+    def get_session(cls) -> requests.Session:
+        """
+        获取当前线程使用的http session，挂载共享的连接池
+        :return:
+        """
+        session = getattr(cls._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = cls.get_adapter()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            cls._local.session = session
+        return session
+
+    @classmethod
+    def get_headers(cls, referer=None) -> dict:
+        headers = {'user-agent': UA}
+        if referer:
+            headers['referer'] = referer
+        return headers
+
+    @classmethod
+    def get(cls, url: str, referer=None, proxies=None, keep_cookies=False, timeout=None, deadline=None, stream=False):
+        """
+        发送GET请求
+        :param url:
+        :param referer:
+        :param proxies: 代理
+        :param keep_cookies: 是否在当前线程的后续请求中保留cookie（会话），否则每个请求独立
+        :param timeout: 每次请求（包括跳转）的超时，(连接超时, 读取超时)
+        :param deadline: 截止时间（time.time()），包括所有跳转，为空表示不限制
+        :param stream: 只读取响应头，内容由调用方分块读取（iter_content），读取完成后需要关闭响应
+        :return:
+        :raise DeadlineExceeded: 跳转过程中超过截止时间
+        """
+        session = cls.get_session()
+        headers = cls.get_headers(referer)
+        try:
+            if deadline is None:
+                return session.get(url, headers=headers, proxies=proxies, timeout=timeout, stream=stream)
+            # 逐个跟随跳转，每次请求的超时不超过剩余时间
+            for i in range(MAX_REDIRECTS + 1):
+                res = session.get(url, headers=headers, proxies=proxies, allow_redirects=False,
+                                  timeout=cls.limit_timeout(timeout, deadline), stream=stream)
+                if not res.is_redirect:
+                    return res
+                url = urljoin(res.url, res.headers['location'])
+                res.close()
+            raise requests.TooManyRedirects('Exceeded {} redirects: {}'.format(MAX_REDIRECTS, url))
+        finally:
+            if not keep_cookies:
+                session.cookies.clear()
+
+    @classmethod
+    def limit_timeout(cls, timeout, deadline: float):
+        """
+        请求超时不超过截止时间
+        :param timeout: (连接超时, 读取超时)，为空表示不限制
+        :param deadline:
+        :return:
+        """
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise DeadlineExceeded(remaining)
+        if timeout is None:
+            return remaining
+        connect, read = timeout
+        return min(connect, remaining), min(read, remaining)
+
+    @classmethod
+    def close(cls):
+        """
+        关闭共享的连接池
+        :return:
+        """
+        with cls._lock:
+            if cls._adapter is not None:
+                cls._adapter.close()
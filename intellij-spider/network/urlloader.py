@@ -1,33 +1,51 @@
-import requests
 import datetime
 import time
-from threading import current_thread
+
 from config import get_app_config
-from common.cache import daily_cache
+from common.cache import daily_cache, daily_raw_cache, RawCacheWriter
+from common.content import RawContent
 from common.log import logger
+from network.transport import Transport
+from network.charset import Charset
+from network.hoststats import HostConcurrency, HostTimeout
+from network.retry import CircuitBreaker, DeadlineExceeded, RetryBudget, RetryLater, get_retry_delay, \
+    FAILURE_STATUS_CODES
 
-UA = 'Mozilla/5.0 (Windows NT 6.1; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/66.0.3359.181 Safari/537.36'
-# UA = 'Mozilla/5.0 (compatible; Baiduspider-render/2.0; +http://www.baidu.com/search/spider.html)'
+# 表示请求过于频繁（限流）的状态码
+BLOCK_STATUS_CODES = (429, 503)
+# 允许下载的内容类型（包含其中之一），响应头没有内容类型时不限制
+TEXT_CONTENT_TYPES = ('text/', 'html', 'xml', 'json', 'javascript')
+# 分块下载的块大小
+CHUNK_SIZE = 64 * 1024
 
-headers = {'user-agent': UA}
 
-threaded_session = {}
+class BodyRejected(Exception):
+    """
+    响应内容不是网页，或者大小超过上限，中止下载，不重试
+    """
+    pass
 
 
-def get_current_thread_session():
+class BufferedResponse(object):
     """
-    获取当前线程使用的http session.
-    http session不能多线程并发使用
-    :return:
+    分块读取后的响应
     """
-    t = current_thread()
-    tid = t.ident
-    session = threaded_session.get(tid)
-    if not session:
-        session = requests.Session()
-        session.headers = headers
-        threaded_session[tid] = session
-    return session
+
+    def __init__(self, status_code, reason, headers, content):
+        """
+        :param status_code:
+        :param reason:
+        :param headers:
+        :param content: 响应内容，bytes或者内存映射的缓存内容（memoryview）
+        """
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
 
 
 class Url(object):
@@ -59,69 +77,207 @@ class UrlLoader(object):
     """
     URL下载器，
     支持缓存，如果本地文件存在缓存，则先从缓存读取，缓存有效期为1个自然日
-    支持下载失败重试
+    支持下载失败重试（RetryPolicy：指数退避、重试预算），域名熔断时抛出CircuitOpenError
     """
 
     @classmethod
     # @daily_cache_for_str
     @daily_cache
-    def load(cls, url: Url, retry=25):
+    def load(cls, url: Url, retry=None, attempt=0, defer=False, deadline=None):
         """
         下载URL链接，返回下载的内容；
         先从缓存查询该链接（本地文件缓存或者ElasticSearch缓存），如果缓存存在，直接返回缓存内容
         :param url:
         :param retry:
+        :param attempt: 已经请求的次数
+        :param defer: 请求失败时抛出RetryLater，由调用方延后重试，不在当前线程等待
+        :param deadline: 截止时间（time.time()），包括所有重试和跳转
         :return:
         """
+        return cls.fetch(url, retry, attempt=attempt, defer=defer, deadline=deadline)
+
+    @classmethod
+    @daily_raw_cache
+    def load_raw(cls, url: Url, retry=None, attempt=0, defer=False, deadline=None):
+        """
+        下载URL链接，返回未解码的原始内容RawContent（包含网页编码），用于按字节解析；
+        先从本地文件缓存查询该链接，缓存内容使用内存映射读取
+        :param url:
+        :param retry:
+        :param attempt: 已经请求的次数
+        :param defer: 请求失败时抛出RetryLater，由调用方延后重试，不在当前线程等待
+        :param deadline: 截止时间（time.time()），包括所有重试和跳转
+        :return:
+        """
+        return cls.fetch(url, retry, raw=True, attempt=attempt, defer=defer, deadline=deadline)
+
+    @classmethod
+    def get_encoding(cls, url: str, res: BufferedResponse):
+        """
+        确定网页编码：响应头、BOM、<meta charset>，最后按域名检测（Charset）
+        :param url:
+        :param res:
+        :return:
+        """
+        return Charset.detect(url, res.headers, res.content)
+
+    @classmethod
+    def decode(cls, res: BufferedResponse, encoding):
+        return str(res.content, encoding, errors='replace')
+
+    @classmethod
+    def check_headers(cls, url: str, headers) -> int:
+        """
+        根据响应头检查内容类型和大小
+        :param url:
+        :param headers:
+        :return: 内容大小上限
+        :raise BodyRejected: 内容类型不是网页，或者声明的大小超过上限
+        """
+        content_type = headers.get('content-type', '').lower()
+        if content_type and not any(t in content_type for t in TEXT_CONTENT_TYPES):
+            raise BodyRejected('Content type not supported: {}'.format(content_type))
+        max_size = get_app_config().body_size_mapping.get_url_size(url)
+        length = headers.get('content-length')
+        if length and length.isdigit() and int(length) > max_size:
+            raise BodyRejected('Content length {} exceeds {}'.format(length, max_size))
+        return max_size
+
+    @classmethod
+    def read_response(cls, url: str, res, writer: RawCacheWriter = None, deadline=None) -> BufferedResponse:
+        """
+        分块读取响应内容，内容类型不是网页或者大小超过上限时中止下载
+        :param url:
+        :param res: 流式请求（stream=True）的响应
+        :param writer: 原始内容缓存，内容边下载边写入缓存，为空时读取到内存
+        :param deadline: 截止时间（time.time()），读取超时只限制每次读取，服务端持续缓慢发送时按截止时间中止
+        :return:
+        :raise BodyRejected:
+        :raise DeadlineExceeded: 下载内容超过截止时间
+        """
+        try:
+            max_size = cls.check_headers(url, res.headers)
+            size, buffer = 0, bytearray()
+            for chunk in res.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise BodyRejected('Content size exceeds {}'.format(max_size))
+                if deadline is not None and time.time() > deadline:
+                    raise DeadlineExceeded(deadline - time.time())
+                if writer:
+                    writer.write(chunk)
+                else:
+                    buffer.extend(chunk)
+        finally:
+            res.close()
+        return BufferedResponse(res.status_code, res.reason, res.headers, writer.body() if writer else bytes(buffer))
+
+    @classmethod
+    def fetch(cls, url: Url, retry=None, raw=False, attempt=0, defer=False, deadline=None):
+        """
+        下载URL链接，失败重试
+        :param url:
+        :param retry: 最大请求次数，为空时使用RetryPolicy.max_retries
+        :param raw: 是否返回未解码的原始内容RawContent
+        :param attempt: 已经请求的次数，延后重试时从该次数继续
+        :param defer: 请求失败时抛出RetryLater，由调用方延后重试，不在当前线程等待
+        :param deadline: 截止时间（time.time()），包括所有重试和跳转，超过后不再重试（defer为True时延后重试）
+        :return: (ok, content)
+        :raise CircuitOpenError: 域名熔断中
+        :raise RetryLater: 请求失败，需要延后重试（defer为True）
+        """
         ok, result = False, None
         referer = url.referer
         url = url.value
 
-        if referer:
-            headers['referer'] = referer
-
-        # 代理设置
+        # 代理设置：每次请求从代理池按健康分数选择代理，重试时切换代理
         app_config = get_app_config()
-        proxies = app_config.proxy_mapping.get_url_proxy(url)
-        logger.info('Start request url: {}, proxy: {}'.format(url, proxies))
+        policy = app_config.get_url_policy(url)
+        pool = policy.proxy_pool
+        logger.info('Start request url: {}, proxy: {}'.format(url, pool))
 
-        for i in range(retry):
-            from_t = datetime.datetime.now()
-            logger.info('[{}] request url: {}, proxy: {}'.format(i, url, proxies))
+        retry = retry or app_config.retry_policy.max_retries
+        if not attempt:
+            RetryBudget.deposit(url)
+        for i in range(attempt, retry):
+            # 域名熔断时抛出CircuitOpenError，任务延后执行
+            probe = CircuitBreaker.allow(url)
             try:
-                dt = (datetime.datetime.now() - from_t).microseconds // 1000
-                # 根据配置选择是否使用会话
-                if app_config.use_session:
-                    session = get_current_thread_session()
-                    session.proxies = proxies
-                    # 使用会话抓取，自动处理天猫的302跳转, 中间可能有多个302跳转，所以不要设置超时时间
-                    res = session.get(url, timeout=120)
-                else:
-                    res = requests.get(url, headers=headers, proxies=proxies)
-
-                if res.ok:
-                    logger.info('[{}] request url success, takes: {} ms, size:{}, {}'.format(i, dt, len(res.text), url))
-                    if res.encoding == 'ISO-8859-1':
-                        result = res.content.decode('utf8')
-                    elif res.encoding is None and res.apparent_encoding == 'ISO-8859-1':
-                        result = res.content.decode('gb2312')
+                proxies = pool.choose() if pool else None
+                from_t = datetime.datetime.now()
+                logger.info('[{}] request url: {}, proxy: {}'.format(i, url, proxies))
+                blocked, status_code = False, None
+                try:
+                    # 根据配置选择是否使用会话（保留cookie），连接池在所有线程间共享；
+                    # 使用会话抓取时自动处理天猫的302跳转，中间可能有多个302跳转，每次跳转的超时按域名延迟计算，总时间不超过截止时间
+                    res = Transport.get(url, referer, proxies, keep_cookies=app_config.use_session,
+                                        timeout=HostTimeout.get_timeout(url), deadline=deadline, stream=True)
+                    if res.ok:
+                        CircuitBreaker.record(url, True)
+                        # 分块下载，原始内容直接写入缓存
+                        writer = RawCacheWriter(url) if raw else None
+                        try:
+                            response = cls.read_response(url, res, writer, deadline)
+                            seconds = (datetime.datetime.now() - from_t).total_seconds()
+                            logger.info('[{}] request url success, takes: {} ms, size:{}, {}'.format(
+                                i, int(seconds * 1000), len(response.content), url))
+                            encoding = cls.get_encoding(url, response)
+                            # 根据配置检查是否是正常的返回内容，如果不是，重新抓取
+                            if writer:
+                                ok = app_config.fail_conditions.test(url, RawContent(response.content, encoding), policy.failures)
+                                response = None
+                                result = writer.commit(encoding) if ok else None
+                            else:
+                                result = cls.decode(response, encoding)
+                                ok = app_config.fail_conditions.test(url, result, policy.failures)
+                        finally:
+                            if writer and not ok:
+                                writer.abort()
+                        HostConcurrency.record(url, seconds, blocked=not ok)
+                        if pool:
+                            pool.record(proxies, seconds, blocked=not ok)
+                        if ok:
+                            break
+                        # 被反扒，等待代理地址切换
+                        blocked = True
                     else:
-                        result = res.text if res.encoding in (
-                            'gbk', 'GBK', None, 'gb2312', 'ISO-8859-1') else res.content.decode('utf8')
-
-                    # 根据配置检查是否是正常的返回内容，如果不是，重新抓取
-                    if app_config.fail_conditions.test(url, result):
-                        ok = True
+                        res.close()
+                        seconds = (datetime.datetime.now() - from_t).total_seconds()
+                        dt = int(seconds * 1000)
+                        logger.info('[{}] request url failed, takes {}ms, code:{}-{}'.format(i, dt, res.status_code, res.reason))
+                        status_code = res.status_code
+                        blocked = status_code in BLOCK_STATUS_CODES
+                        # 只有服务端错误计入并发调整和熔断，404等链接错误不表示域名不可用
+                        healthy = status_code not in FAILURE_STATUS_CODES
+                        HostConcurrency.record(url, seconds, ok=healthy, blocked=blocked)
+                        CircuitBreaker.record(url, healthy)
+                        if pool:
+                            pool.record(proxies, seconds, ok=False, blocked=blocked)
+                except BodyRejected as e:
+                    logger.warn('[{}] {}, {}'.format(i, e, url))
+                    break
+                except DeadlineExceeded as e:
+                    logger.warn('[{}] {}, {}'.format(i, e, url))
+                    if not defer:
                         break
-                    else:
-                        # 被反扒，等待4s 代理地址切换
-                        time.sleep(4)
-                else:
-                    logger.info('[{}] request url failed, takes {}ms, code:{}-{}'.format(i, dt, res.status_code, res.reason))
-                    time.sleep(0.5)
-            except Exception as e:
-                logger.error('[{}] request url failed, error: {}'.format(i, e))
-                # import traceback
-                # traceback.print_exc()
-            time.sleep(0.1)
+                    # 任务延后重新执行，使用新的截止时间
+                except Exception as e:
+                    logger.error('[{}] request url failed, error: {}'.format(i, e))
+                    seconds = (datetime.datetime.now() - from_t).total_seconds()
+                    HostConcurrency.record(url, seconds, ok=False)
+                    CircuitBreaker.record(url, False)
+                    if pool:
+                        pool.record(proxies, seconds, ok=False)
+                    # import traceback
+                    # traceback.print_exc()
+            finally:
+                # 试探请求没有调用record（例如超过截止时间）时释放试探，否则域名一直处于熔断状态
+                if probe:
+                    CircuitBreaker.release(url)
+            delay = get_retry_delay(url, i, retry, blocked, status_code)
+            if delay is None:
+                break
+            if defer:
+                raise RetryLater(url, delay, i + 1)
+            time.sleep(delay)
         return ok, result
@@ -0,0 +1,134 @@
+import json
+import time
+import pathlib
+
+import fire
+
+from common import util
+from common.log import logger
+from common.cache import read_cache_index, read_raw_cache, read_str_cache, CACHE_INDEX_FILE, TMP_SUFFIX
+from config import CACHE_DIR, app_config
+from rule.registry import RuleRegistry
+from rule.ruleparser import RuleParser
+from rule.budget import RegexOffenders
+
+'''
+模板性能分析：使用指定的解析规则解析某个域名下所有缓存的网页（CACHE_DIR/<日期>/<域名>/），
+统计每个解析节点的耗时、匹配率、输出大小，以及耗时最长的网页，用于找出解析耗时最多的模板，例如：
+python profiler.py sgsc_page sg.vegnet.com.cn --app sgsc
+python profiler.py sgsc_page sg.vegnet.com.cn --app sgsc --date 2020-01-01 --top 20
+'''
+
+
+class NodeStats(object):
+    def __init__(self, path: str):
+        self.path = path
+        self.calls = 0
+        self.hits = 0
+        self.seconds = 0
+        self.size = 0
+
+
+class TemplateProfiler(object):
+    """
+    解析节点性能统计，作为RuleParser的profiler使用
+    """
+
+    def __init__(self, rule):
+        self._rule = rule
+        # k：id(节点)，v：NodeStats
+        self._nodes = {}
+        for node in rule.nodes:
+            self.add_node(node, '')
+        # [(耗时, 大小, 链接或者缓存文件)]
+        self._pages = []
+
+    def add_node(self, node, parent_path):
+        if not node:
+            return
+        path = parent_path + '/' + node.name if parent_path else node.name
+        self._nodes[id(node)] = NodeStats(path)
+        for child in node.children:
+            self.add_node(child, path)
+
+    def record(self, node, seconds, value):
+        stats = self._nodes.get(id(node))
+        if stats is None:
+            return
+        stats.calls += 1
+        stats.seconds += seconds
+        if value:
+            stats.hits += 1
+            stats.size += len(value) if isinstance(value, str) else len(json.dumps(value, ensure_ascii=False))
+
+    def profile_page(self, content, url, name):
+        start = time.perf_counter()
+        RuleParser(self._rule, content, url, app_config.combined_scan, app_config.regex_timeout,
+                   app_config.adaptive_regex_order, self).parse()
+        self._pages.append((time.perf_counter() - start, len(content), url or name))
+
+    def report(self, top=10):
+        total = sum(p[0] for p in self._pages)
+        print('-------------------- 解析节点（耗时包括子节点） --------------------')
+        print('{:>10} {:>9} {:>8} {:>8} {:>10} {:>10}  {}'.format(
+            'total(ms)', 'avg(ms)', 'calls', 'match', 'out(KB)', 'time', 'node'))
+        for stats in sorted(self._nodes.values(), key=lambda s: -s.seconds):
+            print('{:>10.1f} {:>9.3f} {:>8} {:>8.1%} {:>10.1f} {:>10.1%}  {}'.format(
+                stats.seconds * 1000, stats.seconds * 1000 / stats.calls if stats.calls else 0, stats.calls,
+                stats.hits / stats.calls if stats.calls else 0, stats.size / 1024,
+                stats.seconds / total if total else 0, stats.path))
+
+        print('\n-------------------- 耗时最长的网页 --------------------')
+        for seconds, size, page in sorted(self._pages, key=lambda p: -p[0])[:top]:
+            print('{:>10.1f}ms {:>10.1f}KB  {}'.format(seconds * 1000, size / 1024, page))
+
+        print('\n-------------------- 汇总 --------------------')
+        print('pages: {}, total: {:.1f}ms, avg: {:.3f}ms'.format(
+            len(self._pages), total * 1000, total * 1000 / len(self._pages) if self._pages else 0))
+        for (rule_name, node_name, url), (count, regex) in RegexOffenders.items():
+            print('regex timeout: {} / {}, {} times, {}, {}'.format(rule_name, node_name, count, regex, url))
+
+
+def iter_cached_pages(domain: str, date: str = None):
+    """
+    逐个产生域名下所有缓存的网页
+    :param domain:
+    :param date: 缓存日期（yyyy-mm-dd），为空时使用所有日期的缓存
+    :return: (网页内容, 链接, 缓存文件)
+    """
+    for cache_dir in sorted(pathlib.Path(CACHE_DIR).glob('{}/{}'.format(date or '*', domain))):
+        index = read_cache_index(cache_dir)
+        for cache_file in sorted(cache_dir.iterdir()):
+            if cache_file.name == CACHE_INDEX_FILE or cache_file.suffix == TMP_SUFFIX or not cache_file.is_file():
+                continue
+            try:
+                content = read_raw_cache(cache_file) if cache_file.suffix == '.raw' else read_str_cache(cache_file)
+            except (OSError, ValueError) as e:
+                logger.error('Read cache failed, {} {}'.format(cache_file, e))
+                continue
+            yield content, index.get(cache_file.name, ''), str(cache_file)
+
+
+def profile(rule_name: str, domain: str, app: str = None, date: str = None, top=10):
+    """
+    使用解析规则解析域名下所有缓存的网页，输出性能统计
+    :param rule_name: 解析规则（模板）名称
+    :param domain: 缓存网页的域名
+    :param app: 模板所在的应用（apps/<app>/templates/），为空时使用当前的模板目录
+    :param date: 缓存日期（yyyy-mm-dd），为空时使用所有日期的缓存
+    :param top: 输出耗时最长的网页个数
+    :return:
+    """
+    if app:
+        util.template_path = 'apps.{}.templates.'.format(app)
+    rule = RuleRegistry.get(rule_name)
+    if not rule:
+        return
+    profiler = TemplateProfiler(rule)
+    for content, url, cache_file in iter_cached_pages(domain, date):
+        profiler.profile_page(content, url, cache_file)
+    profiler.report(top)
+
+
+if __name__ == '__main__':
+    fire.Fire(profile)
@@ -0,0 +1,80 @@
+import re
+
+"""
+"匹配所有"结果的批量后处理：所有结果以分隔符连接，每个处理步骤对连接后的内容只执行一次，然后按分隔符拆分。
+只有当各个步骤不会跨越、匹配或者生成分隔符时，批量处理的结果才与逐个处理一致，这里对替换正则做保守判断
+"""
+
+SEPARATOR = '\x00'
+# 每批处理的结果个数，匹配结果按批次从生成器取出，不需要等待所有匹配
+BATCH_SIZE = 256
+# 去除HTML标签，标签不跨越分隔符
+HTML_TAG_PATTERN = re.compile('<[^>\x00]+?>')
+# 每个结果首尾的空白
+STRIP_PATTERN = re.compile(r'\s*\x00\s*')
+
+# 可能匹配分隔符，或者在内容边界上语义不同的转义：\W \S \D \A \Z 以及按编码表示的字符
+UNSAFE_ESCAPES = set('WSDAZxuUN0123456789')
+# 替换内容中可能生成分隔符的转义
+UNSAFE_REPL_ESCAPES = ('\\0', '\\x', '\\u', '\\U', '\\N')
+
+
+def is_pattern_safe(regex: str) -> bool:
+    """
+    检查替换正则在连接后的内容上执行时是否与逐个执行结果一致（保守判断）：
+    不能匹配分隔符（任意字符、取反的字符集、\\W \\S \\D等），不能依赖内容的开始和结束（^ $ \\A \\Z），
+    除(?:...)和命名分组之外不能使用(?...)扩展语法（前后查找、内联标志等）
+    :param regex:
+    :return:
+    """
+    i, n = 0, len(regex)
+    while i < n:
+        c = regex[i]
+        if c == SEPARATOR:
+            return False
+        if c == '\\':
+            if i + 1 >= n or regex[i + 1] in UNSAFE_ESCAPES:
+                return False
+            i += 2
+        elif c == '[':
+            j = i + 1
+            if j < n and regex[j] == '^':
+                return False
+            if j < n and regex[j] == ']':
+                j += 1
+            while j < n and regex[j] != ']':
+                if regex[j] == '\\':
+                    if j + 1 >= n or regex[j + 1] in UNSAFE_ESCAPES:
+                        return False
+                    j += 1
+                elif regex[j] == SEPARATOR:
+                    return False
+                j += 1
+            if j >= n:
+                return False
+            i = j + 1
+        elif c in '.^$':
+            return False
+        elif c == '(' and regex.startswith('(?', i):
+            if not regex.startswith(('(?:', '(?P<', '(?P='), i):
+                return False
+            i += 2
+        else:
+            i += 1
+    return True
+
+
+def is_repl_safe(repl) -> bool:
+    if not isinstance(repl, str) or SEPARATOR in repl:
+        return False
+    return not any(e in repl for e in UNSAFE_REPL_ESCAPES)
+
+
+def is_chain_safe(chain) -> bool:
+    """
+    检查字符串替换链是否可以批量执行
+    :param chain: [(pattern, repl)]
+    :return:
+    """
+    return all(isinstance(pattern.pattern, str) and is_pattern_safe(pattern.pattern) and is_repl_safe(repl)
+               for pattern, repl in chain)
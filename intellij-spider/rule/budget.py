@@ -0,0 +1,184 @@
+import re
+import time
+import threading
+
+from common.log import logger
+
+"""
+正则时间预算：每个解析节点的正则匹配限定总耗时，超时后中止该节点的解析，节点结果按失败处理，不影响工作线程继续执行其他任务。
+匹配过程本身通过regex模块中断（regex的timeout参数），设置了时间预算时必须安装regex模块；
+regex无法编译的正则只能在每次匹配之间检查耗时，单次匹配的回溯无法中断，但超时后不再继续查找后续匹配
+"""
+
+try:
+    import regex
+except ImportError:
+    regex = None
+
+
+class RegexTimeout(Exception):
+    def __init__(self, regex_source, elapsed):
+        super().__init__('Regex timeout after {:.3f}s: {}'.format(elapsed, regex_source))
+        self.regex = regex_source
+        self.elapsed = elapsed
+        # 超时的解析节点名称，由解析器填充
+        self.node = None
+
+
+def require_regex():
+    """
+    检查是否可以中断正则匹配，设置了时间预算（Configuration.regex_timeout）时调用
+    :return:
+    :raise RuntimeError: 没有安装regex模块
+    """
+    if regex is None:
+        raise RuntimeError('regex_timeout requires the regex module (pip install regex), '
+                           'or set regex_timeout to 0 to disable the regex time budget')
+
+
+class RegexBudget(object):
+    """
+    一个解析节点（包括其子节点）的正则匹配时间预算
+    """
+
+    def __init__(self, seconds: float):
+        self._seconds = seconds
+        self._start = time.monotonic()
+        self._deadline = self._start + seconds
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self._start
+
+    def remaining(self):
+        return max(self._deadline - time.monotonic(), 0)
+
+    def check(self, pattern):
+        """
+        超过预算时抛出RegexTimeout
+        :param pattern: 当前执行的正则
+        :return:
+        """
+        if time.monotonic() > self._deadline:
+            raise RegexTimeout(source_of(pattern), self.elapsed)
+
+
+# re编译的正则 -> regex编译的正则（不兼容时为None）
+_guarded = {}
+_guarded_lock = threading.Lock()
+
+
+def source_of(pattern):
+    source = pattern.pattern
+    return source.decode('latin-1') if isinstance(source, bytes) else source
+
+
+def regex_flags(flags):
+    # re和regex的ASCII标志取值不同，其他标志取值一致
+    ret = flags & (re.IGNORECASE | re.LOCALE | re.MULTILINE | re.DOTALL | re.UNICODE | re.VERBOSE)
+    if flags & re.ASCII:
+        ret |= regex.ASCII
+    return ret | regex.VERSION0
+
+
+def guarded(pattern):
+    """
+    获取可以中断的regex正则，regex模块不可用或者无法编译时返回None
+    :param pattern: re编译的正则
+    :return:
+    """
+    if regex is None:
+        return None
+    try:
+        return _guarded[pattern]
+    except KeyError:
+        pass
+    try:
+        compiled = regex.compile(pattern.pattern, regex_flags(pattern.flags))
+    except (regex.error, ValueError, TypeError) as e:
+        logger.warn('Regex cannot be guarded, timeout is checked between matches only, {} {}'.format(
+            source_of(pattern), e))
+        compiled = None
+    with _guarded_lock:
+        _guarded[pattern] = compiled
+    return compiled
+
+
+def search(pattern, content, budget: RegexBudget = None, pos=0):
+    """
+    在时间预算内查找第一个匹配
+    :param pattern: re编译的正则
+    :param content:
+    :param budget: 时间预算，为空时不限制
+    :param pos: 开始位置
+    :return:
+    """
+    if budget is None:
+        return pattern.search(content, pos)
+    budget.check(pattern)
+    guarded_pattern = guarded(pattern)
+    if guarded_pattern is None:
+        m = pattern.search(content, pos)
+        budget.check(pattern)
+        return m
+    try:
+        return guarded_pattern.search(content, pos, timeout=budget.remaining())
+    except TimeoutError:
+        raise RegexTimeout(source_of(pattern), budget.elapsed)
+
+
+def finditer(pattern, content, budget: RegexBudget = None):
+    """
+    在时间预算内逐个产生所有匹配
+    :param pattern: re编译的正则
+    :param content:
+    :param budget: 时间预算，为空时不限制
+    :return:
+    """
+    if budget is None:
+        yield from pattern.finditer(content)
+        return
+    budget.check(pattern)
+    guarded_pattern = guarded(pattern)
+    if guarded_pattern is None:
+        for m in pattern.finditer(content):
+            budget.check(pattern)
+            yield m
+        budget.check(pattern)
+        return
+    try:
+        for m in guarded_pattern.finditer(content, timeout=budget.remaining()):
+            yield m
+            budget.check(pattern)
+    except TimeoutError:
+        raise RegexTimeout(source_of(pattern), budget.elapsed)
+
+
+class RegexOffenders(object):
+    """
+    正则超时记录，k：(规则, 节点, 链接)，用于找出需要修改的模板
+    """
+    _lock = threading.Lock()
+    _offenders = {}
+
+    @classmethod
+    def record(cls, rule_name, node_name, url, e: RegexTimeout):
+        logger.error('Regex timeout, rule: {}, node: {}, url: {}, elapsed: {:.3f}s, re: {}'.format(
+            rule_name, node_name, url, e.elapsed, e.regex))
+        with cls._lock:
+            key = (rule_name, node_name, url)
+            count, _ = cls._offenders.get(key, (0, None))
+            cls._offenders[key] = (count + 1, e.regex)
+
+    @classmethod
+    def items(cls):
+        """
+        :return: [((规则, 节点, 链接), (次数, 正则))]，按次数倒序
+        """
+        with cls._lock:
+            return sorted(cls._offenders.items(), key=lambda i: -i[1][0])
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._offenders.clear()
@@ -0,0 +1,269 @@
+import re
+import codecs
+
+"""
+字节正则：直接在原始网页内容（bytes）上匹配，只对匹配到的分组解码。
+只有当字节匹配与字符串匹配结果一致时才使用字节正则，否则返回None，由调用方解码后按字符串匹配
+"""
+
+# ASCII字节不会出现在多字节字符中间、并且可以从任意字节确定字符边界（UTF-8、单字节编码）的编码，可以直接按字节匹配
+SYNC_ENCODINGS = {'utf-8', 'ascii', 'latin-1'}
+SYNC_ENCODING_PREFIXES = ('iso8859', 'cp125')
+# ASCII字节不会出现在多字节字符中间，但多字节字符可能在错位的位置匹配（EUC），正则只能包含ASCII字符
+ASCII_ONLY_ENCODINGS = {'euc_jp', 'euc_kr'}
+
+# 字节模式下语义不同的转义：\w \s \d \b 等只匹配ASCII
+UNSAFE_ESCAPES = set('wWbBsSdDuUN')
+# 字符集中的\w \s \d与对应的大写转义同时出现时匹配任意字符（例如[\s\S]），与字节模式一致
+CLASS_ESCAPE_PAIRS = ('sS', 'dD', 'wW')
+# 表示普通字符的字母转义
+LITERAL_ESCAPES = set('ntrfv')
+# 字符串模式下忽略大小写、Unicode/ASCII/locale相关的内联标记
+UNSAFE_FLAGS = set('iuaL')
+
+
+def get_encoding_kind(encoding: str):
+    """
+    :param encoding:
+    :return: 'sync'（可以按字节匹配）、'ascii'（正则只能包含ASCII字符）或者None（不能按字节匹配）
+    """
+    try:
+        name = codecs.lookup(encoding).name
+    except (LookupError, TypeError):
+        return None
+    if name in SYNC_ENCODINGS or name.startswith(SYNC_ENCODING_PREFIXES):
+        return 'sync'
+    return 'ascii' if name in ASCII_ONLY_ENCODINGS else None
+
+
+def parse_class(regex: str, i: int):
+    """
+    解析字符集[...]
+    :param regex:
+    :param i: '['的位置
+    :return: 字符集结束后的位置，字符集按字节匹配与按字符匹配不一致时返回None
+    """
+    n = len(regex)
+    j = i + 1
+    negated = j < n and regex[j] == '^'
+    if negated:
+        j += 1
+    if j < n and regex[j] == ']':
+        j += 1
+    escapes = set()
+    while j < n and regex[j] != ']':
+        if regex[j] == '\\':
+            if j + 1 >= n:
+                return None
+            e = regex[j + 1]
+            if e in UNSAFE_ESCAPES:
+                escapes.add(e)
+            elif e.isalnum() and e not in LITERAL_ESCAPES:
+                return None
+            j += 1
+        elif ord(regex[j]) > 127:
+            return None
+        j += 1
+    if j >= n:
+        return None
+    if escapes and (negated or not any(set(pair) <= escapes for pair in CLASS_ESCAPE_PAIRS)):
+        return None
+    return j + 1
+
+
+def tokenize(regex: str):
+    """
+    将正则表达式拆分为(类型, 文本)，类型：literal、class、quant、open、close、alt、anchor、other
+    :param regex:
+    :return: 包含按字节匹配与按字符匹配不一致的语法时返回None
+    """
+    tokens = []
+    i, n = 0, len(regex)
+    while i < n:
+        c = regex[i]
+        if c == '\\':
+            if i + 1 >= n:
+                return None
+            e = regex[i + 1]
+            if e in 'AZ':
+                kind = 'anchor'
+            elif e.isdigit():
+                # 反向引用
+                kind = 'other'
+            elif e in LITERAL_ESCAPES or not e.isalnum():
+                kind = 'literal'
+            else:
+                # \w \s \d \b \x \u等
+                return None
+            tokens.append((kind, regex[i:i + 2]))
+            i += 2
+        elif c == '[':
+            j = parse_class(regex, i)
+            if j is None:
+                return None
+            tokens.append(('class', regex[i:j]))
+            i = j
+        elif c == '(':
+            j = i + 1
+            if j < n and regex[j] == '?':
+                j += 1
+                # 内联标记，例如(?i)、(?s:...)
+                k = j
+                while k < n and regex[k].isalpha() and regex[k] in 'aiLmsux-':
+                    k += 1
+                if UNSAFE_FLAGS & set(regex[j:k]):
+                    return None
+                if j < n and regex[j] == 'P':
+                    # 命名分组(?P<name>...)或者(?P=name)
+                    k = regex.find('>' if regex[j + 1:j + 2] == '<' else ')', j)
+                    if k < 0:
+                        return None
+                    j = k + 1 if regex[k] == '>' else k
+                    if regex[k] == ')':
+                        tokens.append(('other', regex[i:k]))
+                        i = k
+                        continue
+            tokens.append(('open', regex[i:j]))
+            i = j
+        elif c == ')':
+            tokens.append(('close', c))
+            i += 1
+        elif c == '|':
+            tokens.append(('alt', c))
+            i += 1
+        elif c in '*+?':
+            tokens.append(('quant', c))
+            i += 1
+        elif c in '^$':
+            tokens.append(('anchor', c))
+            i += 1
+        elif c == '{':
+            # 按个数重复
+            return None
+        elif c == '.':
+            tokens.append(('class', c))
+            i += 1
+        else:
+            tokens.append(('literal', c))
+            i += 1
+    return tokens
+
+
+def is_bytes_safe(regex: str, ascii_only=False) -> bool:
+    """
+    检查正则表达式按字节匹配时是否与按字符匹配结果一致（保守判断）：
+    非ASCII字符只能作为普通文本出现，不能在字符集中或者带量词；
+    任意字符、字符集只能以*或+的形式出现（不能按个数匹配半个字符），
+    后面必须紧跟普通文本（非贪婪匹配时），匹配结束的位置才是字符边界；
+    不能使用\\w \\s \\d \\b等Unicode相关的转义（[\\s\\S]除外），不能忽略大小写，不能匹配空字符串
+    :param regex:
+    :param ascii_only: 正则只能包含ASCII字符
+    :return:
+    """
+    if ascii_only and any(ord(c) > 127 for c in regex):
+        return False
+    try:
+        # 可以匹配空字符串的正则会在多字节字符的中间产生空匹配
+        if re.fullmatch(regex, ''):
+            return False
+    except re.error:
+        return False
+    tokens = tokenize(regex)
+    if tokens is None:
+        return False
+    n = len(tokens)
+    for i, (kind, text) in enumerate(tokens):
+        if kind == 'literal' and ord(text[-1]) > 127:
+            if i + 1 < n and tokens[i + 1][0] == 'quant':
+                return False
+        if kind != 'class':
+            continue
+        if i + 1 >= n or tokens[i + 1][1] not in '*+':
+            return False
+        j = i + 2
+        lazy = j < n and tokens[j][1] == '?'
+        if lazy:
+            j += 1
+        while j < n and tokens[j][0] == 'close':
+            j += 1
+        if j >= n or tokens[j][0] == 'alt':
+            # 贪婪匹配到结尾是字符边界
+            if lazy:
+                return False
+        elif tokens[j][0] not in ('literal', 'anchor'):
+            return False
+    return True
+
+
+def compile_bytes(regex: str, encoding: str):
+    """
+    将字符串正则编译为指定编码的字节正则，无法安全转换时返回None
+    :param regex:
+    :param encoding: 网页编码
+    :return:
+    """
+    kind = get_encoding_kind(encoding)
+    if kind is None or not is_bytes_safe(regex, ascii_only=(kind == 'ascii')):
+        return None
+    try:
+        return re.compile(regex.encode(encoding))
+    except (re.error, UnicodeEncodeError):
+        return None
+
+
+def test_bytes_safe():
+    assert is_bytes_safe(r'<li>(.*?)</li>')
+    assert is_bytes_safe(r'"price":"([^"]*)"')
+    assert is_bytes_safe(r'<p>([\s\S]*)</p>')
+    assert not is_bytes_safe(r'[\s\S]*')
+    assert is_bytes_safe(r'价格：(.+?)元')
+    assert not is_bytes_safe(r'<span>\s*(.*?)</span>')
+    assert not is_bytes_safe(r'(\d+)')
+    assert not is_bytes_safe(r'[^\s<]+>')
+    assert not is_bytes_safe(r'<b>(.+?)')
+    assert not is_bytes_safe(r'(?i)<B>(.*?)</B>')
+    assert not is_bytes_safe(r'<a>.{2}')
+    assert compile_bytes(r'<b>(.*?)</b>', 'gb2312') is None
+    assert compile_bytes(r'价格(.*?)<', 'euc_kr') is None
+    assert compile_bytes(r'<b>(.*?)</b>', 'euc_kr') is not None
+
+
+def test_bytes_equivalence():
+    """
+    随机生成正则和网页内容，可以按字节匹配的正则与按字符匹配的结果必须一致
+    """
+    import random
+    rnd = random.Random(0)
+    literals = ['<span>', '</span>', '价格', '"', ':', 'a', '\\.', '\u3000', ' ', '$']
+    classes = ['.', '[^<]', '[\\s\\S]', '\\s', '\\S', '\\d', '[a-z]', '\\w', '[^"]', '[^\\s]']
+    quantifiers = ['*', '+', '*?', '+?', '', '?']
+    alphabet = ['<span>', '</span>', '价', '格', '\u3000', ' ', 'a', '"', ':', '1', '\uff11', '\n', '.', '\u00e9']
+    checked = 0
+    for encoding in ('utf-8', 'euc_kr', 'latin-1'):
+        chars = [c for c in alphabet if c.encode(encoding, errors='ignore').decode(encoding) == c]
+        texts = [''.join(rnd.choice(chars) for _ in range(rnd.randint(0, 30))) for _ in range(30)]
+        for _ in range(2000):
+            parts = []
+            for _ in range(rnd.randint(1, 5)):
+                part = rnd.choice(literals) if rnd.random() < 0.5 else rnd.choice(classes) + rnd.choice(quantifiers)
+                parts.append('({})'.format(part) if rnd.random() < 0.3 else part)
+            regex = ''.join(parts)
+            try:
+                pattern = re.compile(regex)
+            except re.error:
+                continue
+            bytes_pattern = compile_bytes(regex, encoding)
+            if bytes_pattern is None:
+                continue
+            checked += 1
+            for text in texts:
+                expected = [(m.group(0),) + m.groups() for m in pattern.finditer(text)]
+                actual = [tuple(g.decode(encoding) if g is not None else None for g in (m.group(0),) + m.groups())
+                          for m in bytes_pattern.finditer(text.encode(encoding))]
+                assert expected == actual, (regex, encoding, text, expected, actual)
+    assert checked > 100
+
+
+if __name__ == '__main__':
+    test_bytes_safe()
+    test_bytes_equivalence()
@@ -0,0 +1,361 @@
+import re
+from html.parser import HTMLParser
+
+from common.log import logger
+
+"""
+轻量级HTML树和选择器，用于选择器解析节点（Keys.SELECTOR）
+每次解析只将网页解析为树一次，同一规则下的所有选择器节点共享该树，子节点在子树上继续选择
+选择器支持CSS和XPath的常用子集：
+CSS：   tag, *, #id, .class, [attr], [attr=v], [attr~=v], [attr^=v], [attr$=v], [attr*=v],
+        后代（空格）、子元素（>），多个选择器（,），取值 ::text ::html ::attr(name)
+XPath： /tag, //tag, *, [@attr], [@attr='v'], [contains(@attr,'v')], [n]，取值 /text() /@attr
+缺省取值为元素的全部文本内容
+"""
+
+# 没有结束标签的元素
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source',
+                 'track', 'wbr'}
+
+
+class HtmlElement(object):
+    """
+    HTML树的一个元素节点，记录在原始网页中的位置，获取元素HTML时直接截取原始内容，不重新序列化
+    """
+
+    def __init__(self, tag: str, attrs: dict, parent, source: str, start: int):
+        self.tag = tag
+        self.attrs = attrs
+        self.parent = parent
+        # 子节点，包括子元素和文本
+        self.nodes = []
+        self._source = source
+        self.start = start
+        self.end = start
+
+    @property
+    def children(self):
+        return [n for n in self.nodes if isinstance(n, HtmlElement)]
+
+    def iter_descendants(self):
+        stack = list(reversed(self.children))
+        while stack:
+            element = stack.pop()
+            yield element
+            stack.extend(reversed(element.children))
+
+    @property
+    def own_text(self) -> str:
+        return ''.join(n for n in self.nodes if isinstance(n, str))
+
+    @property
+    def text(self) -> str:
+        ret, stack = [], [self]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, str):
+                ret.append(node)
+            else:
+                stack.extend(reversed(node.nodes))
+        return ''.join(ret)
+
+    @property
+    def html(self) -> str:
+        return self._source[self.start:self.end]
+
+    @property
+    def classes(self):
+        return (self.attrs.get('class') or '').split()
+
+    def __str__(self) -> str:
+        return self.html
+
+
+class HtmlTreeBuilder(HTMLParser):
+    def __init__(self, source: str):
+        super().__init__(convert_charrefs=True)
+        self._source = source
+        self._line_offsets = [0] + [m.end() for m in re.finditer('\n', source)]
+        self.root = HtmlElement('#document', {}, None, source, 0)
+        self._stack = [self.root]
+
+    def get_offset(self):
+        line, col = self.getpos()
+        return self._line_offsets[line - 1] + col
+
+    def handle_starttag(self, tag, attrs):
+        start = self.get_offset()
+        parent = self._stack[-1]
+        element = HtmlElement(tag, {k: v if v is not None else '' for k, v in attrs}, parent, self._source, start)
+        element.end = start + len(self.get_starttag_text() or '')
+        parent.nodes.append(element)
+        if tag not in VOID_ELEMENTS:
+            self._stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self._stack.pop()
+
+    def handle_endtag(self, tag):
+        start = self.get_offset()
+        # 忽略没有对应开始标签的结束标签，未闭合的子元素在此处隐式结束
+        for i in range(len(self._stack) - 1, 0, -1):
+            if self._stack[i].tag == tag:
+                end = self._source.find('>', start)
+                end = len(self._source) if end < 0 else end + 1
+                for element in self._stack[i + 1:]:
+                    element.end = start
+                self._stack[i].end = end
+                del self._stack[i:]
+                break
+
+    def handle_data(self, data):
+        self._stack[-1].nodes.append(data)
+
+    def build(self) -> HtmlElement:
+        self.feed(self._source)
+        self.close()
+        for element in self._stack[1:]:
+            element.end = len(self._source)
+        self.root.end = len(self._source)
+        return self.root
+
+
+def parse_html(source: str) -> HtmlElement:
+    """
+    将HTML解析为树，返回文档根节点
+    :param source:
+    :return:
+    """
+    return HtmlTreeBuilder(source).build()
+
+
+class Step(object):
+    """
+    选择器的一步：轴（后代/子元素）+ 标签 + 条件 + 位置
+    """
+    DESCENDANT = 0
+    CHILD = 1
+
+    def __init__(self, axis, tag='*'):
+        self.axis = axis
+        self.tag = tag
+        # [(attr, op, value)]
+        self.conditions = []
+        self.position = None
+
+    def test(self, element: HtmlElement) -> bool:
+        if self.tag != '*' and element.tag != self.tag:
+            return False
+        for attr, op, value in self.conditions:
+            actual = element.attrs.get(attr)
+            if actual is None:
+                return False
+            if op is None:
+                continue
+            if op == '=' and actual != value:
+                return False
+            if op == '~=' and value not in actual.split():
+                return False
+            if op == '^=' and not actual.startswith(value):
+                return False
+            if op == '$=' and not actual.endswith(value):
+                return False
+            if op == '*=' and value not in actual:
+                return False
+        return True
+
+    def apply(self, contexts: list) -> list:
+        ret, seen = [], set()
+        for context in contexts:
+            candidates = context.iter_descendants() if self.axis == self.DESCENDANT else context.children
+            matched = [e for e in candidates if self.test(e)]
+            if self.position is not None:
+                matched = self.filter_position(matched)
+            for e in matched:
+                if id(e) not in seen:
+                    seen.add(id(e))
+                    ret.append(e)
+        if len(contexts) > 1:
+            ret.sort(key=lambda e: e.start)
+        return ret
+
+    def filter_position(self, matched):
+        # XPath位置从1开始，按父元素分组计算
+        counter, ret = {}, []
+        for e in matched:
+            n = counter[id(e.parent)] = counter.get(id(e.parent), 0) + 1
+            if n == self.position:
+                ret.append(e)
+        return ret
+
+
+class Selector(object):
+    """
+    编译后的选择器，支持CSS和XPath常用子集
+    """
+    TEXT = 'text'
+    OWN_TEXT = 'own_text'
+    HTML = 'html'
+    ATTR = 'attr'
+
+    CSS_TOKEN = re.compile(r'\s*(>)\s*|(\s+)|([#.]?[\w-]+|\*)|\[\s*([\w-]+)\s*(?:([~^$*]?=)\s*["\']?([^"\'\]]*)["\']?\s*)?\]')
+    XPATH_STEP = re.compile(r'(//|/)([\w-]+|\*)')
+    XPATH_PREDICATE = re.compile(r'\[\s*(?:(\d+)|@([\w-]+)(?:\s*=\s*["\']([^"\']*)["\'])?|'
+                                 r'contains\(\s*@([\w-]+)\s*,\s*["\']([^"\']*)["\']\s*\))\s*\]')
+
+    def __init__(self, expr: str):
+        self._expr = expr
+        # 多个选择器（CSS的逗号分隔）[[Step]]
+        self._paths = []
+        self._extract = (self.TEXT, None)
+        if expr.lstrip().startswith(('/', './')):
+            self.compile_xpath(expr.strip())
+        else:
+            self.compile_css(expr.strip())
+
+    @property
+    def expr(self):
+        return self._expr
+
+    def compile_css(self, expr):
+        m = re.search(r'::(text|html|attr\(\s*([\w-]+)\s*\))$', expr)
+        if m:
+            expr = expr[:m.start()]
+            if m.group(1) == 'text':
+                self._extract = (self.OWN_TEXT, None)
+            elif m.group(1) == 'html':
+                self._extract = (self.HTML, None)
+            else:
+                self._extract = (self.ATTR, m.group(2))
+        for part in expr.split(','):
+            steps, axis, pos, part = [], Step.DESCENDANT, 0, part.strip()
+            step = None
+            while pos < len(part):
+                t = self.CSS_TOKEN.match(part, pos)
+                if not t or t.end() == pos:
+                    raise ValueError('Invalid css selector: {}'.format(self._expr))
+                pos = t.end()
+                if t.group(1) or t.group(2):
+                    axis, step = (Step.CHILD if t.group(1) else Step.DESCENDANT), None
+                    continue
+                if step is None:
+                    step = Step(axis)
+                    steps.append(step)
+                token = t.group(3)
+                if token is None:
+                    step.conditions.append((t.group(4), t.group(5), t.group(6)))
+                elif token.startswith('#'):
+                    step.conditions.append(('id', '=', token[1:]))
+                elif token.startswith('.'):
+                    step.conditions.append(('class', '~=', token[1:]))
+                else:
+                    step.tag = token.lower()
+            if not steps:
+                raise ValueError('Invalid css selector: {}'.format(self._expr))
+            self._paths.append(steps)
+
+    def compile_xpath(self, expr):
+        expr = expr[1:] if expr.startswith('./') else expr
+        m = re.search(r'/(text\(\)|@([\w-]+))$', expr)
+        if m:
+            expr = expr[:m.start()]
+            self._extract = (self.OWN_TEXT, None) if m.group(2) is None else (self.ATTR, m.group(2))
+        steps, pos = [], 0
+        while pos < len(expr):
+            # 逐段匹配，不支持的语法（轴、函数、逻辑运算等）不能跳过，否则选择错误的元素
+            m = self.XPATH_STEP.match(expr, pos)
+            if not m:
+                raise ValueError('Invalid xpath selector: {}'.format(self._expr))
+            step = Step(Step.DESCENDANT if m.group(1) == '//' else Step.CHILD, m.group(2).lower())
+            pos = m.end()
+            while pos < len(expr) and expr[pos] == '[':
+                p = self.XPATH_PREDICATE.match(expr, pos)
+                if not p:
+                    raise ValueError('Invalid xpath selector: {}'.format(self._expr))
+                pos = p.end()
+                if p.group(1):
+                    step.position = int(p.group(1))
+                elif p.group(2):
+                    step.conditions.append((p.group(2), '=' if p.group(3) is not None else None, p.group(3)))
+                else:
+                    step.conditions.append((p.group(4), '*=', p.group(5)))
+            steps.append(step)
+        if not steps:
+            raise ValueError('Invalid xpath selector: {}'.format(self._expr))
+        self._paths.append(steps)
+
+    def select(self, context: HtmlElement) -> list:
+        """
+        在元素（子树）上查找所有匹配的元素，按文档顺序返回
+        :param context:
+        :return:
+        """
+        ret = []
+        for steps in self._paths:
+            elements = [context]
+            for step in steps:
+                elements = step.apply(elements)
+                if not elements:
+                    break
+            ret.extend(elements)
+        if len(self._paths) > 1:
+            ret.sort(key=lambda e: e.start)
+        return ret
+
+    def extract(self, element: HtmlElement):
+        kind, name = self._extract
+        if kind == self.ATTR:
+            return element.attrs.get(name)
+        if kind == self.HTML:
+            return element.html
+        if kind == self.OWN_TEXT:
+            return element.own_text.strip()
+        return element.text.strip()
+
+    def iter_values(self, context: HtmlElement):
+        """
+        逐个产生匹配元素及其取值
+        :param context:
+        :return: (value, element)
+        """
+        for element in self.select(context):
+            value = self.extract(element)
+            if value is not None:
+                yield value, element
+
+    @classmethod
+    def compile(cls, expr: str):
+        try:
+            return cls(expr)
+        except ValueError as e:
+            logger.error(e)
+            return None
+
+
+def test_selector():
+    root = parse_html('<div class="list a" id="x"><a href="/1">one</a><a href="/2">two</a><br></div>'
+                      '<div class="b"><p>text <b>bold</b></p><a href="/3">three</a></div>')
+    assert [v for v, _ in Selector('//div/a/@href').iter_values(root)] == ['/1', '/2', '/3']
+    assert [v for v, _ in Selector('//div[@class="b"]/a').iter_values(root)] == ['three']
+    assert [v for v, _ in Selector("//div[contains(@class,'list')]/a[2]/text()").iter_values(root)] == ['two']
+    assert [v for v, _ in Selector('//p/text()').iter_values(root)] == ['text']
+    assert [v for v, _ in Selector('//p').iter_values(root)] == ['text bold']
+    assert [v for v, _ in Selector('div.a > a::attr(href)').iter_values(root)] == ['/1', '/2']
+    assert [v for v, _ in Selector('#x a, .b a::text').iter_values(root)] == ['one', 'two', 'three']
+    assert [e.tag for e in Selector('div[id] > *').select(root)] == ['a', 'a', 'br']
+
+    # 不支持的语法必须报错，不能忽略后选择错误的元素
+    for expr in ['//div[last()]/a', '//div[@class="a" and @id="b"]', '//div[position()<3]',
+                 '//div/following-sibling::p', '//div[1', '//a | //p', '//']:
+        try:
+            Selector(expr)
+            assert False, expr
+        except ValueError:
+            pass
+        assert Selector.compile(expr) is None
+
+
+if __name__ == '__main__':
+    test_selector()
@@ -0,0 +1,174 @@
+import re
+import json
+
+from common.log import logger
+
+"""
+JSON路径，用于JSON路径解析节点（Keys.JSON_PATH）
+每次解析只将接口返回的JSON解析一次，所有JSON路径节点共享，子节点在匹配的值上继续查找
+支持：$（根，子节点中为当前值）, .key, ['key'], [n], [-n], [*], .*, ..key（递归查找）
+例如：'$.data.items[*].title', '$..skuId'
+"""
+
+# JSONP: callback({...});
+JSONP_PATTERN = re.compile(r'^\s*[\w$.]+\s*\(([\s\S]*)\)\s*;?\s*$')
+
+
+class JsonValue(object):
+    """
+    JSON路径匹配的值，作为子节点的解析内容
+    """
+
+    def __init__(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        return self._value
+
+    @property
+    def text(self) -> str:
+        """
+        匹配值的文本形式，字符串直接返回，其他值序列化为JSON
+        :return:
+        """
+        if isinstance(self._value, str):
+            return self._value
+        return json.dumps(self._value, ensure_ascii=False)
+
+    def __str__(self) -> str:
+        return self.text
+
+
+def loads(text: str):
+    """
+    解析JSON，支持JSONP格式
+    :param text:
+    :return: 解析失败时返回None
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        m = JSONP_PATTERN.match(text)
+        if m:
+            try:
+                return json.loads(m.group(1))
+            except ValueError:
+                pass
+    logger.error('Convert to json failed ! {}'.format(text[:256]))
+    return None
+
+
+class JsonPath(object):
+    CHILD = 0
+    INDEX = 1
+    WILDCARD = 2
+    DESCENDANT = 3
+
+    TOKEN = re.compile(r'(\.\.|\.)([\w$-]+|\*)|\.?\[\s*(\*|-?\d+|\'[^\']*\'|"[^"]*")\s*\]|(\.\.)')
+
+    def __init__(self, expr: str):
+        self._expr = expr
+        # [(kind, key)]
+        self._steps = []
+        expr = expr.strip()
+        if expr.startswith(('$', '@')):
+            expr = expr[1:]
+        elif expr and expr[0] not in '.[':
+            expr = '.' + expr
+
+        pos, descendant = 0, False
+        while pos < len(expr):
+            t = self.TOKEN.match(expr, pos)
+            if not t or t.end() == pos:
+                raise ValueError('Invalid json path: {}'.format(self._expr))
+            pos = t.end()
+            if t.group(4):
+                # ..[n] ..['key']
+                descendant = True
+                continue
+            if t.group(2) is not None:
+                key = t.group(2)
+                descendant = descendant or t.group(1) == '..'
+            else:
+                key = t.group(3)
+                if key[0] in '\'"':
+                    key = key[1:-1]
+                elif key != '*':
+                    key = int(key)
+            if descendant:
+                self._steps.append((self.DESCENDANT, key))
+            elif key == '*':
+                self._steps.append((self.WILDCARD, None))
+            elif isinstance(key, int):
+                self._steps.append((self.INDEX, key))
+            else:
+                self._steps.append((self.CHILD, key))
+            descendant = False
+
+    @property
+    def expr(self):
+        return self._expr
+
+    @classmethod
+    def compile(cls, expr: str):
+        try:
+            return cls(expr)
+        except ValueError as e:
+            logger.error(e)
+            return None
+
+    def find(self, data):
+        """
+        逐个产生所有匹配的值
+        :param data:
+        :return:
+        """
+        values = iter([data])
+        for kind, key in self._steps:
+            values = self.apply_step(values, kind, key)
+        return values
+
+    @classmethod
+    def apply_step(cls, values, kind, key):
+        for value in values:
+            if kind == cls.CHILD:
+                if isinstance(value, dict) and key in value:
+                    yield value[key]
+            elif kind == cls.INDEX:
+                if isinstance(value, list) and -len(value) <= key < len(value):
+                    yield value[key]
+            elif kind == cls.WILDCARD:
+                if isinstance(value, dict):
+                    yield from value.values()
+                elif isinstance(value, list):
+                    yield from value
+            else:
+                yield from cls.descend(value, key)
+
+    @classmethod
+    def descend(cls, value, key):
+        """
+        递归查找所有层级的key（或者所有子值）
+        :param value:
+        :param key:
+        :return:
+        """
+        stack = [value]
+        while stack:
+            v = stack.pop()
+            if isinstance(v, dict):
+                children = list(v.values())
+                if key == '*':
+                    yield from children
+                elif not isinstance(key, int) and key in v:
+                    yield v[key]
+            elif isinstance(v, list):
+                children = v
+                if key == '*':
+                    yield from children
+                elif isinstance(key, int) and -len(v) <= key < len(v):
+                    yield v[key]
+            else:
+                continue
+            stack.extend(reversed(children))
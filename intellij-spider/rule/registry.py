@@ -0,0 +1,83 @@
+import threading
+
+from rule.rule import Rule
+from common import util
+from common.log import logger
+
+
+class RuleRegistry(object):
+    """
+    进程内的解析规则注册表，
+    首次使用时一次性加载当前应用模板目录（apps/<app>/templates/）下的所有模板，
+    之后按名称返回共享的、不可修改的解析规则，避免每个子任务重复导入模板、重复生成规则
+    """
+    _lock = threading.Lock()
+    _rules = {}
+    _missing = set()
+    _loaded = False
+
+    @classmethod
+    def load_all(cls):
+        """
+        加载模板目录下的所有模板，只执行一次
+        :return:
+        """
+        if cls._loaded:
+            return
+        with cls._lock:
+            if cls._loaded:
+                return
+            for name in util.get_rule_names():
+                cls._load(name)
+            logger.info('Load {} rules: {}'.format(len(cls._rules), sorted(cls._rules.keys())))
+            cls._loaded = True
+
+    @classmethod
+    def _load(cls, name):
+        rule = None
+        try:
+            rule = Rule.find_by_name(name)
+        except Exception as e:
+            logger.error('Load rule failed, {} {}'.format(name, e))
+        if rule:
+            cls._rules[name] = rule.freeze()
+        else:
+            cls._missing.add(name)
+        return rule
+
+    @classmethod
+    def get(cls, name) -> Rule:
+        """
+        根据名称获取解析规则，规则不存在时返回None
+        :param name: 模板名称
+        :return:
+        """
+        cls.load_all()
+        rule = cls._rules.get(name)
+        if rule or not name:
+            return rule
+
+        with cls._lock:
+            rule = cls._rules.get(name)
+            if not rule and name not in cls._missing:
+                # 模板目录之外的模板（或者无法枚举模板目录时）按名称加载一次
+                rule = cls._load(name)
+                if not rule:
+                    logger.error('Cannot find rule by name: {}'.format(name))
+        return rule
+
+    @classmethod
+    def exists(cls, name):
+        return cls.get(name) is not None
+
+    @classmethod
+    def names(cls):
+        cls.load_all()
+        return sorted(cls._rules.keys())
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._rules = {}
+            cls._missing = set()
+            cls._loaded = False
@@ -1,15 +1,87 @@
+import re
 import traceback
 
 from common import util
 from common.consts import *
 from common.log import logger
+from rule.scanner import MultiNodeScanner
+from rule.bytesregex import compile_bytes
+from rule.dom import Selector
+from rule.jsonpath import JsonPath
+from rule import batch
 from collections import defaultdict
 from enum import Enum
 
 
+# 变量引用：${various}
+VAR_PATTERN = re.compile(r'\${(\S+?)}')
+# 取值模板中的引用：$0,$1...$9 或者 ${various}
+QUERY_TOKEN_PATTERN = re.compile(r'\$(\d)|\${(\S+?)}')
+
+
+class QueryTemplate(object):
+    """
+    预编译的取值模板，例如：'$0', 'hello $1', 'http://www.test.com?p1=$1&p2=${page}'
+    加载规则时拆分为文本片段、分组引用（$n）和变量引用（${various}），解析时直接拼接
+    """
+    LITERAL = 0
+    GROUP = 1
+    VAR = 2
+
+    def __init__(self, query: str):
+        self._query = query
+        self._parts = []
+        self._var_names = []
+        pos = 0
+        for m in QUERY_TOKEN_PATTERN.finditer(query):
+            if m.start() > pos:
+                self._parts.append((self.LITERAL, query[pos:m.start()]))
+            if m.group(1) is not None:
+                self._parts.append((self.GROUP, int(m.group(1))))
+            else:
+                self._parts.append((self.VAR, m.group(2)))
+                self._var_names.append(m.group(2))
+            pos = m.end()
+        if pos < len(query):
+            self._parts.append((self.LITERAL, query[pos:]))
+
+    @property
+    def query(self):
+        return self._query
+
+    @property
+    def var_names(self):
+        return self._var_names
+
+    def render(self, g0, groups, get_var):
+        """
+        根据匹配结果拼接取值，未匹配的分组和未定义的变量保持原样
+        :param g0: 完整匹配内容，对应$0
+        :param groups: 分组匹配内容，对应$1...$n
+        :param get_var: 变量查询函数
+        :return:
+        """
+        ret = []
+        for kind, value in self._parts:
+            if kind == self.LITERAL:
+                ret.append(value)
+            elif kind == self.GROUP:
+                g = g0 if value == 0 else (groups[value - 1] if value <= len(groups) else None)
+                ret.append(g if isinstance(g, str) else '${}'.format(value))
+            else:
+                var_value = get_var(value)
+                ret.append(var_value if var_value else '${%s}' % value)
+        return ''.join(ret)
+
+
 class RegexItem(object):
     def __init__(self, regex: str, query: str):
         self._regex, self._query = regex, query
+        # 加载规则时预编译正则表达式和取值模板
+        self._pattern = re.compile(regex)
+        self._template = QueryTemplate(query)
+        # 网页编码 -> 字节正则（无法按字节匹配时为None）
+        self._bytes_patterns = {}
 
     @property
     def regex(self):
@@ -19,6 +91,24 @@ class RegexItem(object):
     def query(self):
         return self._query
 
+    @property
+    def pattern(self):
+        return self._pattern
+
+    @property
+    def template(self):
+        return self._template
+
+    def bytes_pattern(self, encoding: str):
+        """
+        获取指定编码的字节正则，用于直接匹配未解码的网页内容
+        :param encoding: 网页编码
+        :return: 无法按字节匹配时返回None
+        """
+        if encoding not in self._bytes_patterns:
+            self._bytes_patterns[encoding] = compile_bytes(self._regex, encoding)
+        return self._bytes_patterns[encoding]
+
 
 class RuleNode(object):
     """
@@ -33,8 +123,13 @@ class RuleNode(object):
         self._type = NodeType.NORMAL
         # 正则表达式
         self._regex_items = []
-        # 匹配结果取值
+        # 选择器，与正则表达式二选一
+        self._selectors = []
+        # JSON路径，与正则表达式二选一
+        self._json_paths = []
+        # 匹配结果取值（选择器节点使用）
         self._query = '$0'
+        self._query_template = QueryTemplate(self._query)
         # 正则匹配模式，匹配第一个/匹配所有
         self._search_mode = self.REGEX_FIND_1ST
         # 提取的链接后续应用的解析规则Rule
@@ -52,6 +147,19 @@ class RuleNode(object):
         # unicode字符转为utf8
         self._unicode_to_cn = False
         self._post_replaces = []
+        # 预编译的字符串替换链 [(pattern, repl)]
+        self._post_replace_chain = []
+        # 字符串替换链是否可以对"匹配所有"的结果批量执行
+        self._post_replace_batchable = True
+        # 子解析项的组合扫描器
+        self._scanner = None
+        # 冻结后不可修改，用于多个任务共享同一个解析规则
+        self._frozen = False
+
+    def __setattr__(self, key, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('Cannot modify frozen rule node: {}'.format(self._name))
+        super().__setattr__(key, value)
 
     @property
     def name(self):
@@ -77,6 +185,22 @@ class RuleNode(object):
     def regex_items(self, v):
         self._regex_items = v
 
+    @property
+    def selectors(self):
+        return self._selectors
+
+    @selectors.setter
+    def selectors(self, v):
+        self._selectors = v
+
+    @property
+    def json_paths(self):
+        return self._json_paths
+
+    @json_paths.setter
+    def json_paths(self, v):
+        self._json_paths = v
+
     @property
     def search_mode(self):
         return self._search_mode
@@ -100,6 +224,11 @@ class RuleNode(object):
     @query.setter
     def query(self, v):
         self._query = v
+        self._query_template = QueryTemplate(v)
+
+    @property
+    def query_template(self):
+        return self._query_template
 
     @property
     def source(self):
@@ -148,11 +277,47 @@ class RuleNode(object):
     @post_replaces.setter
     def post_replaces(self, v):
         self._post_replaces = v
+        self._post_replace_chain = [(re.compile(pr[0]), pr[1]) for pr in v
+                                    if isinstance(pr, (list, tuple)) and len(pr) >= 2]
+        self._post_replace_batchable = batch.is_chain_safe(self._post_replace_chain)
+
+    @property
+    def post_replace_chain(self):
+        return self._post_replace_chain
+
+    @property
+    def post_replace_batchable(self):
+        return self._post_replace_batchable
+
+    @property
+    def scanner(self):
+        return self._scanner
 
     def add_child(self, node):
         self._children.append(node)
+        self._scanner = None
         return self
 
+    def freeze(self):
+        """
+        冻结解析节点（包括所有子节点），冻结后的节点不可修改
+        :return:
+        """
+        for child in self._children:
+            child.freeze()
+        self._regex_items = tuple(self._regex_items)
+        self._selectors = tuple(self._selectors)
+        self._json_paths = tuple(self._json_paths)
+        self._children = tuple(self._children)
+        self._post_replaces = tuple(self._post_replaces)
+        self._post_replace_chain = tuple(self._post_replace_chain)
+        self._frozen = True
+        return self
+
+    @property
+    def frozen(self):
+        return self._frozen
+
     @classmethod
     def from_json(cls, data: dict):
         """
@@ -169,8 +334,25 @@ class RuleNode(object):
             regex_items = data.get(Keys.REGEX)
             if regex_items and isinstance(regex_items, (tuple, list)):
                 for item in regex_items:
-                    node.regex_items.append(RegexItem(item[0], item[1]))
-            else:
+                    try:
+                        node.regex_items.append(RegexItem(item[0], item[1]))
+                    except re.error as e:
+                        logger.error('Init rule error, invalid regex for item: {}, {} {}'.format(
+                            data[Keys.NAME], item[0], e))
+
+            selectors = data.get(Keys.SELECTOR)
+            if isinstance(selectors, str):
+                selectors = [selectors]
+            if selectors and isinstance(selectors, (tuple, list)):
+                node.selectors = [s for s in (Selector.compile(i) for i in selectors) if s]
+
+            json_paths = data.get(Keys.JSON_PATH)
+            if isinstance(json_paths, str):
+                json_paths = [json_paths]
+            if json_paths and isinstance(json_paths, (tuple, list)):
+                node.json_paths = [p for p in (JsonPath.compile(i) for i in json_paths) if p]
+
+            if not node.regex_items and not node.selectors and not node.json_paths:
                 logger.info('Init rule warning, invalid regex for item: {}'.format(data[Keys.NAME]))
 
             query = data.get(Keys.QUERY)
@@ -209,6 +391,7 @@ class RuleNode(object):
             if items:
                 for item in items:
                     node.children.append(cls.from_json(item))
+                node._scanner = MultiNodeScanner.build(node.children)
         except Exception as e:
             logger.error('Generate rule error from json, {} {}'.format(e, data))
             traceback.print_exc()
@@ -228,14 +411,49 @@ class Rule(object):
     def __init__(self, name):
         self._nodes = []
         self._name = name
+        # 解析节点的组合扫描器
+        self._scanner = None
+        self._frozen = False
+
+    def __setattr__(self, key, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('Cannot modify frozen rule: {}'.format(self._name))
+        super().__setattr__(key, value)
 
     def add_node(self, node: RuleNode):
         self._nodes.append(node)
+        self._scanner = None
+
+    def freeze(self):
+        """
+        冻结解析规则，冻结后的规则不可修改，可以在多个任务、多个线程之间共享
+        :return:
+        """
+        for node in self._nodes:
+            if node:
+                node.freeze()
+        self._nodes = tuple(self._nodes)
+        self._frozen = True
+        return self
+
+    @property
+    def frozen(self):
+        return self._frozen
+
+    def __reduce_ex__(self, protocol):
+        # 共享的规则跨进程传递时只传递名称，由接收进程的规则注册表提供实例
+        if self._frozen:
+            return _find_shared_rule, (self._name,)
+        return super().__reduce_ex__(protocol)
 
     @property
     def nodes(self):
         return self._nodes
 
+    @property
+    def scanner(self):
+        return self._scanner
+
     @property
     def name(self):
         return self._name
@@ -248,13 +466,24 @@ class Rule(object):
         rule = Rule(rule_name)
         for item in data:
             rule.add_node(RuleNode.from_json(item))
+        rule._scanner = MultiNodeScanner.build(rule.nodes)
         return rule
 
     @classmethod
     def find_by_name(cls, rule_name):
+        """
+        根据模板名称加载并生成新的解析规则，共享的规则实例请使用RuleRegistry.get
+        :param rule_name:
+        :return:
+        """
         return cls.from_json(rule_name, util.get_rule(rule_name))
 
 
+def _find_shared_rule(name):
+    from rule.registry import RuleRegistry
+    return RuleRegistry.get(name)
+
+
 class RuleNodeFunction(object):
     def __init__(self, rule):
         self._rule = rule
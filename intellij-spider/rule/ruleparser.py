@@ -1,9 +1,20 @@
 import re
 import json
+import time
 import datetime
-from rule.rule import RuleNode, Rule
+import itertools
+from rule.rule import RuleNode, Rule, RegexItem, VAR_PATTERN
 from common.consts import Keys, NodeType, Source
+from common.content import RawContent
 from common.log import logger
+from rule.dom import HtmlElement, parse_html
+from rule.jsonpath import JsonValue, loads
+from rule import budget as regex_budget
+from rule.budget import RegexBudget, RegexTimeout, RegexOffenders
+from rule.stats import RegexStats
+from rule import batch
+
+HTML_TAG_PATTERN = re.compile('<[^>]+?>')
 
 
 class RuleParserResult(object):
@@ -20,16 +31,62 @@ class RuleParserResult(object):
         return self._linked_urls
 
 
+class ParseEvent(object):
+    """
+    流式解析事件
+    """
+    # 提取的新链接，key：链接，value：解析规则名称
+    LINK = 'link'
+    # 顶层"匹配所有"节点解析出的一条记录，key：节点名称，value：记录
+    RECORD = 'record'
+    # 顶层节点的解析结果，key：节点名称，value：解析结果
+    FIELD = 'field'
+    # 完整的解析结果，最后一个事件，value：包装后的解析结果
+    DATA = 'data'
+
+    def __init__(self, kind, key, value):
+        self.kind = kind
+        self.key = key
+        self.value = value
+
+
 class RuleParser(object):
     """
     内容解析器，对上下文应用指定的规则进行解析，
+    支持流式解析（iter_parse），解析过程中逐个产生提取的链接和记录
     """
 
-    def __init__(self, rule: Rule, content: str, url: str):
+    def __init__(self, rule: Rule, content: (str, RawContent), url: str, combined_scan=False, regex_timeout=0,
+                 adaptive_order=False, profiler=None):
+        """
+        :param rule: 解析规则
+        :param content: 被解析内容，字符串或者原始网页内容（按字节匹配，只解码匹配到的内容）
+        :param url: 内容对应的链接
+        :param combined_scan: 是否将同级节点的正则合并为一次扫描
+        :param regex_timeout: 每个顶层节点（包括子节点）正则匹配的时间预算（秒），0表示不限制
+        :param adaptive_order: "匹配第一个"节点的备选正则项是否按历史命中率排序后尝试
+        :param profiler: 性能统计，每个节点解析结束后调用profiler.record(节点, 耗时, 解析结果)
+        :raise RuntimeError: 设置了regex_timeout，但没有安装regex模块
+        """
+        if regex_timeout:
+            regex_budget.require_regex()
         self._rule = rule
         self._content = content
         self._url = url
         self._vars = {}
+        self._combined_scan = combined_scan
+        self._regex_timeout = regex_timeout
+        self._adaptive_order = adaptive_order
+        self._profiler = profiler
+        # 当前解析节点的时间预算
+        self._budget = None
+        # 网页解析后的HTML树，所有选择器节点共享
+        self._tree = None
+        # 接口返回内容解析后的JSON，所有JSON路径节点共享
+        self._json = None
+        self._json_loaded = False
+        # 提取的所有链接，k：链接，v：解析规则名称
+        self._links = {}
 
     def get_var(self, k):
         return self._vars.get(k)
@@ -40,13 +97,108 @@ class RuleParser(object):
             logger.warn('Warning, overwrite existed key:{} {} {}'.format(k, self._vars.get(k), v))
         self._vars[k] = v
 
+    def get_element(self, content) -> HtmlElement:
+        """
+        获取选择器的查找范围：网页内容只解析为HTML树一次，子节点直接使用父节点匹配的元素（子树）
+        :param content:
+        :return:
+        """
+        if isinstance(content, HtmlElement):
+            return content
+        if content is self._content:
+            if self._tree is None:
+                self._tree = parse_html(content.text if isinstance(content, RawContent) else content)
+            return self._tree
+        return parse_html(str(content))
+
+    def get_json(self, content):
+        """
+        获取JSON路径的查找对象：接口返回内容只解析一次，子节点直接使用父节点匹配的值
+        :param content:
+        :return:
+        """
+        if isinstance(content, JsonValue):
+            return content.value
+        if content is self._content:
+            if not self._json_loaded:
+                self._json = loads(content.text if isinstance(content, RawContent) else content)
+                self._json_loaded = True
+            return self._json
+        return loads(str(content))
+
+    @classmethod
+    def as_text(cls, content):
+        """
+        正则节点匹配的内容：元素的HTML，JSON值的文本
+        :param content:
+        :return:
+        """
+        if isinstance(content, (HtmlElement, JsonValue)):
+            return content.html if isinstance(content, HtmlElement) else content.text
+        return content
+
+    def scan_nodes(self, scanner, content):
+        """
+        同级节点组合扫描，未开启组合扫描时返回空
+        :param scanner: 同级节点的组合扫描器
+        :param content:
+        :return: {id(node): 各个正则项的第一个匹配}
+        """
+        if not self._combined_scan or not scanner or not content:
+            return {}
+        if self._budget is not None:
+            # 节点内的组合扫描使用节点的时间预算，超时由节点处理
+            return scanner.scan(self.as_text(content), self._budget)
+        try:
+            return scanner.scan(self.as_text(content), self.new_budget())
+        except RegexTimeout as e:
+            # 组合扫描超时后各个节点单独匹配
+            RegexOffenders.record(self._rule.name, 'combined_scan', self._url, e)
+            return {}
+
+    def new_budget(self):
+        return RegexBudget(self._regex_timeout) if self._regex_timeout and self._regex_timeout > 0 else None
+
+    def add_link(self, url, rule_name):
+        """
+        提取的链接加入链接集合，同一个链接只保留第一次提取时的解析规则
+        :param url:
+        :param rule_name:
+        :return: 是否是新的链接
+        """
+        if url in self._links:
+            if self._links[url] != rule_name:
+                logger.warn('Ignore duplicated link with different rule: {} {} {}'.format(
+                    url, self._links[url], rule_name))
+            return False
+        self._links[url] = rule_name
+        return True
+
+    def emit_link(self, url, rule_name):
+        if self.add_link(url, rule_name):
+            yield ParseEvent(ParseEvent.LINK, url, rule_name)
+
     def parse(self) -> RuleParserResult:
-        ret, link_items = {}, {}
+        data = None
+        for event in self.iter_parse():
+            if event.kind == ParseEvent.DATA:
+                data = event.value
+        return RuleParserResult(data, self._links)
+
+    def iter_parse(self):
+        """
+        流式解析，解析过程中逐个产生ParseEvent：
+        提取的新链接（LINK）、顶层"匹配所有"节点的每条记录（RECORD）、顶层节点的解析结果（FIELD），
+        最后产生完整的解析结果（DATA）
+        :return:
+        """
+        ret = {}
+        scanned = self.scan_nodes(self._rule.scanner, self._content)
         for node in self._rule.nodes:
-            k, v, items = self.parse_node(node, self._content)
+            k, v = yield from self.parse_top_node(node, scanned.get(id(node)))
             if k and v:
                 ret[k] = v
-            link_items = {**link_items, **items}
+                yield ParseEvent(ParseEvent.FIELD, k, v)
 
         wrapped_result = {
             '_collectTime': datetime.datetime.now().isoformat(),
@@ -54,26 +206,64 @@ class RuleParser(object):
             '_rule': self._rule.name,
             '_source': ret
         }
-        return RuleParserResult(wrapped_result, link_items)
+        yield ParseEvent(ParseEvent.DATA, None, wrapped_result)
 
-    def parse_node(self, rule_node: RuleNode, content: str):
+    def parse_top_node(self, rule_node: RuleNode, matches: list = None):
+        """
+        在时间预算内解析顶层节点，正则匹配超时时中止该节点的解析，节点结果按失败处理并记录
+        :param rule_node:
+        :param matches: 组合扫描得到的各个正则项的第一个匹配
+        :return: (节点名称, 解析结果)
+        """
+        self._budget = self.new_budget()
+        try:
+            return (yield from self.parse_node(rule_node, self._content, matches, top=True))
+        except RegexTimeout as e:
+            RegexOffenders.record(self._rule.name, e.node or rule_node.name, self._url, e)
+            return rule_node.name if rule_node else None, None
+        finally:
+            self._budget = None
+
+    def parse_node(self, rule_node: RuleNode, content: str, matches: list = None, top=False):
+        """
+        解析一个节点，解析过程中产生提取链接等事件
+        :param rule_node:
+        :param content:
+        :param matches: 组合扫描得到的各个正则项的第一个匹配
+        :param top: 是否是顶层节点
+        :return: (节点名称, 解析结果)
+        """
+        if self._profiler is None or not rule_node:
+            return (yield from self.parse_node_content(rule_node, content, matches, top))
+        # 节点耗时包括子节点的耗时
+        start = time.perf_counter()
+        k, v = yield from self.parse_node_content(rule_node, content, matches, top)
+        self._profiler.record(rule_node, time.perf_counter() - start, v)
+        return k, v
+
+    def parse_node_content(self, rule_node: RuleNode, content: str, matches: list = None, top=False):
         if not rule_node:
-            return None, None, {}
+            return None, None
 
         if not content:
-            return rule_node.name, None, {}
+            return rule_node.name, None
 
         # 其他翻页提取
         if rule_node.type == NodeType.PAGE_FLIP:
             value, new_links = self.parse_node_page_flip(rule_node)
-            return rule_node.name, value, new_links
+            for url, rule_name in new_links.items():
+                yield from self.emit_link(url, rule_name)
+            return rule_node.name, value
 
         content = content if rule_node.source == Source.CONTENT else self._url
+        if not rule_node.selectors and not rule_node.json_paths:
+            # 正则节点匹配元素的HTML或者JSON值的文本
+            content = self.as_text(content)
         if rule_node.search_mode == RuleNode.REGEX_FIND_1ST:
-            value, new_links = self.parse_node_search_1st(rule_node, content)
+            value = yield from self.parse_node_search_1st(rule_node, content, matches)
         else:
-            value, new_links = self.parse_node_search_all(rule_node, content)
-        return rule_node.name, value, new_links
+            value = yield from self.parse_node_search_all(rule_node, content, top)
+        return rule_node.name, value
 
     def parse_node_page_flip(self, rule_node: RuleNode):
         """
@@ -162,31 +352,28 @@ class RuleParser(object):
     def get_page_url_pattern(self):
         return self.get_var(Keys.VAR_PAGE_URL_PATTERN.value) or ''
 
-    def parse_node_search_1st(self, node: RuleNode, content):
-        key, value, new_links = node.name, {}, {}
-        m = None
-        for item in node.regex_items:
-            # 查找第一个匹配
-            search_ret = re.search(item.regex, content)
-            if not search_ret:
-                logger.info('Regex match failed, re: {}, {}'.format(item.regex, self._url))
-                continue
-
-            g0, groups = search_ret.group(0), search_ret.groups()
-            # $0,$1...取值
-            m = self.query_content(item.query, g0, groups)
-            if m:
-                break
+    def parse_node_search_1st(self, node: RuleNode, content, matches: list = None):
+        """
+        查找第一个匹配
+        :param node:
+        :param content:
+        :param matches: 组合扫描得到的各个正则项的第一个匹配，为空时单独查找
+        :return:
+        """
+        m, scope = self.find_first(node, content, matches)
         if not m:
-            return None, {}
+            return None
 
         # 后处理，去除HTML标签等
         m = self.post_process(node, m)
         if not node.children:
             # 没有子解析项，直接输出匹配后的内容
-            if node.jsonfied:
+            if node.jsonfied and isinstance(scope, JsonValue):
+                # JSON路径匹配的值已经是JSON对象，不需要再次解析
+                m = scope.value
+            elif node.jsonfied:
                 try:
-                    m = json.loads(m, encoding='utf8')
+                    m = json.loads(m)
                 except Exception as e:
                     logger.error('Convert to json failed ! {}, {}'.format(m, e))
                     m = None
@@ -196,68 +383,222 @@ class RuleParser(object):
             # 当前解析节点需要提取链接
             if node.type == NodeType.LINK:
                 if isinstance(m, str):
-                    new_links[m] = node.link_rule
+                    yield from self.emit_link(m, node.link_rule)
                 elif isinstance(m, list):
                     for mi in m:
-                        new_links[mi] = node.link_rule
+                        yield from self.emit_link(mi, node.link_rule)
         else:
-            # 有子解析项
-            value, new_links = self.parse_child_nodes(node.children, m)
-        return value, new_links
+            # 有子解析项，选择器/JSON路径节点的子节点在匹配的元素/值上解析
+            value = yield from self.parse_child_nodes(node.children, m if scope is None else scope, node.scanner)
+        return value
 
-    def parse_node_search_all(self, rule_node, content):
-        key, value, new_links = rule_node.name, [], {}
+    def parse_node_search_all(self, rule_node, content, top=False):
+        """
+        查找所有匹配，匹配结果逐个解析，解析过程中产生提取链接等事件，顶层节点同时产生每条记录
+        :param rule_node:
+        :param content:
+        :param top: 是否是顶层节点
+        :return:
+        """
+        value = []
+        matches = self.iter_matches(rule_node, content)
 
-        m = []
-        for item in rule_node.regex_items:
-            # 查找第一个匹配, 用于保存$0
-            search_ret = re.search(item.regex, content)
+        if not rule_node.children:
+            # 没有子解析项，直接输出匹配后的内容；匹配结果按批次取出，每批批量后处理（去除HTML标签等）后逐个输出
+            while True:
+                chunk = list(itertools.islice(matches, batch.BATCH_SIZE))
+                if not chunk:
+                    break
+                processed = self.post_process_all(rule_node, [i for i, scope in chunk])
+                for m_item, (i, scope) in zip(processed, chunk):
+                    v = m_item
+                    if rule_node.jsonfied:
+                        # JSON路径匹配的值已经是JSON对象，不需要再次解析
+                        v = scope.value if isinstance(scope, JsonValue) else loads(m_item)
+                    value.append(v)
+                    # 当前解析节点需要提取链接
+                    if rule_node.type == NodeType.LINK:
+                        yield from self.emit_link(m_item, rule_node.link_rule)
+                    if top:
+                        yield ParseEvent(ParseEvent.RECORD, rule_node.name, v)
+        else:
+            # 有子解析项，逐个匹配结果应用子解析规则（不等待所有匹配），然后合并结果
+            for i, scope in matches:
+                m_item = self.post_process(rule_node, i)
+                child_content = m_item if scope is None else scope
+                child_rt = yield from self.parse_child_nodes(rule_node.children, child_content, rule_node.scanner)
+                value.append(child_rt)
+                if top:
+                    yield ParseEvent(ParseEvent.RECORD, rule_node.name, child_rt)
+        return value
+
+    def find_first(self, node: RuleNode, content, matches: list = None):
+        """
+        按顺序尝试各个正则项（或选择器），返回第一个取值不为空的匹配
+        :param node:
+        :param content:
+        :param matches: 组合扫描得到的各个正则项的第一个匹配，为空时单独查找
+        :return: ($0,$1...取值后的结果, 选择器匹配的元素)
+        """
+        if node.selectors:
+            context = self.get_element(content)
+            for selector in node.selectors:
+                for g0, element in selector.iter_values(context):
+                    m = node.query_template.render(g0, (), self.get_var)
+                    if m:
+                        return m, element
+                    break
+                else:
+                    logger.info('Selector match failed, selector: {}, {}'.format(selector.expr, self._url))
+            return None, None
+
+        if node.json_paths:
+            data = self.get_json(content)
+            for path in node.json_paths:
+                for v in path.find(data):
+                    if v is None:
+                        continue
+                    value = JsonValue(v)
+                    m = node.query_template.render(value.text, (), self.get_var)
+                    if m:
+                        return m, value
+                    break
+                else:
+                    logger.info('Json path match failed, path: {}, {}'.format(path.expr, self._url))
+            return None, None
+
+        # 只有按命中率排序时才统计命中次数（只有一个正则项时不需要排序）
+        adaptive = self._adaptive_order and len(node.regex_items) > 1
+        items = RegexStats.order(self._rule.name, node) if adaptive else enumerate(node.regex_items)
+        for i, item in items:
+            # 查找第一个匹配
+            if matches is not None:
+                search_ret = matches[i]
+            else:
+                try:
+                    search_ret = self.search(item, content, self._budget)
+                except RegexTimeout as e:
+                    e.node = node.name
+                    raise
             if not search_ret:
                 logger.info('Regex match failed, re: {}, {}'.format(item.regex, self._url))
+                if adaptive:
+                    RegexStats.record(self._rule.name, node.name, item.regex, False)
                 continue
-            # 需要查找所有匹配的场景，返回数组
-            result = re.findall(item.regex, content)
 
-            if not result:
-                logger.info('{} parse failed'.format(rule_node.name))
-            else:
-                # $0,$1...取值
-                result = [self.query_content_for_multi(item.query, groups, groups) for groups in result]
-                m.extend(result)
+            g0, groups = search_ret
+            # $0,$1...取值
+            m = self.query_content(item, g0, groups)
+            if adaptive:
+                RegexStats.record(self._rule.name, node.name, item.regex, bool(m))
+            if m:
+                return m, None
+        return None, None
 
-        # 后处理，去除HTML标签等
-        m = [self.post_process(rule_node, content=i) for i in m]
+    def iter_matches(self, rule_node: RuleNode, content):
+        """
+        依次对每个正则项（或选择器）查找所有匹配，逐个产生$0,$1...取值后的结果，
+        每个正则项只扫描一遍内容，$0为完整匹配内容，$1...$n为分组内容；
+        选择器的$0为元素的取值，同时产生匹配的元素，用于子节点解析
+        :param rule_node:
+        :param content:
+        :return: (取值结果, 选择器匹配的元素)
+        """
+        if rule_node.selectors:
+            context = self.get_element(content)
+            for selector in rule_node.selectors:
+                matched = False
+                for g0, element in selector.iter_values(context):
+                    matched = True
+                    yield rule_node.query_template.render(g0, (), self.get_var), element
+                if not matched:
+                    logger.info('Selector match failed, selector: {}, {}'.format(selector.expr, self._url))
+            return
+
+        if rule_node.json_paths:
+            data = self.get_json(content)
+            for path in rule_node.json_paths:
+                matched = False
+                for v in path.find(data):
+                    if v is None:
+                        continue
+                    matched = True
+                    value = JsonValue(v)
+                    yield rule_node.query_template.render(value.text, (), self.get_var), value
+                if not matched:
+                    logger.info('Json path match failed, path: {}, {}'.format(path.expr, self._url))
+            return
 
-        if not rule_node.children:
-            # 没有子解析项，直接输出匹配后的内容
-            value = m if not rule_node.jsonfied else [json.loads(i, encoding='utf8') for i in m]
-            # 当前解析节点需要提取链接
-            if rule_node.type == NodeType.LINK:
-                for m_item in m:
-                    new_links[m_item] = rule_node.link_rule
-        else:
-            # 有子解析项，遍历所有匹配的结果，每个结果应用子解析规则，然后合并结果
-            for m_item in m:
-                child_rt, child_links = self.parse_child_nodes(rule_node.children, m_item)
-                value.append(child_rt)
-                new_links = {**new_links, **child_links}
-        return value, new_links
+        for item in rule_node.regex_items:
+            matched = False
+            try:
+                for g0, groups in self.finditer(item, content, self._budget):
+                    matched = True
+                    # 没有分组时$1同$0，与之前findall的取值方式保持一致
+                    yield self.query_content(item, g0, groups or (g0,)), None
+            except RegexTimeout as e:
+                e.node = rule_node.name
+                raise
+            if not matched:
+                logger.info('Regex match failed, re: {}, {}'.format(item.regex, self._url))
 
-    def parse_child_nodes(self, children, content):
-        ret, linked_urls = {}, {}
+    @classmethod
+    def search(cls, item: RegexItem, content, budget: RegexBudget = None):
+        """
+        查找第一个匹配，原始网页内容优先按字节匹配，只解码匹配到的内容
+        :param item:
+        :param content: 字符串或者原始网页内容
+        :param budget: 时间预算，超时抛出RegexTimeout
+        :return: (g0, groups)，没有匹配时返回None
+        """
+        if isinstance(content, RawContent):
+            pattern = item.bytes_pattern(content.encoding)
+            if pattern is None:
+                return cls.search(item, content.text, budget)
+            m = regex_budget.search(pattern, content.body, budget)
+            if not m:
+                return None
+            return content.decode(m.group(0)), tuple(content.decode(g) for g in m.groups())
+
+        m = regex_budget.search(item.pattern, content, budget)
+        return (m.group(0), m.groups()) if m else None
+
+    @classmethod
+    def finditer(cls, item: RegexItem, content, budget: RegexBudget = None):
+        """
+        逐个产生所有匹配，原始网页内容优先按字节匹配，只解码匹配到的内容
+        :param item:
+        :param content: 字符串或者原始网页内容
+        :param budget: 时间预算，超时抛出RegexTimeout
+        :return: (g0, groups)
+        """
+        if isinstance(content, RawContent):
+            pattern = item.bytes_pattern(content.encoding)
+            if pattern is None:
+                yield from cls.finditer(item, content.text, budget)
+                return
+            for m in regex_budget.finditer(pattern, content.body, budget):
+                yield content.decode(m.group(0)), tuple(content.decode(g) for g in m.groups())
+            return
+
+        for m in regex_budget.finditer(item.pattern, content, budget):
+            yield m.group(0), m.groups()
+
+    def parse_child_nodes(self, children, content, scanner=None):
+        ret = {}
+        scanned = self.scan_nodes(scanner, content)
         for rule in children:
-            k, v, items = self.parse_node(rule, content)
+            # 子节点提取的链接直接加入链接集合
+            k, v = yield from self.parse_node(rule, content, scanned.get(id(rule)))
             if k and v:
                 # 合并各个子节点解析的结果
                 ret[k] = v
-            # 合并各个子节点解析提取的链接
-            linked_urls = {**linked_urls, **items}
-        return ret, linked_urls
+        return ret
 
     def post_process(self, rule: RuleNode, content: str):
         ret = content
         if rule.remove_html:
-            ret = re.sub('<[^>]+?>', '', ret)
+            ret = HTML_TAG_PATTERN.sub('', ret)
             ret = ret.strip()
         ret = ret.replace('&nbsp;', '').replace('\n\n', '')
 
@@ -266,10 +607,8 @@ class RuleParser(object):
             ret = ret.encode().decode('unicode_escape')
 
         # 字符串替换处理
-        if rule.post_replaces:
-            for pr in rule.post_replaces:
-                if isinstance(pr, (list, tuple)) and len(pr) >= 2:
-                    ret = re.sub(pr[0], pr[1], ret)
+        for pattern, repl in rule.post_replace_chain:
+            ret = pattern.sub(repl, ret)
 
         # 变量替换
         ret = self.replace_vars(ret)
@@ -280,31 +619,65 @@ class RuleParser(object):
             ret = rule.function(self)(ret)
         return ret
 
-    def query_content(self, query, content, groups):
-        if isinstance(content, str):
-            query = query.replace('$0', content)
+    def post_process_all(self, rule: RuleNode, contents: list) -> list:
+        """
+        批量后处理"匹配所有"的结果，结果与逐个后处理一致，无法保证一致时逐个后处理
+        :param rule:
+        :param contents:
+        :return:
+        """
+        ret = None
+        if len(contents) > 1 and rule.post_replace_batchable:
+            ret = self.batch_post_process(rule, contents)
+        if ret is None:
+            ret = [self.post_process(rule, i) for i in contents]
+        return ret
+
+    def batch_post_process(self, rule: RuleNode, contents: list):
+        """
+        所有结果以分隔符连接，每个处理步骤只执行一次，然后按分隔符拆分
+        :param rule:
+        :param contents:
+        :return: 结果中包含分隔符，或者处理后分隔符个数改变时返回None
+        """
+        sep, n = batch.SEPARATOR, len(contents)
+        ret = sep.join(contents)
+        if ret.count(sep) != n - 1:
+            return None
+        if rule.remove_html:
+            ret = batch.HTML_TAG_PATTERN.sub('', ret)
+            ret = batch.STRIP_PATTERN.sub(sep, ret).strip()
+        ret = ret.replace('&nbsp;', '').replace('\n\n', '')
+
+        # Unicode转中文，结果以反斜杠结尾时转义会跨越分隔符
+        if rule.unicode_to_cn:
+            if ret.endswith('\\') or '\\' + sep in ret:
+                return None
+            try:
+                ret = ret.encode().decode('unicode_escape')
+            except UnicodeDecodeError:
+                return None
 
-        if isinstance(groups, (list, tuple)):
-            for i, g in enumerate(groups):
-                if isinstance(groups[i], str):
-                    query = query.replace('${}'.format(i + 1), groups[i])
+        # 字符串替换处理
+        for pattern, repl in rule.post_replace_chain:
+            ret = pattern.sub(repl, ret)
 
-        query = self.replace_vars(query)
-        return query
+        has_vars = '${' in ret
+        ret = ret.split(sep)
+        if len(ret) != n:
+            return None
 
-    def query_content_for_multi(self, query, content, groups):
-        if '$0' in query:
-            return query.replace('$0', content)
+        # 变量替换
+        if has_vars:
+            ret = [self.replace_vars(i) for i in ret]
 
-        if isinstance(groups, str):
-            query = query.replace('$1', groups)
+        # 执行自定义函数, 函数必须最后执行
+        if rule.function:
+            ret = [rule.function(self)(i) for i in ret]
+        return ret
 
-        if isinstance(groups, (list, tuple)):
-            for i, g in enumerate(groups):
-                if isinstance(groups[i], str):
-                    query = query.replace('${}'.format(i + 1), groups[i])
-        query = self.replace_vars(query)
-        return query
+    def query_content(self, item: RegexItem, content, groups):
+        return item.template.render(content, groups, self.get_var)
 
     def replace_vars(self, content: str):
         """
@@ -312,7 +685,9 @@ class RuleParser(object):
         :param content: 源内容
         :return:
         """
-        ret = re.findall('\${(\S+?)}', content)
+        if '${' not in content:
+            return content
+        ret = VAR_PATTERN.findall(content)
         if ret:
             for item in ret:
                 var_name = item.strip()
@@ -330,5 +705,77 @@ def test_replace_vars():
     assert result == 'hello-hello-bbbbb'
 
 
+def test_batch_post_process():
+    """
+    批量后处理的结果必须与逐个后处理一致
+    """
+    import random
+    rnd = random.Random(0)
+    pieces = ['<b>', '</b>', '<a href="x">', ' ', '\n', '\n\n', '&nbsp;', 'abc', '价格', '\\u4ef7', '\\', '${a}', '1']
+    replaces = [[], [['a', 'A']], [['[0-9]+', '#']], [['\\s+', '']], [['^a', '']], [['b(c)', '\\1\\1']]]
+    cp = RuleParser(Rule('app'), '', '')
+    cp.set_var('a', 'hello')
+    checked = 0
+    for _ in range(500):
+        node = RuleNode('n')
+        node.remove_html = rnd.random() < 0.5
+        node.unicode_to_cn = rnd.random() < 0.3
+        node.post_replaces = rnd.choice(replaces)
+        contents = [''.join(rnd.choice(pieces) for _ in range(rnd.randint(0, 6))) for _ in range(rnd.randint(2, 8))]
+        try:
+            expected = [cp.post_process(node, i) for i in contents]
+        except UnicodeDecodeError:
+            continue
+        ret = cp.batch_post_process(node, contents) if node.post_replace_batchable else None
+        if ret is not None:
+            checked += 1
+            assert ret == expected, (contents, ret, expected)
+        assert cp.post_process_all(node, contents) == expected
+    assert checked > 100
+
+
+def test_search_all_streaming():
+    """
+    "匹配所有"节点：没有子节点时按批次后处理，有子节点时逐个匹配结果解析，不等待所有匹配
+    """
+    count = batch.BATCH_SIZE * 2 + 3
+    content = ''.join('<li><b>{}</b></li>'.format(i) for i in range(count))
+    cp = RuleParser(Rule('app'), content, '')
+
+    leaf = RuleNode('items')
+    leaf.remove_html = True
+    leaf.regex_items.append(RegexItem('<li>(.*?)</li>', '$1'))
+    events = []
+    gen = cp.parse_node_search_all(leaf, content, top=True)
+    try:
+        while True:
+            events.append(next(gen))
+    except StopIteration as e:
+        value = e.value
+    assert value == [str(i) for i in range(count)]
+    assert [e.value for e in events] == value
+
+    produced = []
+    iter_matches = cp.iter_matches
+
+    def tracked(rule_node, c):
+        for m in iter_matches(rule_node, c):
+            produced.append(m)
+            yield m
+
+    cp.iter_matches = tracked
+    parent = RuleNode('rows')
+    parent.regex_items.append(RegexItem('<li>.*?</li>', '$0'))
+    child = RuleNode('b')
+    child.regex_items.append(RegexItem('<b>(.*?)</b>', '$1'))
+    parent.add_child(child)
+    gen = cp.parse_node_search_all(parent, content, top=True)
+    first = next(gen)
+    assert first.value == {'b': '0'}
+    assert len(produced) == 1
+
+
 if __name__ == '__main__':
     test_replace_vars()
+    test_batch_post_process()
+    test_search_all_streaming()
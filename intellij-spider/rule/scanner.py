@@ -0,0 +1,133 @@
+import re
+import threading
+
+from common.consts import NodeType, Source
+from common.content import RawContent
+from common.log import logger
+from rule import budget as regex_budget
+
+# 组合扫描无法处理的正则：分组反向引用、命名分组引用
+BACKREF_PATTERN = re.compile(r'\\[1-9]|\(\?P=')
+
+
+class MultiNodeScanner(object):
+    """
+    同级解析节点的组合扫描器，
+    将多个"匹配第一个"的同级节点的正则项合并为一个正则，扫描一遍内容即可得到每个正则项的第一个匹配，
+    每个正则项以前瞻断言(?=(...))的形式出现，匹配位置和分组与单独调用search的结果一致。
+    无法安全合并的节点（命名分组、反向引用、全局标志等）不参与组合扫描，仍然单独匹配
+    """
+
+    def __init__(self, nodes: list):
+        # 参与组合扫描的正则项 [(node, item_index, item)]
+        self._slots = []
+        self._nodes = set()
+        for node in nodes:
+            if self.is_combinable(node):
+                self._nodes.add(id(node))
+                for i, item in enumerate(node.regex_items):
+                    self._slots.append((node, i, item))
+        self._lock = threading.Lock()
+        # 剩余正则项组合 -> 编译后的组合正则
+        self._compiled = {}
+
+    @property
+    def size(self):
+        return len(self._slots)
+
+    @classmethod
+    def build(cls, nodes):
+        """
+        为同级节点生成组合扫描器，少于2个节点可以合并时返回None
+        :param nodes:
+        :return:
+        """
+        scanner = cls(nodes)
+        return scanner if len(scanner._nodes) >= 2 else None
+
+    @classmethod
+    def is_combinable(cls, node):
+        if not node or not node.regex_items:
+            return False
+        if node.search_mode != node.REGEX_FIND_1ST or node.type == NodeType.PAGE_FLIP:
+            return False
+        if node.source != Source.CONTENT:
+            return False
+        for item in node.regex_items:
+            if item.pattern.groupindex or item.pattern.flags & ~re.UNICODE or BACKREF_PATTERN.search(item.regex):
+                return False
+            try:
+                re.compile('(?=({}))'.format(item.regex))
+            except re.error:
+                return False
+        return True
+
+    def _compile(self, remaining: tuple, encoding: str = None):
+        """
+        编译剩余正则项的组合正则：前面是任意一项能匹配的前瞻，后面是每一项的可选捕获
+        :param remaining: 剩余正则项的下标
+        :param encoding: 网页编码，不为空时编译为字节正则
+        :return: (组合正则, [(正则项下标, 捕获分组序号)])
+        """
+        compiled = self._compiled.get((remaining, encoding))
+        if compiled:
+            return compiled
+
+        items = [self._slots[i][2] for i in remaining]
+        gate = '(?=(?:{}))'.format('|'.join('(?:{})'.format(item.regex) for item in items))
+        group_index = 1 + sum(item.pattern.groups for item in items)
+        captures, group_map = [], []
+        for i, item in zip(remaining, items):
+            captures.append('(?:(?=({}))|)'.format(item.regex))
+            group_map.append((i, group_index))
+            group_index += 1 + item.pattern.groups
+        source = gate + ''.join(captures)
+        compiled = re.compile(source.encode(encoding) if encoding else source), group_map
+        with self._lock:
+            self._compiled[(remaining, encoding)] = compiled
+        return compiled
+
+    def is_bytes_safe(self, encoding: str):
+        return all(item.bytes_pattern(encoding) is not None for node, i, item in self._slots)
+
+    def scan(self, content, budget=None) -> dict:
+        """
+        扫描内容，返回每个参与组合扫描的节点各个正则项的第一个匹配
+        :param content: 字符串或者原始网页内容RawContent
+        :param budget: 时间预算，超时抛出RegexTimeout
+        :return: {id(node): [(g0, groups) 或 None, ...]}，与node.regex_items一一对应
+        """
+        ret = {}
+        for node, i, item in self._slots:
+            ret.setdefault(id(node), [None] * len(node.regex_items))
+
+        encoding, decode = None, None
+        if isinstance(content, RawContent):
+            if self.is_bytes_safe(content.encoding):
+                encoding, decode = content.encoding, content.decode
+                content = content.body
+            else:
+                content = content.text
+
+        remaining, pos = tuple(range(len(self._slots))), 0
+        while remaining and pos <= len(content):
+            pattern, group_map = self._compile(remaining, encoding)
+            m = regex_budget.search(pattern, content, budget, pos)
+            if not m:
+                break
+            found = set()
+            for i, group_index in group_map:
+                g0 = m.group(group_index)
+                if g0 is None:
+                    continue
+                node, item_index, item = self._slots[i]
+                groups = m.groups()[group_index:group_index + item.pattern.groups]
+                if decode:
+                    g0, groups = decode(g0), tuple(decode(g) for g in groups)
+                ret[id(node)][item_index] = (g0, groups)
+                found.add(i)
+            # 未找到的正则项在当前位置不匹配，从下一个位置继续查找
+            remaining = tuple(i for i in remaining if i not in found)
+            pos = m.start() + 1
+        logger.debug('Combined scan {} regex items, {} not found'.format(len(self._slots), len(remaining)))
+        return ret
@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import contextlib
+
+from common.log import logger
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+"""
+正则项命中统计：记录每个模板节点的各个备选正则项（"匹配第一个"模式）的命中/未命中次数，
+解析时可以按命中率调整备选正则项的尝试顺序，统计保存到文件，多次运行（多个进程）累计。
+统计在后台线程定期保存，保存时加文件锁，重新读取文件合并其他进程保存的统计。
+查看统计，找出长期不命中的备选正则项：python -m rule.stats <统计文件>
+"""
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """
+    进程间的文件锁（<path>.lock）
+    :param path:
+    :return:
+    """
+    with open(path + '.lock', 'a+') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class RegexStats(object):
+    _lock = threading.Lock()
+    # k：(规则, 节点, 正则)，v：[命中次数, 未命中次数]，从统计文件加载的累计值
+    _counts = {}
+    # 本进程新增的统计，保存时合并到统计文件
+    _deltas = {}
+    # 正在保存的统计
+    _saving = {}
+    _path = None
+    # 同一时间只有一个线程保存
+    _save_lock = threading.Lock()
+    # 启动保存线程的进程，子进程（多进程应用）需要启动自己的保存线程
+    _saver_pid = None
+
+    # 自动保存间隔（秒）
+    SAVE_INTERVAL = 60
+    # 样本数少于该值的正则项保持声明顺序
+    MIN_SAMPLES = 20
+
+    @classmethod
+    def setup(cls, path: str):
+        """
+        指定统计文件，加载已有统计，进程退出时保存
+        :param path:
+        :return:
+        """
+        with cls._lock:
+            if cls._path == path:
+                return
+            cls._path = path
+            cls._counts = cls.read(path)
+        atexit.register(cls.save)
+        cls.start_saver()
+        logger.info('Load regex stats: {} items from {}'.format(len(cls._counts), path))
+
+    @classmethod
+    def start_saver(cls):
+        """
+        启动后台保存线程，每SAVE_INTERVAL秒保存一次
+        :return:
+        """
+        with cls._lock:
+            pid = os.getpid()
+            if cls._saver_pid == pid:
+                return
+            cls._saver_pid = pid
+
+        def run():
+            while True:
+                time.sleep(cls.SAVE_INTERVAL)
+                cls.save()
+
+        threading.Thread(target=run, name='regex_stats_saver', daemon=True).start()
+
+    @classmethod
+    def read(cls, path):
+        counts = {}
+        if not path or not os.path.exists(path):
+            return counts
+        try:
+            with open(path, encoding='utf8') as f:
+                for row in json.load(f):
+                    counts[(row['rule'], row['node'], row['regex'])] = [row['hits'], row['misses']]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error('Read regex stats failed, {} {}'.format(path, e))
+        return counts
+
+    @classmethod
+    def save(cls):
+        """
+        将本进程新增的统计合并到统计文件，文件读写不占用统计锁，不阻塞解析线程
+        :return:
+        """
+        with cls._save_lock:
+            with cls._lock:
+                path, deltas = cls._path, cls._deltas
+                if not path or not deltas:
+                    return
+                cls._deltas, cls._saving = {}, deltas
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                with file_lock(path):
+                    # 重新读取文件，合并其他进程保存的统计
+                    counts = cls.read(path)
+                    for key, (hits, misses) in deltas.items():
+                        c = counts.setdefault(key, [0, 0])
+                        c[0] += hits
+                        c[1] += misses
+                    rows = [{'rule': k[0], 'node': k[1], 'regex': k[2], 'hits': v[0], 'misses': v[1]}
+                            for k, v in counts.items()]
+                    tmp = '{}.{}.tmp'.format(path, os.getpid())
+                    with open(tmp, 'w', encoding='utf8') as f:
+                        json.dump(rows, f, ensure_ascii=False, indent=1)
+                    os.replace(tmp, path)
+            except OSError as e:
+                logger.error('Save regex stats failed, {} {}'.format(path, e))
+                # 保存失败，统计留到下次保存
+                with cls._lock:
+                    for key, (hits, misses) in deltas.items():
+                        c = cls._deltas.setdefault(key, [0, 0])
+                        c[0] += hits
+                        c[1] += misses
+                    cls._saving = {}
+                return
+            with cls._lock:
+                cls._counts, cls._saving = counts, {}
+
+    @classmethod
+    def record(cls, rule_name, node_name, regex, hit: bool):
+        key = (rule_name, node_name, regex)
+        with cls._lock:
+            c = cls._deltas.get(key)
+            if c is None:
+                c = cls._deltas[key] = [0, 0]
+            c[0 if hit else 1] += 1
+        if cls._path and cls._saver_pid != os.getpid():
+            cls.start_saver()
+
+    @classmethod
+    def get(cls, rule_name, node_name, regex):
+        """
+        :return: (命中次数, 未命中次数)
+        """
+        key = (rule_name, node_name, regex)
+        with cls._lock:
+            counts = [cls._counts.get(key), cls._saving.get(key), cls._deltas.get(key)]
+        counts = [c for c in counts if c]
+        return sum(c[0] for c in counts), sum(c[1] for c in counts)
+
+    @classmethod
+    def rate(cls, rule_name, node_name, regex):
+        """
+        命中率，样本不足时返回None
+        :return:
+        """
+        hits, misses = cls.get(rule_name, node_name, regex)
+        if hits + misses < cls.MIN_SAMPLES:
+            return None
+        return (hits + 1) / (hits + misses + 2)
+
+    @classmethod
+    def order(cls, rule_name, node):
+        """
+        按命中率从高到低排列节点的备选正则项，样本不足的正则项排在有统计的正则项之后，命中率相同时保持声明顺序
+        :param rule_name:
+        :param node:
+        :return: [(正则项下标, 正则项)]
+        """
+        items = list(enumerate(node.regex_items))
+        if len(items) < 2:
+            return items
+        rates = [cls.rate(rule_name, node.name, item.regex) for i, item in items]
+        if all(r is None for r in rates):
+            return items
+        return sorted(items, key=lambda i: (rates[i[0]] is None, -(rates[i[0]] or 0), i[0]))
+
+    @classmethod
+    def dump(cls):
+        """
+        :return: [(规则, 节点, 正则, 命中次数, 未命中次数, 命中率)]，按规则、节点排列
+        """
+        with cls._lock:
+            keys = set(cls._counts) | set(cls._saving) | set(cls._deltas)
+        rows = []
+        for key in sorted(keys):
+            hits, misses = cls.get(*key)
+            rows.append(key + (hits, misses, hits / (hits + misses) if hits + misses else 0))
+        return rows
+
+    @classmethod
+    def stale(cls, min_samples=100, max_rate=0.01):
+        """
+        长期不命中的备选正则项
+        :param min_samples: 最少样本数
+        :param max_rate: 最大命中率
+        :return:
+        """
+        return [row for row in cls.dump() if row[3] + row[4] >= min_samples and row[5] <= max_rate]
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._counts = {}
+            cls._saving = {}
+            cls._deltas = {}
+
+
+if __name__ == '__main__':
+    RegexStats._counts = RegexStats.read(sys.argv[1])
+    for rule, node, regex, hits, misses, rate in RegexStats.dump():
+        print('{:>6.1%} {:>8} {:>8}  {} / {}  {}'.format(rate, hits, misses, rule, node, regex))
+    print('\n-------------------- 长期不命中的正则项 --------------------')
+    for rule, node, regex, hits, misses, rate in RegexStats.stale():
+        print('{} / {}  {}'.format(rule, node, regex))
@@ -0,0 +1,342 @@
+import time
+import heapq
+import queue
+import threading
+from collections import deque
+
+from config import get_app_config, RateLimitMapping
+from common.cache import is_cached
+from common.log import logger
+from network.hoststats import get_host, HostConcurrency
+from network.retry import CircuitBreaker
+from task import Task
+
+
+class HostRateLimiter(object):
+    """
+    按域名限制请求频率，每个域名一个令牌桶（GCRA算法：只需要记录每个域名下一次请求的理论时间），
+    请求频率按URL配置（RateLimitMapping），
+    状态可以保存在多进程共享的字典中（multiprocessing.Manager），使所有进程的请求频率之和不超过限制
+    """
+
+    def __init__(self, mapping: RateLimitMapping = None, states=None, lock=None):
+        """
+        :param mapping: 请求频率配置
+        :param states: 域名 -> 理论请求时间，多进程共享时使用Manager().dict()
+        :param lock: 多进程共享时使用Manager().Lock()
+        """
+        self._mapping = mapping if mapping is not None else get_app_config().rate_limit_mapping
+        self._states = states if states is not None else {}
+        self._lock = lock if lock is not None else threading.Lock()
+
+    def acquire(self, url: str):
+        """
+        获取URL所在域名的一个令牌
+        :param url:
+        :return: (是否获取成功, 距离下一个令牌的时间（秒）)
+        """
+        interval, burst = self._mapping.get_url_rate(url)
+        if not interval or interval <= 0:
+            return True, 0
+        host = get_host(url)
+        tolerance = interval * (burst - 1)
+        with self._lock:
+            now = time.time()
+            tat = self._states.get(host, now)
+            if now < tat - tolerance:
+                return False, tat - tolerance - now
+            tat = max(tat, now) + interval
+            self._states[host] = tat
+        return True, max(tat - tolerance - now, 0)
+
+
+class DelayQueue(object):
+    """
+    延后执行的任务，按到期时间排序（堆），不加锁，由Scheduler在锁内使用
+    """
+
+    def __init__(self):
+        # (到期时间, 序号, 任务)
+        self._heap = []
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def put(self, task: Task, due: float):
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, task))
+
+    def next_due(self):
+        """
+        :return: 最早的到期时间，没有任务时返回None
+        """
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float) -> list:
+        """
+        取出所有到期的任务
+        :param now:
+        :return:
+        """
+        tasks = []
+        while self._heap and self._heap[0][0] <= now:
+            tasks.append(heapq.heappop(self._heap)[2])
+        return tasks
+
+
+class Scheduler(object):
+    """
+    按域名调度的任务队列（接口与queue.Queue一致），
+    每个域名的任务单独排队，get时返回任意一个有令牌的域名的任务，某个域名达到请求频率限制时不影响其他域名的任务，
+    工作线程只在所有域名都没有令牌时等待；已经有缓存的任务不发送网络请求，不受频率限制。
+    每个域名同时执行的任务数不超过该域名当前的并发上限（HostConcurrency），任务执行完成后需要调用done释放；
+    熔断中（CircuitBreaker）的域名的任务在熔断结束后调度；
+    没有执行完成的任务（TaskResult.retry_after）按重试间隔延后加入（put的delay参数），到期前工作线程可以执行其他任务
+    """
+
+    def __init__(self, limiter: HostRateLimiter = None):
+        self._limiter = limiter if limiter is not None else HostRateLimiter()
+        self._cond = threading.Condition()
+        # 不受频率限制的任务
+        self._free = deque()
+        # 域名 -> 任务队列
+        self._hosts = {}
+        # (可以请求的时间, 序号, 域名)
+        self._heap = []
+        # 达到并发上限的域名，有任务完成时重新调度
+        self._parked = set()
+        # 延后执行的任务
+        self._delayed = DelayQueue()
+        # id(任务) -> 域名，占用并发名额的任务
+        self._running = {}
+        self._seq = 0
+        self._size = 0
+
+    def qsize(self):
+        return self._size
+
+    def ready_qsize(self):
+        """
+        不包括延后执行的任务数
+        """
+        return self._size - len(self._delayed)
+
+    def empty(self):
+        return self._size == 0
+
+    def _push(self, host, ready_time):
+        self._seq += 1
+        heapq.heappush(self._heap, (ready_time, self._seq, host))
+
+    def _enqueue(self, task: Task, now: float):
+        host = get_host(task.url.value)
+        tasks = self._hosts.get(host)
+        if tasks is None:
+            tasks = self._hosts[host] = deque()
+            self._push(host, now)
+        tasks.append(task)
+
+    def put(self, task: Task, block=True, timeout=None, delay=0):
+        """
+        加入任务
+        :param task:
+        :param block: 不使用，与queue.Queue一致
+        :param timeout: 不使用，与queue.Queue一致
+        :param delay: 延后调度的时间（秒），用于失败重试
+        :return:
+        """
+        if delay > 0:
+            with self._cond:
+                self._delayed.put(task, time.time() + delay)
+                self._size += 1
+                self._cond.notify()
+            return
+        url = task.url.value
+        free = is_cached(url, get_app_config().raw_content)
+        with self._cond:
+            if free:
+                self._free.append(task)
+            else:
+                self._enqueue(task, time.time())
+            self._size += 1
+            self._cond.notify()
+
+    def get(self, block=True, timeout=None) -> Task:
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                task, wait = self._poll()
+                if task is not None:
+                    return task
+                if not block:
+                    raise queue.Empty
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
+
+    def poll(self):
+        """
+        不等待，取出一个可以执行的任务，用于异步模式（在事件循环中调用）
+        :return: (任务, None)；没有可以执行的任务时返回(None, 需要等待的时间)，等待时间为None表示等待新任务或者任务完成
+        """
+        with self._cond:
+            return self._poll()
+
+    def _poll(self):
+        if self._free:
+            self._size -= 1
+            return self._free.popleft(), None
+
+        # 到期的延后任务（下载失败，没有缓存）加入域名队列
+        now = time.time()
+        for task in self._delayed.pop_due(now):
+            self._enqueue(task, now)
+
+        wait = None
+        while self._heap:
+            ready_time, _, host = self._heap[0]
+            now = time.time()
+            if ready_time > now:
+                wait = ready_time - now
+                break
+            heapq.heappop(self._heap)
+            tasks = self._hosts[host]
+            url = tasks[0].url.value
+            # 域名熔断中，熔断结束后再调度
+            open_wait = CircuitBreaker.get_wait(url)
+            if open_wait:
+                self._push(host, now + open_wait)
+                continue
+            if not HostConcurrency.try_acquire(url):
+                self._parked.add(host)
+                continue
+            ok, next_time = self._limiter.acquire(url)
+            if not ok:
+                # 令牌被其他进程（或者同一域名的其他配置）使用
+                HostConcurrency.release(url)
+                self._push(host, now + next_time)
+                continue
+            task = tasks.popleft()
+            self._running[id(task)] = host
+            if tasks:
+                self._push(host, now + next_time)
+            else:
+                del self._hosts[host]
+            self._size -= 1
+            return task, None
+
+        next_due = self._delayed.next_due()
+        if next_due is not None:
+            due_wait = max(next_due - time.time(), 0)
+            wait = due_wait if wait is None else min(wait, due_wait)
+        return None, wait
+
+    def done(self, task: Task):
+        """
+        任务执行完成，释放任务所在域名的并发名额
+        :param task:
+        :return:
+        """
+        with self._cond:
+            host = self._running.pop(id(task), None)
+            if host is None:
+                return
+            HostConcurrency.release(task.url.value)
+            if host in self._parked:
+                self._parked.remove(host)
+                self._push(host, time.time())
+                self._cond.notify()
+
+    def put_many(self, tasks: list):
+        for task in tasks:
+            self.put(task)
+        if tasks:
+            logger.info('Add {} new tasks, scheduled task count: {}'.format(len(tasks), self._size))
+
+
+def _setup_test(initial_concurrency=2):
+    import tempfile
+    from common import cache
+    # 测试链接没有缓存，缓存目录使用临时目录
+    cache.CACHE_DIR = tempfile.mkdtemp()
+    app_config = get_app_config()
+    app_config.adaptive_concurrency = True
+    app_config.initial_host_concurrency = initial_concurrency
+    HostConcurrency.clear()
+    CircuitBreaker.clear()
+
+
+def test_host_rate_limiter():
+    limiter = HostRateLimiter(RateLimitMapping().add_url_rate(r'a\.test', 10, burst=3))
+    # 突发3个请求，之后每10秒一个
+    assert limiter.acquire('http://a.test/1') == (True, 0)
+    assert limiter.acquire('http://a.test/2') == (True, 0)
+    ok, wait = limiter.acquire('http://a.test/3')
+    assert ok and 9 < wait <= 10
+    ok, wait = limiter.acquire('http://a.test/4')
+    assert not ok and 9 < wait <= 10
+    # 其他域名不受影响
+    assert limiter.acquire('http://b.test/1') == (True, 0)
+
+
+def test_scheduler_hosts():
+    _setup_test(initial_concurrency=10)
+    scheduler = Scheduler(HostRateLimiter(RateLimitMapping().add_url_rate(r'slow\.test', 60)))
+    for url in ['http://slow.test/1', 'http://slow.test/2', 'http://fast.test/1', 'http://fast.test/2',
+                'http://fast.test/3']:
+        scheduler.put(Task(url, None))
+    urls = []
+    for _ in range(4):
+        task = scheduler.get(block=False)
+        urls.append(task.url.value)
+        scheduler.done(task)
+    # 限速的域名只执行一个任务，其他域名的任务继续执行
+    assert urls == ['http://slow.test/1', 'http://fast.test/1', 'http://fast.test/2', 'http://fast.test/3']
+    task, wait = scheduler.poll()
+    assert task is None and 59 < wait <= 60
+    assert scheduler.qsize() == 1
+    try:
+        scheduler.get(timeout=0.05)
+        assert False
+    except queue.Empty:
+        pass
+
+
+def test_scheduler_parked_host():
+    _setup_test(initial_concurrency=1)
+    scheduler = Scheduler(HostRateLimiter(RateLimitMapping()))
+    scheduler.put(Task('http://parked.test/1', None))
+    scheduler.put(Task('http://parked.test/2', None))
+    first = scheduler.get(block=False)
+    # 达到并发上限，域名暂停调度，等待任务完成（没有等待时间）
+    assert scheduler.poll() == (None, None)
+    scheduler.done(first)
+    second = scheduler.get(block=False)
+    assert second.url.value == 'http://parked.test/2'
+    scheduler.done(second)
+    assert scheduler.empty()
+
+
+def test_scheduler_delayed_task():
+    _setup_test()
+    scheduler = Scheduler(HostRateLimiter(RateLimitMapping()))
+    scheduler.put(Task('http://delay.test/1', None), delay=0.2)
+    assert scheduler.qsize() == 1 and scheduler.ready_qsize() == 0
+    task, wait = scheduler.poll()
+    assert task is None and 0 < wait <= 0.2
+    # 到期后加入域名队列
+    task = scheduler.get(timeout=1)
+    assert task.url.value == 'http://delay.test/1'
+    assert scheduler.empty()
+    scheduler.done(task)
+
+
+if __name__ == '__main__':
+    test_host_rate_limiter()
+    test_scheduler_hosts()
+    test_scheduler_parked_host()
+    test_scheduler_delayed_task()
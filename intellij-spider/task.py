@@ -1,19 +1,28 @@
+import time
 import queue
 from rule.rule import Rule
-from rule.ruleparser import RuleParser
+from rule.registry import RuleRegistry
+from rule.ruleparser import RuleParser, ParseEvent
 from network.urlloader import UrlLoader, Url
+from network.retry import CircuitOpenError, RetryLater
 from config import app_config
+from common.log import logger
 
 
 class Task(object):
     """
     对一个URL的处理过程，包括下载和解析2个步骤，同步执行
     执行结果返回Tuple，1：解析结果JSON， 2：提取的新的链接任务字典（k：链接， v:解析规则模板名称）
+    解析过程中每提取到一个新的链接即生成子任务，可以通过on_sub_task回调立即加入任务队列，不需要等待解析结束
     """
 
     def __init__(self, url: Url, rule: Rule):
         self._url = url if isinstance(url, Url) else Url(url)
         self._rule = rule
+        # 已经请求的次数（延后重试时继续计数）
+        self._attempt = 0
+        # 下载的截止时间
+        self._deadline = None
 
     @property
     def url(self):
@@ -23,22 +32,101 @@ class Task(object):
     def rule(self):
         return self._rule
 
-    def execute(self):
-        url_content = UrlLoader.load(url=self._url)
+    @property
+    def attempt(self):
+        return self._attempt
+
+    def get_deadline(self):
+        """
+        任务下载的截止时间（包括所有重试和跳转），超过截止时间后重新执行的任务使用新的截止时间
+        :return: 不限制时返回None
+        """
+        if not app_config.task_deadline:
+            return None
+        now = time.time()
+        if self._deadline is None or now >= self._deadline:
+            self._deadline = now + app_config.task_deadline
+        return self._deadline
+
+    def execute(self, on_sub_task=None, defer_retry=False):
+        """
+        下载并解析
+        :param on_sub_task: 子任务回调，解析过程中每生成一个子任务立即调用，为空时子任务只在执行结果中返回
+        :param defer_retry: 下载失败时不在当前线程等待重试，由调用方按执行结果的retry_after延后重新执行
+        :return: 域名熔断（或者延后重试）时，执行结果的retry_after为任务重新执行前需要等待的时间
+        """
+        try:
+            deadline = self.get_deadline()
+            if app_config.raw_content:
+                url_content = UrlLoader.load_raw(url=self._url, attempt=self._attempt, defer=defer_retry,
+                                                 deadline=deadline)
+            else:
+                url_content = UrlLoader.load(url=self._url, attempt=self._attempt, defer=defer_retry,
+                                             deadline=deadline)
+        except CircuitOpenError as e:
+            logger.info('Task deferred, {}, {}'.format(e, self._url))
+            return TaskResult(task=self, ok=False, retry_after=e.retry_after)
+        except RetryLater as e:
+            return self.defer(e)
+        return self.parse(url_content, on_sub_task)
+
+    def defer(self, e):
+        """
+        下载失败，记录已经请求的次数，任务延后重新执行
+        :param e: RetryLater
+        :return:
+        """
+        logger.info('Task deferred, {}, {}'.format(e, self._url))
+        self._attempt = e.attempt
+        return TaskResult(task=self, ok=False, retry_after=e.retry_after)
+
+    def parse(self, url_content, on_sub_task=None):
+        """
+        解析下载的内容
+        :param url_content: 网页内容，字符串或者原始内容RawContent
+        :param on_sub_task: 子任务回调，解析过程中每生成一个子任务立即调用
+        :return:
+        """
         result = TaskResult(task=self, ok=False)
         if url_content:
-            pr = RuleParser(self._rule, url_content, self._url.value).parse()
-            new_links = {}
-            for url, rule in pr.linked_urls.items():
-                new_url = self.wrap_new_url(url)
-                if new_url:
-                    # avoid new task is exactly same with parent task
-                    if new_url.value == self.url.value and rule == self.rule.name:
-                        continue
-                    new_links[new_url] = rule
-            result = TaskResult(task=self, ok=True, data=pr.data, linked_urls=new_links)
+            parser = RuleParser(self._rule, url_content, self._url.value, app_config.combined_scan,
+                                app_config.regex_timeout, app_config.adaptive_regex_order)
+            data, sub_tasks = None, []
+            for event in parser.iter_parse():
+                if event.kind == ParseEvent.LINK:
+                    sub_task = self.make_sub_task(event.key, event.value)
+                    if sub_task:
+                        sub_tasks.append(sub_task)
+                        if on_sub_task:
+                            on_sub_task(sub_task)
+                elif event.kind == ParseEvent.DATA:
+                    data = event.value
+            result = TaskResult(task=self, ok=True, data=data, sub_tasks=sub_tasks)
         return result
 
+    def make_sub_task(self, url, rule_name):
+        """
+        根据提取的链接和解析规则名称生成子任务
+        :param url:
+        :param rule_name:
+        :return: 链接或者规则无效时返回None
+        """
+        new_url = self.wrap_new_url(url)
+        if not new_url:
+            return None
+        # avoid new task is exactly same with parent task
+        if new_url.value == self.url.value and rule_name == self.rule.name:
+            return None
+        if not rule_name:
+            logger.error('Cannot make new task because of invalid url or rule: {} {}'.format(url, rule_name))
+            return None
+        rule = RuleRegistry.get(rule_name)
+        if not rule:
+            logger.error('Cannot make new task, rule [{}] does not exist, link: {}, parent: {} ({})'.format(
+                rule_name, url, self.url, self.rule.name))
+            return None
+        return Task(url=new_url, rule=rule)
+
     def wrap_new_url(self, url):
         if not url:
             return None
@@ -58,21 +146,12 @@ class TaskResult(object):
     单个任务执行结果包装
     """
 
-    def __init__(self, task: Task, ok, data: dict = None, linked_urls: dict = None):
+    def __init__(self, task: Task, ok, data: dict = None, sub_tasks: list = None, retry_after=None):
         self._ok = ok
         self._data = data
         self._task = task
-        self._sub_tasks = []
-        if linked_urls:
-            for url, rule_name in linked_urls.items():
-                if not url or not rule_name:
-                    print('Error: cannot make new task because of invalid url or rule:', url, rule_name)
-                    continue
-                rule = Rule.find_by_name(rule_name)
-                if rule:
-                    self._sub_tasks.append(Task(url=url, rule=rule))
-                else:
-                    print('Error: cannot find rule:', rule_name)
+        self._sub_tasks = sub_tasks if sub_tasks else []
+        self._retry_after = retry_after
 
     @property
     def ok(self):
@@ -90,6 +169,13 @@ class TaskResult(object):
     def sub_tasks(self):
         return self._sub_tasks
 
+    @property
+    def retry_after(self):
+        """
+        任务没有执行完成（域名熔断或者下载失败延后重试），需要在retry_after秒后重新执行，为空表示任务已经执行
+        """
+        return self._retry_after
+
 
 class TaskQueue(object):
     def __init__(self):